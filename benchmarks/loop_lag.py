@@ -0,0 +1,124 @@
+"""
+Measure event loop lag while many chats read and write the sqlite storage.
+
+    PYTHONPATH=src python benchmarks/loop_lag.py [--chats 50] [--messages 2000]
+
+The same workload runs with statements executed on the event loop (inline)
+and on the storage executor (threaded), the lag is the delay a 1ms ticker
+observes on top of its own sleep.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from pathlib import Path
+
+import catgpt.storage as storage
+from catgpt.storage import types
+from catgpt.storage.sqlite3_session_storage import (
+    Sqlite3Datasource,
+    Sqlite3TopicStorage,
+)
+
+SCHEMA_FILE = Path(__file__).parent.parent.joinpath(
+    "src/catgpt/data/session_schema.sql"
+)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def ticker(lags: list[float], stop: asyncio.Event, interval: float = 0.001):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - start - interval))
+
+
+async def populate(topic_storage: Sqlite3TopicStorage, chats: int, messages: int):
+    topic_ids = []
+    for chat_id in range(1, chats + 1):
+        topic = types.Topic(0, f"label-{chat_id}", chat_id, chat_id, "bench", 0, 0)
+        tid = await topic_storage.create_topic(topic)
+        batch = [
+            types.Message(
+                role="user" if i % 2 == 0 else "assistant",
+                content="lorem ipsum dolor sit amet " * 20,
+                message_id=i,
+                chat_id=chat_id,
+                topic_id=tid,
+                ts=i,
+            )
+            for i in range(messages)
+        ]
+        await topic_storage.append_message(tid, batch)
+        topic_ids.append(tid)
+
+    return topic_ids
+
+
+async def chat(topic_storage: Sqlite3TopicStorage, tid: int, rounds: int):
+    for i in range(rounds):
+        await topic_storage.get_messages([tid])
+        message = types.Message("user", "hi", 100000 + i, tid, tid, i)
+        await topic_storage.append_message(tid, [message])
+
+
+async def run(threaded: bool, chats: int, messages: int, rounds: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        datasource = Sqlite3Datasource(db_file, SCHEMA_FILE, threaded=threaded)
+        storage.datasource = datasource
+        topic_storage = Sqlite3TopicStorage()
+        topic_ids = await populate(topic_storage, chats, messages)
+
+        lags = []
+        stop = asyncio.Event()
+        tick = asyncio.create_task(ticker(lags, stop))
+        start = time.perf_counter()
+        await asyncio.gather(*[chat(topic_storage, tid, rounds) for tid in topic_ids])
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await tick
+        datasource.close()
+
+    return {
+        "mode": "threaded" if threaded else "inline",
+        "elapsed": elapsed,
+        "ticks": len(lags),
+        "lag_mean_ms": statistics.mean(lags) * 1000 if lags else 0.0,
+        "lag_p99_ms": percentile(lags, 99) * 1000,
+        "lag_max_ms": max(lags) * 1000 if lags else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=3)
+    options = parser.parse_args()
+
+    results = []
+    for threaded in (False, True):
+        result = asyncio.run(
+            run(threaded, options.chats, options.messages, options.rounds)
+        )
+        results.append(result)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Measure the CPU time of rendering the MarkdownV2 edits of a streamed reply.
+
+    PYTHONPATH=src python benchmarks/markdown_render.py [--length 4096] [--edit-every 40]
+
+A markdown reply of `length` characters is streamed in chunks of 8 to 30
+characters and rendered after every `edit-every` characters, once with
+escape() over the whole text (full) and once with StreamingMarkdown
+(incremental).
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+from catgpt.utils.md2tgmd import escape, StreamingMarkdown
+
+PARAGRAPH = (
+    "The **event loop** runs every coroutine of the bot, so a handler that "
+    "blocks it delays all chats. Use `asyncio.to_thread` for blocking calls "
+    "and keep the handlers _short_.\n\n"
+)
+LIST = "1. read the stream\n2. buffer the text\n3. edit the reply\n\n"
+CODE = "```python\nasync def main():\n    await asyncio.sleep(1)\n    print('done')\n```\n\n"
+HEADING = "## Streaming\n\n"
+
+
+def make_reply(length: int, rnd: random.Random) -> str:
+    parts = [PARAGRAPH, LIST, CODE, HEADING]
+    text = ""
+    while len(text) < length:
+        text += rnd.choice(parts)
+
+    return text[:length]
+
+
+def snapshots(text: str, edit_every: int, rnd: random.Random) -> list[str]:
+    result = []
+    pos = 0
+    last_edit = 0
+    while pos < len(text):
+        pos = min(len(text), pos + rnd.randint(8, 30))
+        if pos - last_edit >= edit_every or pos == len(text):
+            result.append(text[:pos])
+            last_edit = pos
+
+    return result
+
+
+def measure(render, texts: list[str]) -> dict:
+    times = []
+    for text in texts:
+        start = time.process_time()
+        render(text)
+        times.append(time.process_time() - start)
+
+    return {
+        "edits": len(times),
+        "cpu_total_ms": sum(times) * 1000,
+        "cpu_per_edit_ms": statistics.mean(times) * 1000,
+        "cpu_last_edit_ms": times[-1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--length", type=int, default=4096)
+    parser.add_argument("--edit-every", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=42)
+    options = parser.parse_args()
+
+    rnd = random.Random(options.seed)
+    text = make_reply(options.length, rnd)
+    texts = snapshots(text, options.edit_every, rnd)
+
+    full = {"mode": "full"}
+    full.update(measure(escape, texts))
+    markdown = StreamingMarkdown()
+    incremental = {"mode": "incremental"}
+    incremental.update(measure(markdown.render, texts))
+    incremental["same_final_output"] = markdown.render(text) == escape(text)
+
+    print(json.dumps([full, incremental], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Measure the CPU time and the memory allocated per turn to build the provider
+payload of a growing topic.
+
+    PYTHONPATH=src python benchmarks/payload_build.py [--turns 50] [--photo-every 5]
+
+Every turn adds a user message and a reply, every `photo-every` user message
+is a photo of 60 KiB. The payload is built once from scratch with
+message2payload (full) and once with the PayloadCache of the topic (cached).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+import tracemalloc
+
+from catgpt.provider import oai
+from catgpt.provider.payload import PayloadCache
+from catgpt.storage import types
+
+TEXT = "lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 10
+
+
+def make_turn(turn: int, photo_every: int) -> list[types.Message]:
+    question = types.Message("user", TEXT, 2 * turn + 1, 1, 1, turn)
+    if turn % photo_every == 0:
+        question.message_type = 1
+        question.media_url = f"media://{turn}"
+        question.media_data = os.urandom(60 * 1024)
+    answer = types.Message("assistant", TEXT * 3, 2 * turn + 2, 1, 1, turn)
+    return [question, answer]
+
+
+def measure(build, turns: int, photo_every: int) -> dict:
+    messages = []
+    times = []
+    allocated = []
+    for turn in range(turns):
+        messages = messages + make_turn(turn, photo_every)
+        tracemalloc.start()
+        start = time.process_time()
+        build(messages)
+        times.append(time.process_time() - start)
+        allocated.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        "turns": turns,
+        "cpu_per_turn_ms": statistics.mean(times) * 1000,
+        "cpu_last_turn_ms": times[-1] * 1000,
+        "peak_kib_per_turn": statistics.mean(allocated) / 1024,
+        "peak_kib_last_turn": allocated[-1] / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--photo-every", type=int, default=5)
+    options = parser.parse_args()
+
+    full = {"mode": "full"}
+    full.update(measure(oai.message2payload, options.turns, options.photo_every))
+
+    payloads = PayloadCache()
+    cached = {"mode": "cached"}
+    cached.update(
+        measure(
+            lambda messages: payloads.build(oai, "openai", 1, messages),
+            options.turns,
+            options.photo_every,
+        )
+    )
+    cached["converted_bytes_per_turn"] = payloads.get_metrics()[
+        "converted_bytes_per_turn"
+    ]
+
+    print(json.dumps([full, cached], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Time the sqlite storage operations on a database shaped like a real one.
+
+    PYTHONPATH=src python benchmarks/storage_ops.py [--users 2000] [--topics 500] \
+        [--iterations 200] [--concurrency 16] [--threaded] [--output run.json]
+
+    python benchmarks/storage_ops.py --compare base.json run.json [--threshold 0.2]
+
+Every operation runs once in a row (single) and from `concurrency` tasks at
+the same time (concurrent). Topics hold 10 to 2000 messages, log-uniformly
+distributed, and some of their messages are photos kept in the media table.
+A compare exits with 1 if the p50 or p95 of an operation got slower by more
+than the threshold. remove_messages and clear_topic skip an iteration once
+their data runs out, it isn't timed. clear_topic needs --topics >= 2 *
+--iterations to time them all.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+import catgpt.storage as storage
+from catgpt.storage import types
+from catgpt.storage.sqlite3_session_storage import (
+    Sqlite3Datasource,
+    Sqlite3TopicStorage,
+    Sqlite3ProfileStorage,
+    Sqlite3UserStorage,
+    Sqlite3MediaStorage,
+)
+from catgpt.topic import Topic
+
+SCHEMA_FILE = Path(__file__).parent.parent.joinpath(
+    "src/catgpt/data/session_schema.sql"
+)
+
+OPERATIONS = [
+    "get_profile",
+    "list_topics",
+    "get_messages",
+    "append_message",
+    "remove_messages",
+    "clear_topic",
+]
+TEXT = "lorem ipsum dolor sit amet, consectetur adipiscing elit. "
+PHOTO_EVERY = 25
+
+
+class Dataset:
+    def __init__(self):
+        # (uid, chat_id)
+        self.users: list[tuple[int, int]] = []
+        self.topic_ids: list[int] = []
+        self.topics: dict[int, types.Topic] = {}
+        # topic id -> message ids appended by the benchmark
+        self.appended: dict[int, list[int]] = {}
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def message_count(rnd: random.Random) -> int:
+    return int(10 * 200 ** rnd.random())
+
+
+async def populate(options, rnd: random.Random) -> Dataset:
+    users = Sqlite3UserStorage()
+    profiles = Sqlite3ProfileStorage()
+    topics = Sqlite3TopicStorage()
+    media = Sqlite3MediaStorage()
+    data = Dataset()
+
+    for uid in range(1, options.users + 1):
+        chat_id = uid if rnd.random() < 0.8 else -uid
+        await users.create_user(types.User(uid, 0))
+        profile = types.Profile(uid, "gpt-4o", "openai", "", 0, chat_id, 0, 0, "", "")
+        await profiles.create_profile(profile)
+        data.users.append((uid, chat_id))
+
+    for i in range(options.topics):
+        uid, chat_id = data.users[i % len(data.users)]
+        topic = types.Topic(0, f"label-{i}", chat_id, uid, f"topic {i}", 0, 0)
+        topic.tid = await topics.create_topic(topic)
+
+        messages = []
+        for n in range(message_count(rnd)):
+            message = types.Message(
+                role="user" if n % 2 == 0 else "assistant",
+                content=TEXT * rnd.randint(1, 20),
+                message_id=n + 1,
+                chat_id=chat_id,
+                topic_id=topic.tid,
+                ts=n,
+            )
+            if n % PHOTO_EVERY == 0:
+                photo = os.urandom(rnd.randint(20, 80) * 1024)
+                digest = hashlib.sha256(photo).hexdigest()
+                await media.save_media(
+                    types.Media(digest, "image/jpeg", len(photo), photo)
+                )
+                message.message_type = 1
+                message.media_url = types.MEDIA_SCHEME + digest
+            messages.append(message)
+
+        await topics.append_message(topic.tid, messages)
+        data.topic_ids.append(topic.tid)
+        data.topics[topic.tid] = topic
+
+    return data
+
+
+def make_operation(name: str, data: Dataset, rnd: random.Random):
+    profiles = Sqlite3ProfileStorage()
+    topic_storage = Sqlite3TopicStorage()
+    topic = Topic(topic_storage)
+    # topics not cleared yet, clear_topic picks each of them once
+    uncleared = list(data.topic_ids)
+    rnd.shuffle(uncleared)
+    counter = [1000000]
+
+    async def get_profile():
+        uid, chat_id = rnd.choice(data.users)
+        await profiles.get_profile(uid, chat_id, 0)
+
+    async def list_topics():
+        uid, chat_id = rnd.choice(data.users)
+        await topic_storage.list_topics(uid, chat_id, 0)
+
+    async def get_messages():
+        await topic_storage.get_messages([rnd.choice(data.topic_ids)])
+
+    async def append_message():
+        tid = rnd.choice(data.topic_ids)
+        counter[0] += 1
+        message_id = counter[0]
+        messages = [
+            types.Message(role, TEXT, message_id, tid, tid, int(time.time()))
+            for role in ("user", "assistant")
+        ]
+        await topic_storage.append_message(tid, messages)
+        data.appended.setdefault(tid, []).append(message_id)
+
+    async def remove_messages():
+        if not data.appended:
+            return False
+        tid = rnd.choice(list(data.appended))
+        message_id = data.appended[tid].pop()
+        if not data.appended[tid]:
+            del data.appended[tid]
+        await topic_storage.remove_messages(tid, [message_id])
+
+    async def clear_topic():
+        if not uncleared:
+            return False
+        tid = uncleared.pop()
+        await topic.clear_topic(data.topics[tid])
+
+    return {
+        "get_profile": get_profile,
+        "list_topics": list_topics,
+        "get_messages": get_messages,
+        "append_message": append_message,
+        "remove_messages": remove_messages,
+        "clear_topic": clear_topic,
+    }[name]
+
+
+async def measure(operation, iterations: int, concurrency: int) -> dict:
+    """an operation returns False if it had nothing left to do, it isn't counted"""
+    latencies = []
+    skipped = [0]
+
+    async def worker(count: int):
+        for _ in range(count):
+            start = time.perf_counter()
+            if await operation() is False:
+                skipped[0] += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    counts = [iterations // concurrency] * concurrency
+    for i in range(iterations % concurrency):
+        counts[i] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(count) for count in counts if count > 0])
+    elapsed = time.perf_counter() - start
+
+    return {
+        "count": len(latencies),
+        "skipped": skipped[0],
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "ops_per_sec": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+async def run(options) -> dict:
+    rnd = random.Random(options.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        datasource = Sqlite3Datasource(db_file, SCHEMA_FILE, threaded=options.threaded)
+        storage.datasource = datasource
+
+        start = time.perf_counter()
+        data = await populate(options, rnd)
+        populate_elapsed = time.perf_counter() - start
+
+        results = []
+        for name in OPERATIONS:
+            operation = make_operation(name, data, rnd)
+            for mode, concurrency in (
+                ("single", 1),
+                ("concurrent", options.concurrency),
+            ):
+                result = {"operation": name, "mode": mode}
+                result.update(await measure(operation, options.iterations, concurrency))
+                results.append(result)
+
+        datasource.close()
+
+    return {
+        "meta": {
+            "users": options.users,
+            "topics": options.topics,
+            "iterations": options.iterations,
+            "concurrency": options.concurrency,
+            "threaded": options.threaded,
+            "seed": options.seed,
+            "populate_sec": populate_elapsed,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+        },
+        "results": results,
+    }
+
+
+def compare(base_file: str, run_file: str, threshold: float) -> bool:
+    """print the change of every operation, return False on a regression"""
+    with open(base_file) as f:
+        base = {(r["operation"], r["mode"]): r for r in json.load(f)["results"]}
+    with open(run_file) as f:
+        results = json.load(f)["results"]
+
+    ok = True
+    print(f"{'operation':<18}{'mode':<12}{'p50 ms':>16}{'p95 ms':>16}")
+    for r in results:
+        before = base.get((r["operation"], r["mode"]))
+        if before is None or not before["count"] or not r["count"]:
+            # nothing was timed, every iteration was skipped
+            continue
+
+        columns = []
+        for key in ("p50_ms", "p95_ms"):
+            change = (r[key] - before[key]) / before[key] if before[key] > 0 else 0.0
+            flag = ""
+            if change > threshold:
+                flag = " !"
+                ok = False
+            columns.append(f"{r[key]:8.3f} {change:+6.0%}{flag}")
+
+        print(f"{r['operation']:<18}{r['mode']:<12}{columns[0]:>16}{columns[1]:>16}")
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--topics", type=int, default=500)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--threaded", action="store_true")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "RUN"))
+    parser.add_argument("--threshold", type=float, default=0.2)
+    options = parser.parse_args()
+
+    if options.compare:
+        sys.exit(0 if compare(*options.compare, options.threshold) else 1)
+
+    if options.topics < 2 * options.iterations:
+        print(
+            "clear_topic needs --topics >= 2 * --iterations, the rest are skipped",
+            file=sys.stderr,
+        )
+
+    report = json.dumps(asyncio.run(run(options)), indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
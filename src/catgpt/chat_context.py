@@ -0,0 +1,114 @@
+import time
+
+from contextvars import ContextVar
+
+from .storage import types
+from .storage.write_behind import WriteBehindQueue
+from .topic import Topic
+from .user_profile import UserProfile, Users
+
+# the chat context loaded by permission_check for the handler it runs
+current: ContextVar[types.ChatContext | None] = ContextVar("chat_context", default=None)
+
+
+class ChatContexts:
+    """
+    Loads the user, profile, topic and recent messages of a chat message from
+    the caches, or with one read transaction if any of them is missing.
+    """
+
+    def __init__(
+        self,
+        storage: types.ChatContextStorage,
+        users: Users,
+        profiles: UserProfile,
+        topic: Topic,
+        write_behind: WriteBehindQueue = None,
+    ):
+        self.storage = storage
+        self.users = users
+        self.profiles = profiles
+        self.topic = topic
+        self.write_behind = write_behind
+
+    def _from_cache(
+        self, uid: int, chat_id: int, thread_id: int, fetch_messages: bool
+    ) -> types.ChatContext | None:
+        user = self.users.get_cached(uid)
+        if user is None:
+            return None
+
+        profile = self.profiles.get_cached(uid, chat_id, thread_id)
+        if profile is None:
+            return None
+
+        topic = self.topic.get_cached(profile.topic_id, fetch_messages)
+        if topic is None:
+            return None
+
+        return types.ChatContext(user, profile, topic, fetch_messages)
+
+    async def load(
+        self, uid: int, chat_id: int, thread_id: int, context_budget=None
+    ) -> types.ChatContext:
+        start = time.monotonic()
+        context = await self._load(uid, chat_id, thread_id, context_budget)
+        context.load_time = time.monotonic() - start
+        return context
+
+    async def _load(
+        self, uid: int, chat_id: int, thread_id: int, context_budget
+    ) -> types.ChatContext:
+        context = self._from_cache(uid, chat_id, thread_id, context_budget is not None)
+        if context is not None:
+            return context
+
+        if self.write_behind is not None:
+            # only the writes this context reads are flushed, the others stay
+            # in their batch
+            await self.write_behind.sync(f"profile:{uid}-{chat_id}-{thread_id or 0}")
+            profile = self.profiles.get_cached(uid, chat_id, thread_id)
+            if profile is not None:
+                await self.write_behind.sync(f"topic:{profile.topic_id}")
+
+        budget = context_budget
+        cache_topic = context_budget is not None and self.topic.cache is not None
+        if cache_topic:
+            # load the whole topic once, the cache serves the following messages
+            def budget(profile: types.Profile):
+                return None if context_budget(profile) is None else 0
+
+        writes = self.topic.writes
+        profile_writes = self.profiles.writes
+        context = await self.storage.load_context(uid, chat_id, thread_id, budget)
+        if (
+            self.write_behind is not None
+            and context.profile is not None
+            and self.write_behind.has_pending(f"topic:{context.profile.topic_id}")
+        ):
+            # the topic wasn't known before the profile was loaded
+            await self.write_behind.sync(f"topic:{context.profile.topic_id}")
+            context = await self.storage.load_context(uid, chat_id, thread_id, budget)
+        if context.user is not None:
+            self.users.remember(context.user)
+        if context.profile is not None:
+            self.profiles.remember(context.profile, profile_writes)
+        if cache_topic and context.has_messages:
+            self.topic.cache_loaded(context.topic, writes)
+
+        return context
+
+    async def get(
+        self, uid: int, chat_id: int, thread_id: int, context_budget=None
+    ) -> types.ChatContext:
+        """the context permission_check loaded for this message, or a new one"""
+        context = current.get()
+        if (
+            context is not None
+            and context.profile is not None
+            and context.profile.get_key() == f"{uid}-{chat_id}-{thread_id or 0}"
+            and (context_budget is None or context.has_messages)
+        ):
+            return context
+
+        return await self.load(uid, chat_id, thread_id, context_budget)
@@ -9,7 +9,8 @@ from telebot.async_telebot import AsyncTeleBot
 from telebot.types import BotCommand
 from telebot.asyncio_helper import RequestTimeout
 
-from ..context import profiles, config, topic, users
+from ..context import profiles, config, topic, chat_contexts, gateway
+from .. import chat_context
 from ..utils.md2tgmd import escape, NEW_LINE
 from ..utils.text import messages_to_segments, decode_message_id, encode_message_id
 from ..utils.prompt import get_prompt
@@ -72,21 +73,34 @@ async def new_profile(message: Message):
     )
 
 
-def permission_check(func):
+def permission_check(func, context_budget=None):
+    """
+    context_budget(profile), if given, picks the token budget of the recent
+    messages loaded along with the user and profile, see ChatContextStorage
+    """
+
     async def wrapper(message: Message, bot: AsyncTeleBot):
         try:
             uid = message.from_user.id
-            if await users.is_enrolled(uid):
-                if not await profiles.has_profile(
-                    uid, message.chat.id, message.message_thread_id
-                ):
+            context = await chat_contexts.load(
+                uid, message.chat.id, message.message_thread_id, context_budget
+            )
+            if context.user is not None:
+                if context.profile is None:
                     await new_profile(message)
-
-                await func(message, bot)
+                    # the handler loads the context of the new profile itself
+                    context = None
+
+                token = chat_context.current.set(context)
+                try:
+                    # handlers send and edit through the rate limited gateway
+                    await func(message, gateway)
+                finally:
+                    chat_context.current.reset(token)
             else:
                 text = "Please enter a valid key to use this bot. You can do this by typing '/key key'."
                 await send_message(
-                    bot,
+                    gateway,
                     message.chat.id,
                     message.message_id,
                     text,
@@ -132,7 +146,7 @@ async def register_commands(bot: AsyncTeleBot) -> None:
         if handler is not None:
             try:
                 await handler(
-                    bot=bot,
+                    bot=gateway,
                     operation=operation,
                     msg_ids=message_ids,
                     chat_id=chat_id,
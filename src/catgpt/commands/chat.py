@@ -1,19 +1,32 @@
 from telebot.async_telebot import AsyncTeleBot
-from telebot.asyncio_helper import ApiTelegramException
 from telebot.types import Message
 
-from ..context import profiles, config, get_bot_name, topic, group_config, page_preview
+from ..context import (
+    chat_contexts,
+    config,
+    get_bot_name,
+    topic,
+    group_config,
+    page_preview,
+    media,
+    gateway,
+    router,
+    titles,
+    turns,
+)
 from ..types import Endpoint, MessageType, Preview
-from ..utils.text import get_timeout_from_text, MAX_TEXT_LENGTH
 from . import create_convo_and_update_profile
-from ..provider import ask, ask_stream
 from ..utils.md2tgmd import escape
 from ..storage import types
 from ..utils import tg_image
+from .. import context_window
+from ..streaming import StreamBuffer, ReplyRenderer, read_stream
+from ..gateway import Priority
+from ..limiter import EndpointBusy
+from ..timing import TurnTimer
 
 import time
 import asyncio
-import base64
 import logging
 
 
@@ -40,6 +53,21 @@ async def send_message(bot: AsyncTeleBot, message: Message, text: str):
     )
 
 
+def select_model(endpoint: Endpoint, profile: types.Profile) -> str:
+    if profile.model in endpoint.models:
+        return profile.model
+
+    return endpoint.default_model
+
+
+def get_context_budget(profile: types.Profile) -> int | None:
+    endpoint = config.get_endpoint(profile.endpoint)
+    if endpoint is None:
+        return None
+
+    return endpoint.get_context_budget(select_model(endpoint, profile))
+
+
 async def handle_message(message: Message, bot: AsyncTeleBot) -> None:
     message_text = (message.text or "").strip()
     if message.chat.type in ["group", "supergroup", "gigagroup", "channel"]:
@@ -49,20 +77,44 @@ async def handle_message(message: Message, bot: AsyncTeleBot) -> None:
             message.text = message_text
 
     uid = message.from_user.id
-    chat_id = message.chat.id
-    profile = await profiles.load(uid, chat_id, message.message_thread_id)
-    convo_id = profile.topic_id
+    context = await chat_contexts.get(
+        uid, message.chat.id, message.message_thread_id, get_context_budget
+    )
+    # the turn started when permission_check began to load the context
+    timer = TurnTimer(time.monotonic() - context.load_time)
+    timer.stages["context"] = context.load_time
+    key = (message.chat.id, message.message_thread_id or 0, context.profile.topic_id)
+    queued = time.monotonic()
+
+    async def answer(waited: bool):
+        timer.stages["queue"] = time.monotonic() - queued
+        turn_context = context
+        if waited:
+            # the turns before this one added to the topic
+            turn_context = await chat_contexts.load(
+                uid, message.chat.id, message.message_thread_id, get_context_budget
+            )
+        await answer_message(message, bot, turn_context, message_text, timer)
+
+    await turns.run(key, answer)
+
+
+async def answer_message(
+    message: Message,
+    bot: AsyncTeleBot,
+    context: types.ChatContext,
+    message_text: str,
+    timer: TurnTimer,
+):
+    profile = context.profile
 
     endpoint: Endpoint = config.get_endpoint(profile.endpoint)
     if endpoint is None:
         await bot.reply_to(message=message, text="Please select an endpoint to use.")
         return
 
-    model = profile.model
-    if model not in endpoint.models:
-        model = endpoint.default_model
+    model = select_model(endpoint, profile)
 
-    img_data = None
     if message.content_type == "text":
         if not message_text:
             await bot.reply_to(message=message, text="Please enter a message.")
@@ -74,54 +126,69 @@ async def handle_message(message: Message, bot: AsyncTeleBot) -> None:
             )
             return
 
-        bin_data = await tg_image.download_image(bot, message, width=800, height=600)
-        img_data = base64.b64encode(bin_data).decode("utf-8")
-
-    convo = await topic.get_topic(convo_id, fetch_messages=True)
-    if convo is None:
-        convo = await create_convo_and_update_profile(
-            uid=uid,
-            chat_id=chat_id,
-            profile=profile,
-            chat_type=message.chat.type,
-            thread_id=message.message_thread_id,
+    # the placeholder is sent while the prompt is prepared and the provider
+    # request is opened, neither waits for the other
+    placeholder = asyncio.create_task(
+        timer.timed(
+            "placeholder",
+            bot.reply_to(message=message, text="A smart cat is thinking..."),
         )
-
-    messages = [
-        m
-        for m in convo.messages
-        if m.message_type != MessageType.REASONING_CONTENT.value
-    ]
-    msg_type = MessageType[message.content_type.upper()]
-    prompt_message = types.Message(
-        role="user",
-        content=message_text if msg_type.is_text() else message.caption,
-        message_id=message.message_id,
-        chat_id=chat_id,
-        topic_id=convo_id,
-        ts=int(time.time()),
-        message_type=msg_type.value,
     )
-    prompt_message.media_url = img_data
-    messages.append(prompt_message)
+    try:
+        convo, messages, img_data, uncounted = await prepare_prompt(
+            message, bot, context, endpoint, model, message_text, timer
+        )
+        # the fastest healthy endpoint serving the model, which may not be the selected one
+        opening = asyncio.create_task(
+            timer.timed(
+                "provider",
+                router.open_stream(
+                    endpoint,
+                    model,
+                    {"messages": messages, "topic_id": convo.tid},
+                    convo.user_id,
+                ),
+            )
+        )
+    except BaseException:
+        placeholder.cancel()
+        raise
 
-    reply_msg = await bot.reply_to(message=message, text="A smart cat is thinking...")
+    try:
+        await topic.update_tokens(convo.tid, uncounted)
+        reply_msg = await placeholder
+    except BaseException:
+        await close_stream(opening)
+        raise
+
+    msg_type = MessageType[message.content_type.upper()]
     message.text = message_text if msg_type.is_text() else img_data
     # await topic.save_or_update_message_holder(convo_id, message, reply_msg.message_id)
 
     text = ""
     try:
         text, reasoning_content = await do_reply(
-            endpoint, model, messages, reply_msg, bot, convo
+            endpoint, model, opening, reply_msg, bot, convo, timer
         )
         reply_msg.text = text
-        await topic.append_messages(convo_id, message, reply_msg, reasoning_content)
+        await topic.append_messages(convo.tid, message, reply_msg, reasoning_content)
 
         try:
             if convo.generate_title:
-                await do_generate_title(convo, messages, uid, text, endpoint)
+                title_endpoint = (
+                    endpoint
+                    if endpoint.generate_title
+                    else config.get_title_endpoint()[0]
+                )
+                titles.submit(convo, title_endpoint, messages, text)
         except Exception as ie:
             print(ie)
+    except EndpointBusy as e:
+        await bot.edit_message_text(
+            chat_id=message.chat.id,
+            message_id=reply_msg.message_id,
+            text=f"{endpoint.name} is {e}",
+        )
     except Exception as e:
         await bot.edit_message_text(
             chat_id=message.chat.id,
@@ -131,156 +198,125 @@ async def handle_message(message: Message, bot: AsyncTeleBot) -> None:
         logging.exception(e)
 
 
-async def do_reply(
+async def prepare_prompt(
+    message: Message,
+    bot: AsyncTeleBot,
+    context: types.ChatContext,
     endpoint: Endpoint,
     model: str,
-    messages: list,
-    reply_msg: Message,
-    bot: AsyncTeleBot,
-    convo: types.Topic,
+    message_text: str,
+    timer: TurnTimer,
 ):
-    text = ""
-    buffered = ""
-    start = time.time()
-    timeout = 1.8
-    text_overflow = False
-    tmp_info = f"*{endpoint.name},   {model.lower()}*: \n\n"
-    reasoning_content = ""
-    newline = False
-
-    async for chunk in await ask_stream(
-        endpoint,
-        {
-            "model": model,
-            "messages": messages,
-        },
-    ):
-        content = chunk["content"]
-        if chunk.get("reasoning"):
-            reasoning_content += content
-            newline = True
-        elif newline:
-            content = "\n\n---\n" + content
-            newline = False
-        elif not content:
-            print("empty chunk's content", chunk)
-            continue
-
-        buffered += content
-        finished = chunk["finished"] == "stop"
-
-        if text_overflow:
-            continue
-
-        if (time.time() - start > timeout and len(buffered) >= 18) or finished:
-            start = time.time()
-            try:
-                message_text = escape(f"{tmp_info}{text}{buffered}")
-                if len(message_text) > MAX_TEXT_LENGTH:
-                    text_overflow = True
-                    continue
-
-                await bot.edit_message_text(
-                    text=message_text,
-                    chat_id=reply_msg.chat.id,
-                    message_id=reply_msg.message_id,
-                    parse_mode="MarkdownV2",
-                    disable_web_page_preview=True,
-                )
-                text += buffered
-                buffered = ""
-                timeout = 1.8
-            except ApiTelegramException as ae:
-                print(ae)
-                if ae.error_code == 400:
-                    timeout = 2.5
-                    print(escape(text + buffered))
-                elif ae.error_code == 429:
-                    seconds = get_timeout_from_text(ae.description)
-                    timeout = 10 if seconds < 0 else seconds + 1
-                else:
-                    raise ae
-
-    delta = timeout - (time.time() - start)
-    if delta > 0:
-        await asyncio.sleep(int(delta) + 1)
-
-    msg_text = escape(text + buffered)
-    if text_overflow or len(msg_text) > MAX_TEXT_LENGTH:
-        if config.topic_preview == Preview.TELEGRAPH:
-            msg_text = text + buffered
-            title = f"{convo.title}_{reply_msg.message_id}"
-            url = await page_preview.preview_chat(convo.label, title, msg_text)
-            await bot.edit_message_text(
-                chat_id=reply_msg.chat.id,
-                message_id=reply_msg.message_id,
-                text=url,
-                disable_web_page_preview=False,
-            )
-
-            if len(reasoning_content) > 0:
-                msg_text = fullText[len(reasoning_content) + 6 :]
-            return msg_text, reasoning_content
+    """
+    the topic, the messages sent to the model, the media reference of the
+    prompt and the messages whose tokens were counted for the first time
+    """
+    uid = message.from_user.id
+    chat_id = message.chat.id
+    profile = context.profile
+    convo_id = profile.topic_id
 
-        text_overflow = True
-        msg_text = escape(text)
+    img_data = None
+    bin_data = None
+    if message.content_type == "photo":
+        with timer.stage("media"):
+            bin_data = await tg_image.download_image(
+                bot, message, width=800, height=600
+            )
+            img_data = await media.save(bin_data)
 
-    msg = await bot.edit_message_text(
-        text=msg_text,
-        chat_id=reply_msg.chat.id,
-        message_id=reply_msg.message_id,
-        parse_mode="MarkdownV2",
-        disable_web_page_preview=True,
-    )
+    convo = context.topic
+    if convo is None:
+        with timer.stage("topic"):
+            convo = await create_convo_and_update_profile(
+                uid=uid,
+                chat_id=chat_id,
+                profile=profile,
+                chat_type=message.chat.type,
+                thread_id=message.message_thread_id,
+            )
 
-    if text_overflow:
-        await bot.send_message(
-            chat_id=reply_msg.chat.id,
-            text=escape(buffered),
-            reply_to_message_id=msg.message_id,
+    with timer.stage("prompt"):
+        messages = [
+            m
+            for m in convo.messages
+            if m.message_type != MessageType.REASONING_CONTENT.value
+        ]
+        uncounted = [m for m in messages if not m.tokens]
+        msg_type = MessageType[message.content_type.upper()]
+        prompt_message = types.Message(
+            role="user",
+            content=message_text if msg_type.is_text() else message.caption,
+            message_id=message.message_id,
+            chat_id=chat_id,
+            topic_id=convo_id,
+            ts=int(time.time()),
+            message_type=msg_type.value,
         )
+        prompt_message.media_url = img_data
+        prompt_message.media_data = bin_data
+        messages.append(prompt_message)
+        messages = context_window.build(messages, endpoint.get_context_budget(model))
 
-    fullText = text + buffered
-    if len(reasoning_content) > 0:
-        fullText = fullText[len(reasoning_content) + 6 :]
-
-    return fullText, reasoning_content
+    return convo, messages, img_data, [m for m in uncounted if m.tokens]
 
 
-async def do_generate_title(
-    convo: types.Topic, messages: list, uid: int, text: str, current: Endpoint
-):
-    endpoint = current if current.generate_title else config.get_title_endpoint()[0]
-    if endpoint is None:
-        return
+async def close_stream(opening: asyncio.Task):
+    """give up a provider stream that is still opening or wasn't read"""
+    if not opening.done():
+        opening.cancel()
+    elif not opening.cancelled() and opening.exception() is None:
+        _, stream = opening.result()
+        await stream.aclose()
 
-    title_prompt = "Please generate a title for this conversation without any lead-in, punctuation, quotation marks, periods, symbols, bold text, or additional text. Remove enclosing quotation marks. Please only return the title without any additional info."
 
-    title_messages = messages + [
-        types.Message(
-            role="assistant",
-            content=text,
-            message_id=0,
-            chat_id=0,
-            topic_id=0,
-            ts=int(time.time()),
-            message_type=0,
-        ),
-        types.Message(
-            role="user",
-            content=title_prompt,
-            message_id=0,
-            chat_id=0,
-            topic_id=0,
-            ts=int(time.time()),
-            message_type=0,
-        ),
-    ]
-    title = await ask(endpoint, {"messages": title_messages})
+async def do_reply(
+    endpoint: Endpoint,
+    model: str,
+    opening: asyncio.Task,
+    reply_msg: Message,
+    bot: AsyncTeleBot,
+    convo: types.Topic,
+    timer: TurnTimer,
+):
+    tmp_info = f"*{endpoint.name},   {model.lower()}*: \n\n"
+    buffer = StreamBuffer()
+    renderer = ReplyRenderer(gateway, reply_msg, tmp_info)
+    # the provider stream is read at full speed, slow edits only delay the renderer
+    rendering = asyncio.create_task(renderer.run(buffer))
+    try:
+        endpoint, stream = await opening
+        if not stream.cached:
+            # a replayed response says nothing about the endpoint
+            router.record_turn(endpoint, timer)
+        cached = ", cached" if stream.cached else ""
+        renderer.header = f"*{endpoint.name},   {model.lower()}{cached}*: \n\n"
+        await read_stream(stream, buffer)
+    except BaseException:
+        rendering.cancel()
+        raise
+    finally:
+        buffer.finish()
+
+    await rendering
+    if renderer.error is not None:
+        raise renderer.error
+
+    # the final edit replaces a pending intermediate one and goes out first
+    await renderer.finish(buffer.text)
+    gateway.record_final_latency(time.time() - buffer.finished_at)
+
+    if len(renderer.pages) > 1 and config.topic_preview == Preview.TELEGRAPH:
+        # the whole reply on one page, next to its chain of messages
+        title = f"{convo.title}_{reply_msg.message_id}"
+        url = await page_preview.preview_chat(convo.label, title, buffer.text)
+        await gateway.send_message(
+            chat_id=reply_msg.chat.id,
+            text=url,
+            reply_to_message_id=reply_msg.message_id,
+        )
 
-    convo.generate_title = False
-    convo.title = title
-    await topic.update_topic(convo)
+    return buffer.get_answer(), buffer.reasoning
 
 
 async def handle_document(message: Message, bot: AsyncTeleBot):
@@ -370,6 +406,10 @@ segmentation = SegmentationHandler()
 
 def message_check(func):
     async def wrapper(message: Message, bot: AsyncTeleBot):
+        # an update delivered again is dropped before anything is loaded for it
+        if turns.is_duplicate((message.chat.id, message.message_id)):
+            return
+
         if message.chat.type in ["group", "supergroup", "gigagroup", "channel"]:
             respond_message = await group_config.is_respond_group_message(
                 message.chat.id
@@ -390,10 +430,12 @@ def message_check(func):
 
 
 def register(bot: AsyncTeleBot, decorator, provider) -> None:
-    handler = decorator(message_check(handle_message))
+    # skip loading the chat context of redelivered updates and of group
+    # messages the bot doesn't answer
+    handler = message_check(decorator(handle_message, get_context_budget))
     bot.register_message_handler(
         handler, regexp=r"^(?!/)", pass_bot=True, content_types=["text"]
     )
     bot.register_message_handler(handler, pass_bot=True, content_types=["photo"])
-    doc_handler = decorator(message_check(handle_document))
+    doc_handler = message_check(decorator(handle_document, get_context_budget))
     bot.register_message_handler(doc_handler, pass_bot=True, content_types=["document"])
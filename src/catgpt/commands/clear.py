@@ -2,6 +2,7 @@ from telebot.async_telebot import AsyncTeleBot
 from telebot.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
 
 from ..context import topic, profiles, get_bot_name
+from ..provider import payloads
 from ..utils.md2tgmd import escape
 from ..utils.prompt import get_prompt
 
@@ -55,13 +56,14 @@ async def do_clear(
 
     profile = await profiles.load(uid, chat_id, message.message_thread_id)
     convo_id = profile.topic_id
-    convo = await topic.get_topic(convo_id, fetch_messages=True)
+    convo = await topic.get_topic(convo_id)
     if convo is None:
         return
 
-    message_ids = [msg.message_id for msg in convo.messages if msg.role != "system"]
+    message_ids = await topic.get_message_ids(convo.tid)
     prompt = get_prompt(profiles.get_prompt(profile.prompt))
     await topic.clear_topic(convo, prompt)
+    payloads.invalidate(convo.tid)
 
     await bot.send_message(
         chat_id=chat_id,
@@ -2,7 +2,7 @@ from telebot.async_telebot import AsyncTeleBot
 from telebot.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
 
 from ..utils.md2tgmd import escape
-from ..context import profiles, config, get_bot_name
+from ..context import profiles, config, get_bot_name, router
 from ..context import Endpoint
 
 
@@ -43,7 +43,7 @@ async def handle_endpoints(message: Message, bot: AsyncTeleBot):
         )
 
     endpoint_name = profile.endpoint or "None"
-    text = f"current endpoint: **{endpoint_name}** \nEndpoints:"
+    text = f"current endpoint: **{endpoint_name}** \n{get_routing_text()}Endpoints:"
     await bot.send_message(
         chat_id=message.chat.id,
         text=escape(text),
@@ -52,6 +52,36 @@ async def handle_endpoints(message: Message, bot: AsyncTeleBot):
     )
 
 
+def get_routing_text() -> str:
+    metrics = router.get_metrics()
+    if not metrics:
+        return ""
+
+    lines = ["Routing:"]
+    for name, stats in metrics.items():
+        state = "" if stats["healthy"] else ", **down**"
+        lines.append(
+            f"`{name}`: first token p50 {stats['ttft_p50_ms']:.0f} ms, "
+            f"p95 {stats['ttft_p95_ms']:.0f} ms, errors {stats['error_rate']:.0%}, "
+            f"{stats['requests']} requests, {stats['failovers']} failovers, "
+            f"{stats['first_token_timeouts']} first token timeouts, "
+            f"{stats['retries']} retries, {stats['stalls']} stalls, "
+            f"{stats.get('active', 0)} active, {stats.get('queued', 0)} queued, "
+            f"queue wait p95 {stats.get('wait_p95_ms', 0):.0f} ms, "
+            f"{stats.get('rejected', 0) + stats.get('timeouts', 0)} rejected{state}"
+        )
+        if stats["stages"]:
+            stages = ", ".join(
+                f"{stage} {t['p50_ms']:.0f}" for stage, t in stats["stages"].items()
+            )
+            lines.append(
+                f"  reply first token p50 {stats['turn_ttft_p50_ms']:.0f} ms, "
+                f"p99 {stats['turn_ttft_p99_ms']:.0f} ms ({stages} ms p50)"
+            )
+
+    return "\n".join(lines) + "\n"
+
+
 async def do_endpoint_change(
     bot: AsyncTeleBot,
     operation: str,
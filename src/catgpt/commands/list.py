@@ -4,6 +4,7 @@ from telebot.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
 from ..utils.md2tgmd import escape
 from ..utils.text import encode_message_id
 from ..context import profiles, topic
+from ..provider import payloads
 from ..utils.text import messages_to_segments, MAX_TEXT_LENGTH
 from . import send_file, handle_share
 
@@ -25,7 +26,9 @@ async def show_conversation_list(
     items = []
 
     # hint = "current topic: **[{index}]** \n\n{content}"
-    conversations = await topic.list_topics(int(uid), chat_id, thread_id)
+    conversations = await topic.list_topics(
+        int(uid), chat_id, thread_id, fetch_messages=False
+    )
     text = ""
     # current_index = 0
     for index, convo in enumerate(conversations):
@@ -96,7 +99,7 @@ async def do_convo_change(
     real_op = segs[0]
     conversation_id = int(segs[1])
 
-    convo = await topic.get_topic(conversation_id, fetch_messages=True)
+    convo = await topic.get_topic(conversation_id)
     if convo is None:
         await bot.send_message(
             chat_id=chat_id,
@@ -107,6 +110,9 @@ async def do_convo_change(
         return
 
     elif real_op == "s":  # switch to this conversation
+        profile = profiles.get_cached(uid, chat_id, message.message_thread_id)
+        if profile is not None and profile.topic_id != conversation_id:
+            payloads.invalidate(profile.topic_id)
         await profiles.update_conversation_id(
             uid, chat_id, message.message_thread_id, conversation_id
         )
@@ -119,7 +125,8 @@ async def do_convo_change(
         await bot.delete_messages(chat_id, [message.message_id] + msg_ids)
         return
     elif real_op == "sr":  # share this conversation to a share provider
-        if len(convo.messages) == 0:
+        counts = await topic.count_messages([conversation_id])
+        if counts.get(conversation_id, 0) == 0:
             await bot.send_message(
                 chat_id=chat_id,
                 parse_mode="MarkdownV2",
@@ -138,9 +145,11 @@ async def do_convo_change(
             )
         return
     elif real_op == "dl":
+        convo.messages = await topic.get_messages([conversation_id])
         await send_file(bot, message, convo)
     elif real_op == "d":  # delete this conversation
         await topic.remove_topic(conversation_id)
+        payloads.invalidate(conversation_id)
         await show_conversation_list(
             uid=uid,
             msg_id=msg_ids[0],
@@ -169,7 +178,7 @@ async def do_handle_tips(
         return
 
     conversation_id = int(operation)
-    convo = await topic.get_topic(conversation_id, fetch_messages=True)
+    convo = await topic.get_topic(conversation_id)
     my_message_ids = msg_ids + [message.message_id]
     encoded_ids = encode_message_id(my_message_ids)
 
@@ -201,10 +210,9 @@ async def do_handle_tips(
             )
         ],
     ]
-    messages = convo.messages
-    fragments = []
-    if len(messages) >= 2:
-        fragments = [messages[-2], messages[-1]]
+    fragments = await topic.get_last_messages(conversation_id, 2)
+    if len(fragments) < 2:
+        fragments = []
 
     summary = ""
     segments = messages_to_segments(fragments)
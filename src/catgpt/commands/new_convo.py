@@ -2,6 +2,7 @@ from telebot.async_telebot import AsyncTeleBot
 from telebot.types import Message
 
 from ..context import topic, profiles, get_bot_name
+from ..provider import payloads
 from ..utils.md2tgmd import escape
 from ..utils.prompt import get_prompt
 from . import get_profile_text
@@ -39,6 +40,11 @@ async def create_topic_and_update_profile(
     title: str = None,
     messages: list = None,
 ):
+    profile = profiles.get_cached(uid, chat_id, thread_id)
+    if profile is not None:
+        # the chat switches to the new topic
+        payloads.invalidate(profile.topic_id)
+
     convo = await topic.new_topic(
         title=title,
         chat_id=chat_id,
@@ -2,6 +2,7 @@ from telebot.async_telebot import AsyncTeleBot
 from telebot.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
 
 from ..context import profiles, topic
+from ..provider import payloads
 from ..utils.md2tgmd import escape
 from ..storage import types
 
@@ -9,7 +10,7 @@ from ..storage import types
 async def get_convo(uid, chat_id, thread_id) -> types.Topic:
     profile = await profiles.load(uid, chat_id, thread_id)
     convo_id = profile.topic_id
-    convo = await topic.get_topic(convo_id, fetch_messages=True)
+    convo = await topic.get_topic(convo_id)
 
     return convo
 
@@ -37,6 +38,20 @@ async def get_messages_to_revoke(
     return result
 
 
+async def load_messages_to_revoke(
+    topic_id: int, chat_id: int, count: int = None
+) -> list[types.Message]:
+    """Read only the tail of the topic, growing it until the revoke range fits"""
+    limit = count or 10
+    while True:
+        messages = await topic.get_last_messages(topic_id, limit, chat_id)
+        result = await get_messages_to_revoke(messages, chat_id, count)
+        if count is not None or len(messages) < limit or result[0].role == "user":
+            return result
+
+        limit *= 2
+
+
 async def handle_revoke(message: Message, bot: AsyncTeleBot):
     uid = message.from_user.id
     convo = await get_convo(uid, message.chat.id, message.message_thread_id)
@@ -50,8 +65,7 @@ async def handle_revoke(message: Message, bot: AsyncTeleBot):
     except ValueError:
         count = None
 
-    messages: list[types.Message] = convo.messages or []
-    revoke_messages = await get_messages_to_revoke(messages, message.chat.id, count)
+    revoke_messages = await load_messages_to_revoke(convo.tid, message.chat.id, count)
 
     if not revoke_messages:
         await bot.reply_to(
@@ -120,8 +134,7 @@ async def do_revoke(
     except (ValueError, AttributeError):
         count = None
 
-    messages: list[types.Message] = convo.messages or []
-    revoke_messages = await get_messages_to_revoke(messages, chat_id, count)
+    revoke_messages = await load_messages_to_revoke(convo.tid, chat_id, count)
 
     if not revoke_messages:
         await bot.send_message(
@@ -135,6 +148,7 @@ async def do_revoke(
     # Remove messages from conversation
     message_ids = [m.message_id for m in revoke_messages]
     await topic.remove_messages(convo.tid, message_ids)
+    payloads.invalidate(convo.tid)
 
     # Delete messages from chat
     message_ids.append(message.message_id)
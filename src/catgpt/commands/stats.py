@@ -0,0 +1,58 @@
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Message
+
+from ..context import config, gateway, topic, write_behind, turns, titles, responses
+from ..provider import payloads
+from .. import storage
+
+
+def format_metrics(name: str, metrics: dict, indent: str = "") -> list[str]:
+    lines = [f"{indent}{name}:"]
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            lines.extend(format_metrics(key, value, indent + "  "))
+        elif isinstance(value, float):
+            lines.append(f"{indent}  {key}: {value:.2f}")
+        else:
+            lines.append(f"{indent}  {key}: {value}")
+
+    return lines
+
+
+def get_stats_text() -> str:
+    sections = {
+        "gateway": gateway.get_metrics(),
+        "datasource": storage.datasource.get_metrics(),
+        "topic cache": topic.get_cache_metrics(),
+        "payloads": payloads.get_metrics(),
+        "turns": turns.get_metrics(),
+        "titles": titles.get_metrics(),
+    }
+    if write_behind is not None:
+        sections["write behind"] = write_behind.get_metrics()
+    if responses is not None:
+        sections["response cache"] = responses.get_metrics()
+
+    lines = []
+    for name, metrics in sections.items():
+        if metrics:
+            lines.extend(format_metrics(name, metrics))
+
+    return "\n".join(lines)
+
+
+async def handle_stats(message: Message, bot: AsyncTeleBot):
+    if message.from_user.id not in config.admins:
+        await bot.reply_to(message, "Only admins can see the stats.")
+        return
+
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=get_stats_text(),
+        message_thread_id=message.message_thread_id,
+    )
+
+
+def register(bot: AsyncTeleBot, decorator, action_provider):
+    handler = decorator(handle_stats)
+    bot.register_message_handler(handler, pass_bot=True, commands=["stats"])
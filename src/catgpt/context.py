@@ -8,12 +8,18 @@ from .group import GroupConfig
 from .types import Endpoint, Configuration, Preview
 from . import share
 from .topic import Topic
+from .chat_context import ChatContexts
+from .gateway import TelegramGateway
+from .turns import TurnQueue
+from .media import MediaStore
+from .response_cache import ResponseCache
 from . import storage
 from .share.preview import PagePreview
+from .storage.write_behind import WriteBehindQueue
+from .utils.cache import LRUCache
 
 import json
 
-
 config = Configuration()
 
 group_config: GroupConfig | None = None
@@ -24,6 +30,16 @@ topic: Topic | None = None
 bot: AsyncTeleBot
 bot_name = None
 page_preview: PagePreview | None = None
+write_behind: WriteBehindQueue | None = None
+media: MediaStore | None = None
+responses: ResponseCache | None = None
+chat_contexts: ChatContexts | None = None
+gateway: TelegramGateway | None = None
+turns: TurnQueue | None = None
+# Router, created in init_configuration
+router = None
+# TitleQueue, created in init_datasource
+titles = None
 
 
 async def init_configuration(options):
@@ -42,6 +58,9 @@ async def init_configuration(options):
     config.respond_group_message = c.get("respond_group_message", False)
     preview_type = c.get("topic_preview_type", Preview.TELEGRAPH.name)
     config.topic_preview = Preview[preview_type.upper()]
+    config.storage = c.get("storage", {})
+    config.title = c.get("title", {})
+    config.admins = c.get("admins", [])
 
     endpoints = c.get("endpoints", [])
     assert len(endpoints) > 0, "endpoints is required"
@@ -53,11 +72,38 @@ async def init_configuration(options):
     config.endpoints = list_endpoints
 
     global bot
+    global gateway
+    global router
+    global turns
     bot = AsyncTeleBot(
         token=c["tg_token"],
         disable_web_page_preview=True,
         disable_notification=True,
     )
+    rate_limit = c.get("rate_limit", {})
+    gateway = TelegramGateway(
+        bot,
+        global_rate=rate_limit.get("global", 30),
+        private_rate=rate_limit.get("private", 1),
+        group_rate=rate_limit.get("group", 20 / 60),
+        burst=rate_limit.get("burst", 3),
+    )
+
+    turns = TurnQueue(policy=c.get("turns", {}).get("policy", "queue"))
+
+    # the router depends on the provider package, which imports this module
+    from .router import Router
+
+    routing = c.get("routing", {})
+    router = Router(
+        config,
+        enabled=routing.get("enabled", True),
+        first_token_timeout=routing.get("first_token_timeout", 60),
+        stall_timeout=routing.get("stall_timeout", 120),
+        retries=routing.get("retries", 1),
+        max_failures=routing.get("max_failures", 3),
+        cooldown=routing.get("cooldown", 30),
+    )
 
     await share.init_providers(c.get("share", []), config)
 
@@ -68,33 +114,98 @@ async def init_datasource(options):
     global users
     global group_config
     global page_preview
+    global write_behind
+    global media
+    global chat_contexts
+    global titles
+    global responses
     from .storage.sqlite3_session_storage import (
         Sqlite3Datasource,
         Sqlite3TopicStorage,
         Sqlite3ProfileStorage,
         Sqlite3UserStorage,
         Sqlite3GroupInfoStorage,
+        Sqlite3MediaStorage,
+        Sqlite3ChatContextStorage,
+        Sqlite3ResponseCacheStorage,
     )
 
     db_file = options.db_file or "data.db"
     schema_file = Path(__file__).parent.joinpath("data").joinpath("session_schema.sql")
 
-    datasource = Sqlite3Datasource(db_file, schema_file)
+    datasource = Sqlite3Datasource(
+        db_file,
+        schema_file,
+        pool_size=config.storage.get("pool_size", 4),
+        pragmas=config.storage.get("pragmas"),
+        threaded=config.storage.get("threaded", False),
+    )
     storage.datasource = datasource
+
+    write_behind_options = config.storage.get("write_behind", {})
+    if write_behind_options.get("enabled", False):
+        write_behind = WriteBehindQueue(
+            interval_ms=write_behind_options.get("interval_ms", 50),
+            max_rows=write_behind_options.get("max_rows", 200),
+            durability=write_behind_options.get("durability", "commit"),
+        )
+
+    topic_cache = None
+    topic_cache_options = config.storage.get("topic_cache", {})
+    if topic_cache_options.get("max_bytes", 32 * 1024 * 1024) > 0:
+        topic_cache = LRUCache(
+            max_size=topic_cache_options.get("max_topics", 1024),
+            max_bytes=topic_cache_options.get("max_bytes", 32 * 1024 * 1024),
+            ttl=topic_cache_options.get("ttl", 3600),
+        )
+
     topic_storage = Sqlite3TopicStorage()
-    topic = Topic(topic_storage)
+    topic = Topic(topic_storage, write_behind, topic_cache)
 
     profile_storage = Sqlite3ProfileStorage()
     f_preset = Path(options.preset or "presets.json")
 
-    profiles = UserProfile(profile_storage, f_preset)
+    cache_options = config.storage.get("cache", {})
+    max_size = cache_options.get("max_size", 4096)
+    ttl = cache_options.get("ttl", 600)
+
+    profiles = UserProfile(
+        profile_storage, f_preset, write_behind, LRUCache(max_size, ttl=ttl)
+    )
     user_storage = Sqlite3UserStorage()
-    users = Users(user_storage)
+    users = Users(user_storage, LRUCache(max_size, ttl=ttl))
 
     group_storage = Sqlite3GroupInfoStorage()
-    group_config = GroupConfig(group_storage, config.respond_group_message)
+    group_config = GroupConfig(
+        group_storage, config.respond_group_message, LRUCache(max_size, ttl=ttl)
+    )
+
+    chat_contexts = ChatContexts(
+        Sqlite3ChatContextStorage(), users, profiles, topic, write_behind
+    )
 
     page_preview = PagePreview(profiles)
+    media = MediaStore(Sqlite3MediaStorage())
+
+    response_cache_options = config.storage.get("response_cache", {})
+    if response_cache_options.get("enabled", False):
+        responses = ResponseCache(
+            Sqlite3ResponseCacheStorage(),
+            ttl=response_cache_options.get("ttl", 3600),
+            max_entries=response_cache_options.get("max_entries", 10000),
+            max_bytes=response_cache_options.get("max_bytes", 64 * 1024 * 1024),
+        )
+
+    # the title queue depends on the provider package, which imports this module
+    from .titles import TitleQueue
+
+    titles = TitleQueue(
+        topic,
+        concurrency=config.title.get("concurrency", 2),
+        max_retries=config.title.get("max_retries", 3),
+        backoff=config.title.get("backoff", 2),
+        max_chars=config.title.get("max_chars", 1000),
+    )
 
 
 async def init(options):
@@ -0,0 +1,29 @@
+from .storage import types
+from .utils.tokens import count_message_tokens
+
+
+def build(messages: list[types.Message], budget: int) -> list[types.Message]:
+    """
+    Select the messages sent to the provider: system prompts are always kept,
+    followed by as many of the most recent messages as fit into the budget.
+    The latest message is kept even if it exceeds the budget on its own.
+    """
+    system = [m for m in messages if m.role == "system"]
+    history = [m for m in messages if m.role != "system"]
+
+    used = sum(count_message_tokens(m) for m in system)
+    start = len(history)
+    while start > 0:
+        tokens = count_message_tokens(history[start - 1])
+        if used + tokens > budget and start < len(history):
+            break
+
+        used += tokens
+        start -= 1
+
+    window = history[start:]
+    # don't start the conversation with a dangling reply
+    while len(window) > 1 and window[0].role != "user":
+        window = window[1:]
+
+    return system + window
@@ -23,7 +23,8 @@ create table message
     chat_id         INTEGER,
     ts              INTEGER,
     topic_id        INTEGER,
-    message_type    INTEGER default 0
+    message_type    INTEGER default 0,
+    tokens          INTEGER default 0 not null
 );
 
 create index idx_msg_topic_id on message (topic_id);
@@ -72,6 +73,25 @@ create table group_info
 
 create index gi_u_cid on group_info (chat_id);
 
+create table media
+(
+    hash       TEXT PRIMARY KEY,
+    mime_type  TEXT,
+    size       INTEGER,
+    data       BLOB
+);
+
+create table response_cache
+(
+    key        TEXT PRIMARY KEY,
+    content    TEXT,
+    reasoning  TEXT,
+    size       INTEGER default 0 not null,
+    created_at INTEGER default 0 not null
+);
+
+create index idx_rc_created_at on response_cache (created_at);
+
 create table version
 (
     version_name    TEXT,
@@ -0,0 +1,360 @@
+import asyncio
+import enum
+import itertools
+import statistics
+import time
+
+from collections import deque
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+from .utils.cache import LRUCache
+from .utils.text import get_timeout_from_text
+
+
+class Priority(enum.IntEnum):
+    # the last edit of a streamed reply
+    FINAL = 0
+    # sends and ordinary edits
+    NORMAL = 1
+    # intermediate edits of a streamed reply, a newer one replaces a pending one
+    PROGRESS = 2
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def get_retry_after(ae: ApiTelegramException) -> float:
+    parameters = (ae.result_json or {}).get("parameters") or {}
+    seconds = parameters.get("retry_after")
+    if seconds is None:
+        seconds = get_timeout_from_text(ae.description)
+
+    return 10 if seconds < 0 else seconds + 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def get_delay(self, now: float) -> float:
+        """seconds until a token is available"""
+        self._refill(now)
+        delay = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(delay, self.blocked_until - now)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class Request:
+    def __init__(
+        self, priority: Priority, seq: int, chat_id: int, key, message, func, args
+    ):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        # (chat_id, message_id) of a PROGRESS edit
+        self.key = key
+        # (chat_id, message_id) of an edit
+        self.message = message
+        self.func = func
+        self.args = args
+        self.future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+
+    def order(self):
+        return self.priority, self.seq
+
+
+class TelegramGateway:
+    """
+    Sends and edits Telegram messages within the flood limits: a global token
+    bucket for the bot and one per chat, tuned for private chats and groups.
+    Requests wait in a queue per chat, final edits of a reply go out before
+    anything else and a pending intermediate edit of a message is replaced
+    by a newer one. A 429 blocks the chat for retry_after and the request is
+    retried. Edits of a message go out one at a time, so an older edit still
+    in flight can't land after a newer one. Every other method is passed
+    through to the bot.
+    """
+
+    def __init__(
+        self,
+        bot: AsyncTeleBot,
+        global_rate: float = 30,
+        private_rate: float = 1,
+        group_rate: float = 20 / 60,
+        burst: float = 3,
+        max_retries: int = 3,
+    ):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        # chat id -> TokenBucket
+        self.buckets = LRUCache(max_size=10000)
+        # chat id -> pending requests
+        self.queues: dict[int, list[Request]] = {}
+        # (chat_id, message_id) -> pending PROGRESS edit
+        self.progress: dict[tuple, Request] = {}
+        self.counter = itertools.count()
+        self.wakeup: asyncio.Event | None = None
+        self.worker: asyncio.Task | None = None
+        self.inflight: set[asyncio.Task] = set()
+        # (chat_id, message_id) of the edits in flight
+        self.editing: set[tuple] = set()
+        self.closed = False
+
+        self.sent = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        self.max_queued = 0
+        self.final_latencies = deque(maxlen=1000)
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def _ensure_started(self):
+        if self.worker is None or self.worker.done():
+            self.wakeup = asyncio.Event()
+            self.worker = asyncio.create_task(self._run())
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.buckets.peek(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            bucket = TokenBucket(rate, self.burst)
+            self.buckets.put(chat_id, bucket)
+
+        return bucket
+
+    def _enqueue(self, request: Request):
+        if request.key is not None:
+            self.progress[request.key] = request
+
+        self.queues.setdefault(request.chat_id, []).append(request)
+        self.max_queued = max(self.max_queued, self.get_queued())
+        self.wakeup.set()
+
+    def _dequeue(self, request: Request):
+        queue = self.queues[request.chat_id]
+        queue.remove(request)
+        if not queue:
+            del self.queues[request.chat_id]
+
+        if request.key is not None and self.progress.get(request.key) is request:
+            del self.progress[request.key]
+
+    def submit(
+        self, priority: Priority, chat_id: int, func, *args, message_id: int = None
+    ) -> asyncio.Future:
+        """queue func(*args), the future resolves to None if the edit was replaced"""
+        self._ensure_started()
+        seq = None
+        key = None
+        message = None
+        if message_id is not None:
+            message = (chat_id, message_id)
+            pending = self.progress.get((chat_id, message_id))
+            if pending is not None:
+                # the newer edit takes the place of the pending one
+                self._dequeue(pending)
+                pending.future.set_result(None)
+                self.coalesced += 1
+                if priority == Priority.PROGRESS:
+                    seq = pending.seq
+            if priority == Priority.PROGRESS:
+                key = (chat_id, message_id)
+
+        if seq is None:
+            seq = next(self.counter)
+
+        request = Request(priority, seq, chat_id, key, message, func, args)
+        self._enqueue(request)
+        return request.future
+
+    def _next(self, now: float) -> tuple[Request | None, float | None]:
+        """the most urgent request of a chat with budget, or the time to wait"""
+        best = None
+        wait = None
+        for chat_id, queue in self.queues.items():
+            delay = self._bucket(chat_id).get_delay(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            # the edits of a message wait for its edit in flight
+            ready = [r for r in queue if r.message not in self.editing]
+            if not ready:
+                continue
+
+            request = min(ready, key=Request.order)
+            if best is None or request.order() < best.order():
+                best = request
+
+        return best, wait
+
+    async def _run(self):
+        while not self.closed:
+            self.wakeup.clear()
+            now = time.monotonic()
+            request, wait = self._next(now)
+            if request is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delay = self.global_bucket.get_delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            self.global_bucket.take(now)
+            self._bucket(request.chat_id).take(now)
+            self._dequeue(request)
+            if request.message is not None:
+                self.editing.add(request.message)
+            task = asyncio.create_task(self._execute(request))
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+
+    async def _execute(self, request: Request):
+        try:
+            result = await request.func(*request.args)
+            self.sent += 1
+            if not request.future.done():
+                request.future.set_result(result)
+        except ApiTelegramException as ae:
+            if ae.error_code != 429 or request.attempts >= self.max_retries:
+                if not request.future.done():
+                    request.future.set_exception(ae)
+                return
+
+            self.rate_limited += 1
+            request.attempts += 1
+            self._bucket(request.chat_id).block(get_retry_after(ae))
+            if request.key is not None and request.key in self.progress:
+                # a newer edit of the message is waiting already
+                request.future.set_result(None)
+                self.coalesced += 1
+            else:
+                self._enqueue(request)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        finally:
+            if request.message is not None:
+                self.editing.discard(request.message)
+                self.wakeup.set()
+
+    async def send_message(self, chat_id: int, text: str, *args, **kwargs):
+        def send():
+            return self.bot.send_message(chat_id, text, *args, **kwargs)
+
+        return await self.submit(Priority.NORMAL, chat_id, send)
+
+    async def reply_to(self, message, text: str, **kwargs):
+        def reply():
+            return self.bot.reply_to(message, text, **kwargs)
+
+        return await self.submit(Priority.NORMAL, message.chat.id, reply)
+
+    def submit_edit(
+        self,
+        text: str,
+        chat_id: int,
+        message_id: int,
+        priority: Priority = Priority.NORMAL,
+        **kwargs,
+    ) -> asyncio.Future:
+        def edit():
+            return self.bot.edit_message_text(
+                text, chat_id=chat_id, message_id=message_id, **kwargs
+            )
+
+        return self.submit(priority, chat_id, edit, message_id=message_id)
+
+    async def edit_message_text(
+        self,
+        text: str,
+        chat_id: int = None,
+        message_id: int = None,
+        priority: Priority = Priority.NORMAL,
+        **kwargs,
+    ):
+        if chat_id is None:
+            # inline messages don't belong to a chat
+            return await self.bot.edit_message_text(
+                text, chat_id=chat_id, message_id=message_id, **kwargs
+            )
+
+        return await self.submit_edit(text, chat_id, message_id, priority, **kwargs)
+
+    def record_final_latency(self, seconds: float):
+        """time between the last token of a reply and its final edit"""
+        self.final_latencies.append(seconds)
+
+    def get_queued(self, priority: Priority = None) -> int:
+        return sum(
+            1
+            for queue in self.queues.values()
+            for r in queue
+            if priority is None or r.priority == priority
+        )
+
+    def get_metrics(self) -> dict:
+        latencies = list(self.final_latencies)
+        return {
+            "queued": self.get_queued(),
+            "queued_final": self.get_queued(Priority.FINAL),
+            "queued_normal": self.get_queued(Priority.NORMAL),
+            "queued_progress": self.get_queued(Priority.PROGRESS),
+            "max_queued": self.max_queued,
+            "chats": len(self.queues),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "rate_limited": self.rate_limited,
+            "final_edits": len(latencies),
+            "final_latency_mean_ms": (
+                statistics.mean(latencies) * 1000 if latencies else 0.0
+            ),
+            "final_latency_p50_ms": percentile(latencies, 50) * 1000,
+            "final_latency_p95_ms": percentile(latencies, 95) * 1000,
+        }
+
+    async def close(self):
+        self.closed = True
+        if self.worker is not None:
+            self.worker.cancel()
+
+        for queue in self.queues.values():
+            for request in queue:
+                request.future.cancel()
+
+        self.queues.clear()
+        self.progress.clear()
@@ -1,26 +1,49 @@
 from .storage.types import GroupInfoStorage, GroupInfo
+from .utils.cache import LRUCache
 
 
 class GroupConfig:
-    def __init__(self, storage: GroupInfoStorage, respond_messages: int):
+    def __init__(
+        self, storage: GroupInfoStorage, respond_messages: int, cache: LRUCache = None
+    ):
         self.storage = storage
         self.respond_messages = respond_messages
-        self.memory = {}
+        # chat_id -> GroupInfo
+        self.cache = cache or LRUCache(max_size=4096, ttl=600)
+        # chat_id -> token of the load in flight, dropped by writes to the group
+        self.loading = {}
+
+    def invalidate(self, chat_id: int):
+        self.cache.invalidate(chat_id)
+
+    def invalidate_all(self):
+        self.cache.clear()
 
     async def is_respond_group_message(self, chat_id: int):
-        key = str(chat_id)
-        if key in self.memory:
-            return self.memory[key]
+        info = self.cache.get(chat_id)
+        if info is not None:
+            return info.respond_message
 
-        info = await self.storage.get_group_info(chat_id)
-        if not info:
-            info = GroupInfo(chat_id, self.respond_messages)
-            await self.storage.create_group_info(info)
+        token = object()
+        self.loading[chat_id] = token
+        try:
+            info = await self.storage.get_group_info(chat_id)
+            if not info:
+                info = GroupInfo(chat_id, self.respond_messages)
+                await self.storage.create_group_info(info)
+        finally:
+            loaded = self.loading.get(chat_id) is token
+            if loaded:
+                del self.loading[chat_id]
 
-        self.memory[key] = info.respond_message
+        # a load that ran into an update may have read the old row
+        if loaded:
+            self.cache.put(chat_id, info)
 
         return info.respond_message
 
     async def update_respond_messages(self, chat_id: int, respond_messages: int):
+        self.invalidate(chat_id)
         await self.storage.update_group_info(chat_id, respond_messages)
-        self.memory[str(chat_id)] = respond_messages
+        self.loading.pop(chat_id, None)
+        self.cache.put(chat_id, GroupInfo(chat_id, respond_messages))
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+from collections import OrderedDict, deque
+
+from .gateway import percentile
+
+
+class EndpointBusy(Exception):
+    pass
+
+
+class ConcurrencyLimiter:
+    """
+    Bounds the concurrent requests to an endpoint. Requests over the limit
+    wait in a bounded queue, one queue per user served in turn, so a user
+    sending many requests doesn't hold up the others. A request is rejected
+    at once when the queue is full, and after waiting `max_wait` seconds.
+    """
+
+    def __init__(
+        self, max_concurrency: int = 16, max_queue: int = 64, max_wait: float = 60
+    ):
+        assert max_concurrency > 0, "max concurrency must be > 0"
+
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        # uid -> waiting futures, users are served in this order
+        self.waiting: OrderedDict[int, deque] = OrderedDict()
+        self.queued = 0
+
+        self.rejected = 0
+        self.timeouts = 0
+        self.waits = deque(maxlen=1000)
+
+    def try_acquire(self) -> bool:
+        """take a slot if one is free and nobody is waiting for it"""
+        if self.active < self.max_concurrency and self.queued == 0:
+            self.active += 1
+            self.waits.append(0.0)
+            return True
+
+        return False
+
+    def is_full(self) -> bool:
+        return self.queued >= self.max_queue
+
+    def _remove(self, uid: int, future: asyncio.Future):
+        queue = self.waiting.get(uid)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self.queued -= 1
+            if not queue:
+                del self.waiting[uid]
+
+    async def acquire(self, uid: int):
+        if self.try_acquire():
+            return
+
+        if self.is_full():
+            self.rejected += 1
+            raise EndpointBusy("busy, please try again later")
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(uid, deque()).append(future)
+        self.queued += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self._remove(uid, future)
+            self.timeouts += 1
+            raise EndpointBusy("busy, please try again later")
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # the slot was handed over already
+                self.release()
+            else:
+                self._remove(uid, future)
+            raise
+
+        self.waits.append(time.monotonic() - start)
+
+    def release(self):
+        """hand the slot over to the next user in line, or free it"""
+        while self.waiting:
+            uid, queue = self.waiting.popitem(last=False)
+            future = queue.popleft()
+            self.queued -= 1
+            if queue:
+                # the user's next request goes to the back of the line
+                self.waiting[uid] = queue
+
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self.active -= 1
+
+    def get_metrics(self) -> dict:
+        waits = list(self.waits)
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "wait_p50_ms": percentile(waits, 50) * 1000,
+            "wait_p95_ms": percentile(waits, 95) * 1000,
+        }
@@ -3,7 +3,7 @@ import argparse
 
 from telebot.async_telebot import AsyncTeleBot, types
 
-from . import context
+from . import context, storage, provider
 
 
 async def main():
@@ -36,8 +36,19 @@ async def main():
     from .commands import register_commands
 
     await register_commands(bot)
+    # connection setup is done before the first chat, not during it
+    warming = asyncio.create_task(provider.warm_up(context.config.endpoints))
     print("CatGPT is running...")
-    await bot.infinity_polling(interval=1)
+    try:
+        await bot.infinity_polling(interval=1)
+    finally:
+        warming.cancel()
+        await context.titles.close()
+        await provider.close()
+        await context.gateway.close()
+        if context.write_behind is not None:
+            await context.write_behind.close()
+        storage.datasource.close()
 
 
 def launch():
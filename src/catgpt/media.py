@@ -0,0 +1,45 @@
+import hashlib
+
+from .storage import types
+from .storage.types import MEDIA_SCHEME
+
+
+def is_media_ref(media_url: str | None) -> bool:
+    return media_url is not None and media_url.startswith(MEDIA_SCHEME)
+
+
+class MediaStore:
+    """content addressed store for binary media referenced by messages"""
+
+    def __init__(self, storage: types.MediaStorage):
+        self.storage = storage
+
+    async def save(self, data: bytes, mime_type: str = "image/jpeg") -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        media = types.Media(hash=digest, mime_type=mime_type, size=len(data), data=data)
+        await self.storage.save_media(media)
+
+        return f"{MEDIA_SCHEME}{digest}"
+
+    async def load(self, media_ref: str) -> bytes | None:
+        assert is_media_ref(media_ref), "invalid media ref: " + str(media_ref)
+        records = await self.storage.get_media([media_ref[len(MEDIA_SCHEME) :]])
+        if not records:
+            return None
+
+        return records[0].data
+
+    async def resolve(self, messages: list[types.Message]):
+        """load the data of every referenced media that isn't loaded yet"""
+        pending = [
+            m for m in messages if m.media_data is None and is_media_ref(m.media_url)
+        ]
+        if not pending:
+            return
+
+        hashes = list({m.media_url[len(MEDIA_SCHEME) :] for m in pending})
+        mapping = {
+            media.hash: media.data for media in await self.storage.get_media(hashes)
+        }
+        for m in pending:
+            m.media_data = mapping.get(m.media_url[len(MEDIA_SCHEME) :])
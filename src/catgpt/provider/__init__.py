@@ -1,14 +1,20 @@
+import asyncio
 import importlib
 
 from pathlib import Path
 
+from .. import context
+from ..response_cache import CachedStream, make_key
 from ..storage import types
 from ..types import Endpoint
+from .payload import PayloadCache
 
 providers = {
     # Provider.OPENAI: None,
     # Provider.GEMINI: None,
 }
+# converted messages of the recent topics, reused by their next turn
+payloads = PayloadCache()
 
 
 def get_provider(endpoint: Endpoint):
@@ -26,6 +32,23 @@ def get_provider(endpoint: Endpoint):
     return provider
 
 
+async def warm_up(endpoints: list[Endpoint]):
+    """open the connections of the endpoints before the first request"""
+    tasks = []
+    for endpoint in endpoints:
+        provider = get_provider(endpoint)
+        if provider is not None and hasattr(provider, "warm_up"):
+            tasks.append(provider.warm_up(endpoint))
+
+    await asyncio.gather(*tasks)
+
+
+async def close():
+    for provider in providers.values():
+        if hasattr(provider, "close"):
+            await provider.close()
+
+
 def message2payload(endpoint: Endpoint, messages: list[types.Message]) -> list:
     provider = get_provider(endpoint)
     if provider is None:
@@ -34,7 +57,17 @@ def message2payload(endpoint: Endpoint, messages: list[types.Message]) -> list:
     return provider.message2payload(messages)
 
 
-async def ask_stream(endpoint: Endpoint, body: dict):
+async def load_media(messages: list[types.Message]):
+    """media is stored by reference, load it right before building a payload"""
+    if context.media is not None:
+        await context.media.resolve(messages)
+
+
+async def build_payload(endpoint: Endpoint, body: dict) -> list:
+    """
+    the provider payload of body["messages"]. With a body["topic_id"] only
+    the messages new to the topic are converted and have their media loaded.
+    """
     provider = get_provider(endpoint)
     if provider is None:
         raise Exception("Provider not supported")
@@ -43,16 +76,58 @@ async def ask_stream(endpoint: Endpoint, body: dict):
     if not messages:
         raise Exception("No messages")
 
-    return provider.ask_stream(endpoint, body)
+    topic_id = body.get("topic_id")
+    if topic_id is None:
+        await load_media(messages)
+        return provider.message2payload(messages)
 
+    name = endpoint.provider.value
+    await load_media(payloads.get_missing(name, topic_id, messages))
+    return payloads.build(provider, name, topic_id, messages)
 
-async def ask(endpoint: Endpoint, body: dict):
+
+async def get_cached_stream(endpoint: Endpoint, body: dict) -> CachedStream | None:
+    """the cached response of a stream request as a stream, None on a miss"""
+    responses = context.responses
+    if responses is None:
+        return None
+
+    payload = await build_payload(endpoint, body)
+    key = make_key(endpoint, body.get("model"), body, payload, "stream")
+    response = await responses.get(key)
+    if response is None:
+        return None
+
+    return CachedStream(response)
+
+
+async def ask_stream(endpoint: Endpoint, body: dict):
+    """the stream of the endpoint, cached once it's read to the end"""
+    payload = await build_payload(endpoint, body)
     provider = get_provider(endpoint)
-    if provider is None:
-        raise Exception("Provider not supported")
+    responses = context.responses
+    if responses is None:
+        return provider.ask_stream(endpoint, body, payload)
 
-    messages = body.get("messages", [])
-    if not messages:
-        raise Exception("No messages")
+    key = make_key(endpoint, body.get("model"), body, payload, "stream")
+    return responses.record(key, provider.ask_stream(endpoint, body, payload))
 
-    return await provider.ask(endpoint, body)
+
+async def ask(endpoint: Endpoint, body: dict):
+    payload = await build_payload(endpoint, body)
+    responses = context.responses
+    if responses is None:
+        return await get_provider(endpoint).ask(endpoint, body, payload)
+
+    key = make_key(endpoint, body.get("model"), body, payload, "ask")
+    response = await responses.get(key)
+    if response is not None:
+        return response.content
+
+    content = await get_provider(endpoint).ask(endpoint, body, payload)
+    try:
+        await responses.put(key, content or "")
+    except Exception as e:
+        print(f"failed to cache a response: {e!r}")
+
+    return content
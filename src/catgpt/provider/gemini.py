@@ -1,11 +1,16 @@
+import asyncio
+
 import google.generativeai as genai
 from google.generativeai.client import _ClientManager
 
 from ..storage import types
 from ..types import MessageType, Endpoint
 from ..utils import tg_image
+from ..media import is_media_ref
 
 _client_manager_cache = {}
+# (endpoint name, model name, generation config) -> GenerativeModel
+_model_cache = {}
 generation_config = {
     "temperature": 0.7,
     "top_p": 1,
@@ -21,23 +26,38 @@ safety_settings = [
 ]
 
 
-def message2payload(messages: list[types.Message]) -> list:
-    contents = []
-    for m in messages:
-        role = "model" if m.role == "assistant" else "user"
-        parts = []
+def convert_message(m: types.Message) -> tuple[dict | None, int]:
+    """the contents entry of a message and its approximate size"""
+    role = "model" if m.role == "assistant" else "user"
+    parts = []
+    size = 0
 
-        if m.message_type == MessageType.PHOTO.value and m.media_url:
+    if m.message_type == MessageType.PHOTO.value and m.media_url:
+        bin_data = m.media_data
+        if bin_data is None and not is_media_ref(m.media_url):
+            # legacy rows keep base64 data inline
             bin_data = tg_image.decode_image(m.media_url)
+
+        if bin_data is None:
+            # the media row is gone, the message is sent without its image
+            print(f"message {m.message_id}: {m.media_url} not found, image dropped")
+        else:
             parts.append({"mime_type": "image/jpeg", "data": bin_data})
+            size += len(bin_data)
+
+    if m.content:
+        parts.append({"text": m.content})
+        size += len(m.content)
 
-        if m.content:
-            parts.append({"text": m.content})
+    if len(parts) == 0:
+        return None, 0
 
-        if len(parts) > 0:
-            contents.append({"role": role, "parts": parts})
+    return {"role": role, "parts": parts}, size
 
-    return contents
+
+def message2payload(messages: list[types.Message]) -> list:
+    contents = [convert_message(m)[0] for m in messages]
+    return [entry for entry in contents if entry is not None]
 
 
 def get_model(endpoint: Endpoint, body: dict):
@@ -48,22 +68,31 @@ def get_model(endpoint: Endpoint, body: dict):
         _client_manager.configure(api_key=endpoint.secret_key)
         _client_manager_cache[endpoint.name] = _client_manager
 
-    model = genai.GenerativeModel(
-        model_name=body.get("model") or "gemini-1.5-flash",
-        generation_config=generation_config,
-        safety_settings=safety_settings,
-    )
-    model._async_client = _client_manager.get_default_client("generative_async")
+    model_name = body.get("model") or "gemini-1.5-flash"
+    key = (endpoint.name, model_name, tuple(sorted(generation_config.items())))
+    model = _model_cache.get(key)
+    if model is None:
+        model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+        )
+        model._async_client = _client_manager.get_default_client("generative_async")
+        _model_cache[key] = model
 
     return model
 
 
-async def do_ask(endpoint: Endpoint, body: dict, stream=True):
+async def do_ask(endpoint: Endpoint, body: dict, contents: list, stream=True):
     model = get_model(endpoint, body)
-    contents = message2payload(body.get("messages", []))
-    async for chunk in await model.generate_content_async(
-        contents=contents, stream=stream
-    ):
+    request = model.generate_content_async(contents=contents, stream=stream)
+    if stream:
+        # the stream opens once the endpoint accepted the request
+        response = await asyncio.wait_for(request, endpoint.get_connect_timeout())
+    else:
+        response = await request
+
+    async for chunk in response:
         if not chunk.candidates:
             continue
 
@@ -78,13 +107,13 @@ async def do_ask(endpoint: Endpoint, body: dict, stream=True):
     yield {"finished": True, "role": "assistant", "content": ""}
 
 
-async def ask_stream(endpoint: Endpoint, body: dict):
-    async for chunk in do_ask(endpoint, body, stream=True):
+async def ask_stream(endpoint: Endpoint, body: dict, contents: list):
+    async for chunk in do_ask(endpoint, body, contents, stream=True):
         yield chunk
 
 
-async def ask(endpoint: Endpoint, body: dict):
-    async for chunk in do_ask(endpoint, body, stream=False):
+async def ask(endpoint: Endpoint, body: dict, contents: list):
+    async for chunk in do_ask(endpoint, body, contents, stream=False):
         return chunk.get("content", "")
 
     return ""
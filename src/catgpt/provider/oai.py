@@ -1,9 +1,70 @@
+import importlib.util
+
+import httpx
+
 from openai import AsyncOpenAI
 
 from ..storage import types
 from ..context import Endpoint
 from ..utils.prompt import get_system_prompt
+from ..utils import tg_image
 from ..types import MessageType
+from ..media import is_media_ref
+
+# endpoint name -> AsyncOpenAI, shared by all requests to the endpoint
+_clients: dict[str, AsyncOpenAI] = {}
+_http_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def get_client(endpoint: Endpoint) -> AsyncOpenAI:
+    client = _clients.get(endpoint.name)
+    if client is not None:
+        return client
+
+    options = endpoint.http
+    http2 = options.get("http2", False)
+    if http2 and importlib.util.find_spec("h2") is None:
+        print(f"{endpoint.name}: http2 needs the h2 package, using HTTP/1.1")
+        http2 = False
+
+    timeout = httpx.Timeout(
+        options.get("timeout", 600), connect=endpoint.get_connect_timeout()
+    )
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=options.get("max_connections", 100),
+            max_keepalive_connections=options.get("max_keepalive_connections", 20),
+            keepalive_expiry=options.get("keepalive_expiry", 60),
+        ),
+        timeout=timeout,
+        http2=http2,
+    )
+    client = AsyncOpenAI(
+        base_url=endpoint.api_url,
+        api_key=endpoint.secret_key,
+        timeout=timeout,
+        http_client=http_client,
+    )
+    _clients[endpoint.name] = client
+    _http_clients[endpoint.name] = http_client
+    return client
+
+
+async def warm_up(endpoint: Endpoint):
+    """open a connection to the endpoint, it's kept alive in the pool"""
+    client = get_client(endpoint)
+    try:
+        await _http_clients[endpoint.name].head(str(client.base_url))
+    except httpx.HTTPError as e:
+        print(f"failed to warm up {endpoint.name}: {e!r}")
+
+
+async def close():
+    clients = list(_clients.values())
+    _clients.clear()
+    _http_clients.clear()
+    for client in clients:
+        await client.close()
 
 
 def inject_system_prompt_if_need(messages: list, model: str):
@@ -15,39 +76,42 @@ def inject_system_prompt_if_need(messages: list, model: str):
         messages.insert(0, {"role": "system", "content": prompt})
 
 
+def convert_message(m: types.Message) -> tuple[dict | None, int]:
+    """the payload entry of a message and its approximate size"""
+    if m.message_type in [MessageType.TEXT.value, MessageType.DOCUMENT.value]:
+        return {"role": m.role, "content": m.content}, len(m.content or "")
+
+    if is_media_ref(m.media_url) and m.media_data is None:
+        # the media row is gone, the message is sent without its image
+        print(f"message {m.message_id}: {m.media_url} not found, image dropped")
+        if not m.content:
+            return None, 0
+        return {"role": m.role, "content": m.content}, len(m.content)
+
+    content = []
+    is_online = m.media_url.startswith("https://") or m.media_url.startswith("http://")
+    if m.content:
+        content.append({"type": "text", "text": m.content})
+
+    if is_online:
+        url = m.media_url
+    elif m.media_data is not None:
+        url = f"data:image/jpeg;base64,{tg_image.encode_image(m.media_data)}"
+    else:
+        # legacy rows keep base64 data inline
+        url = f"data:image/jpeg;base64,{m.media_url}"
+
+    content.append({"type": "image_url", "image_url": {"url": url}})
+    return {"role": m.role, "content": content}, len(m.content or "") + len(url)
+
+
 def message2payload(messages: [types.Message]) -> list[dict]:
-    messages_payload = []
-    for m in messages:
-        if m.message_type in [MessageType.TEXT.value, MessageType.DOCUMENT.value]:
-            messages_payload.append({"role": m.role, "content": m.content})
-        else:
-            content = []
-            is_online = m.media_url.startswith("https://") or m.media_url.startswith(
-                "http://"
-            )
-            if len(m.content) > 0:
-                content.append({"type": "text", "text": m.content})
-
-            content.append(
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": (
-                            m.media_url
-                            if is_online
-                            else f"data:image/jpeg;base64,{m.media_url}"
-                        )
-                    },
-                }
-            )
-            messages_payload.append({"role": m.role, "content": content})
-
-    return messages_payload
-
-
-async def ask_stream(endpoint: Endpoint, body: dict):
-    client = AsyncOpenAI(base_url=endpoint.api_url, api_key=endpoint.secret_key)
-    messages = message2payload(body.get("messages", []))
+    entries = [convert_message(m)[0] for m in messages]
+    return [entry for entry in entries if entry is not None]
+
+
+async def ask_stream(endpoint: Endpoint, body: dict, messages: list[dict]):
+    client = get_client(endpoint)
     response = await client.chat.completions.create(
         model=body.get("model"),
         messages=messages,
@@ -67,7 +131,7 @@ async def ask_stream(endpoint: Endpoint, body: dict):
         # compatible with Deepseek
         if hasattr(choice.delta, "reasoning_content"):
             reasoning = choice.delta.reasoning_content
-        
+
         # compatible with OpenRouter
         if hasattr(choice.delta, "reasoning"):
             reasoning = choice.delta.reasoning
@@ -85,9 +149,8 @@ async def ask_stream(endpoint: Endpoint, body: dict):
         }
 
 
-async def ask(endpoint: Endpoint, body: dict):
-    client = AsyncOpenAI(base_url=endpoint.api_url, api_key=endpoint.secret_key)
-    messages = message2payload(body.get("messages", []))
+async def ask(endpoint: Endpoint, body: dict, messages: list[dict]):
+    client = get_client(endpoint)
 
     response = await client.chat.completions.create(
         model=endpoint.default_model or "gpt-3.5-turbo",
@@ -0,0 +1,105 @@
+from ..storage import types
+from ..utils.cache import LRUCache
+
+
+def message_key(m: types.Message) -> tuple:
+    """everything the converted entry of a message is made of"""
+    return m.message_id, m.role, m.message_type, m.media_url, m.content
+
+
+class TopicPayload:
+    """the converted messages of a topic for one provider"""
+
+    def __init__(self, provider_name: str):
+        self.provider_name = provider_name
+        # message key -> (entry, size), entry is None if the message converts to nothing
+        self.entries: dict[tuple, tuple[dict | None, int]] = {}
+        self.size = 0
+
+
+class PayloadCache:
+    """
+    The provider payload of recently used topics. A turn converts only the
+    messages that weren't sent before, the entries of the earlier ones are
+    reused. Messages left out of a payload, e.g. by the context window, are
+    dropped from the cache with it.
+    """
+
+    def __init__(self, max_topics: int = 1024, max_bytes: int = 64 * 1024 * 1024):
+        # topic id -> TopicPayload
+        self.topics = LRUCache(max_size=max_topics, max_bytes=max_bytes)
+        self.turns = 0
+        self.converted = 0
+        self.reused = 0
+        # approximate bytes of the entries converted
+        self.converted_bytes = 0
+
+    def _get(self, provider_name: str, topic_id: int) -> TopicPayload:
+        payload = self.topics.get(topic_id)
+        if payload is None or payload.provider_name != provider_name:
+            payload = TopicPayload(provider_name)
+
+        return payload
+
+    def get_missing(
+        self, provider_name: str, topic_id: int, messages: list[types.Message]
+    ) -> list[types.Message]:
+        """the messages without a cached entry"""
+        payload = self.topics.peek(topic_id)
+        if payload is None or payload.provider_name != provider_name:
+            return messages
+
+        return [m for m in messages if message_key(m) not in payload.entries]
+
+    def build(
+        self, provider, provider_name: str, topic_id: int, messages: list[types.Message]
+    ) -> list:
+        """the payload of messages, provider.convert_message converts the new ones"""
+        payload = self._get(provider_name, topic_id)
+        entries = payload.entries
+        result = []
+        used = {}
+        reused = 0
+        for m in messages:
+            key = message_key(m)
+            converted = entries.get(key)
+            if converted is None:
+                converted = provider.convert_message(m)
+                payload.size += converted[1]
+                self.converted += 1
+                self.converted_bytes += converted[1]
+            else:
+                reused += 1
+
+            used[key] = converted
+            if converted[0] is not None:
+                result.append(converted[0])
+
+        if reused < len(entries):
+            # a revoked or left out message, keep only the entries in use
+            payload.entries = used
+            payload.size = sum(size for _, size in used.values())
+        else:
+            entries.update(used)
+
+        self.reused += reused
+        self.turns += 1
+        self.topics.put(topic_id, payload, payload.size)
+        return result
+
+    def invalidate(self, topic_id: int):
+        self.topics.invalidate(topic_id)
+
+    def get_metrics(self) -> dict:
+        metrics = self.topics.get_metrics()
+        metrics.update(
+            {
+                "turns": self.turns,
+                "converted": self.converted,
+                "reused": self.reused,
+                "converted_bytes_per_turn": (
+                    self.converted_bytes / self.turns if self.turns else 0.0
+                ),
+            }
+        )
+        return metrics
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import time
+
+from .storage import types
+from .types import Endpoint
+
+# options of a request body that change the response
+BODY_OPTIONS = ("temperature", "top_p", "presence_penalty", "frequency_penalty")
+
+
+def _encode(o):
+    if isinstance(o, bytes):
+        return hashlib.sha256(o).hexdigest()
+
+    raise TypeError(f"{type(o).__name__} is not serializable")
+
+
+def make_key(endpoint: Endpoint, model: str, body: dict, payload: list, kind: str):
+    """the hash of a request, the same for requests with the same payload"""
+    # a request without a model is answered by the default one
+    model = model or endpoint.default_model
+    options = {name: body[name] for name in BODY_OPTIONS if name in body}
+    data = json.dumps(
+        [kind, endpoint.name, model, options, payload],
+        sort_keys=True,
+        ensure_ascii=False,
+        default=_encode,
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class CachedStream:
+    """replays a cached response as the stream of a provider"""
+
+    cached = True
+
+    def __init__(self, response: types.CachedResponse):
+        chunks = []
+        if response.reasoning:
+            chunks.append(
+                {
+                    "role": "assistant",
+                    "content": response.reasoning,
+                    "finished": None,
+                    "reasoning": True,
+                }
+            )
+        chunks.append(
+            {
+                "role": "assistant",
+                "content": response.content,
+                "finished": "stop",
+                "reasoning": False,
+            }
+        )
+        self.chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def aclose(self):
+        self.chunks = iter(())
+
+
+class ResponseCache:
+    """
+    Responses of the recent requests, keyed by make_key. Only a response
+    read to the end is cached. Responses older than `ttl` seconds are
+    stale, every `evict_every` responses stored the stale ones are deleted
+    along with the oldest ones over `max_entries` or `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        storage: types.ResponseCacheStorage,
+        ttl: int = 3600,
+        max_entries: int = 10000,
+        max_bytes: int = 64 * 1024 * 1024,
+        evict_every: int = 100,
+    ):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    async def get(self, key: str) -> types.CachedResponse | None:
+        response = await self.storage.get_response(key)
+        if response is None or response.created_at < int(time.time()) - self.ttl:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return response
+
+    async def put(self, key: str, content: str, reasoning: str = ""):
+        if not content:
+            return
+
+        size = len(content.encode("utf-8")) + len(reasoning.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        response = types.CachedResponse(key, content, reasoning, size, int(time.time()))
+        await self.storage.save_response(response)
+        self.stored += 1
+        if self.stored % self.evict_every == 0:
+            await self.evict()
+
+    async def evict(self):
+        self.evicted += await self.storage.evict_responses(
+            int(time.time()) - self.ttl, self.max_entries, self.max_bytes
+        )
+
+    async def record(self, key: str, stream):
+        """relay a provider stream and cache the response once it's complete"""
+        content = ""
+        reasoning = ""
+        async for chunk in stream:
+            if chunk.get("reasoning"):
+                reasoning += chunk["content"] or ""
+            else:
+                content += chunk["content"] or ""
+            yield chunk
+
+        try:
+            await self.put(key, content, reasoning)
+        except Exception as e:
+            print(f"failed to cache a response: {e!r}")
+
+    def get_metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stored": self.stored,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,335 @@
+import asyncio
+import statistics
+import time
+
+from collections import deque
+
+from .gateway import percentile
+from .limiter import ConcurrencyLimiter, EndpointBusy
+from . import provider
+from .timing import TurnTimer
+from .types import Configuration, Endpoint
+
+# ends an answer cut off by a stalled stream
+STALL_MARKER = "\n\n_(the response stalled and was cut off)_"
+
+
+class EndpointStats:
+    """rolling time to first token and outcomes of the requests to an endpoint"""
+
+    def __init__(self, window: int):
+        self.ttft = deque(maxlen=window)
+        # True for a request that finished, False for a failed one
+        self.outcomes = deque(maxlen=window)
+        self.requests = 0
+        self.failovers = 0
+        self.first_token_timeouts = 0
+        self.retries = 0
+        self.stalls = 0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        # time to first token of chat turns, from when the message was picked up
+        self.turn_ttft = deque(maxlen=window)
+        # stage name -> its recent durations
+        self.stages: dict[str, deque] = {}
+
+    def is_healthy(self, now: float) -> bool:
+        return now >= self.down_until
+
+    def get_error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def get_latency(self) -> float:
+        """the expected time to first token, 0 if nothing was measured yet"""
+        return statistics.median(self.ttft) if self.ttft else 0.0
+
+    def to_dict(self, now: float) -> dict:
+        ttft = list(self.ttft)
+        return {
+            "healthy": self.is_healthy(now),
+            "requests": self.requests,
+            "failovers": self.failovers,
+            "first_token_timeouts": self.first_token_timeouts,
+            "retries": self.retries,
+            "stalls": self.stalls,
+            "error_rate": self.get_error_rate(),
+            "ttft_p50_ms": percentile(ttft, 50) * 1000,
+            "ttft_p95_ms": percentile(ttft, 95) * 1000,
+            "turn_ttft_p50_ms": percentile(list(self.turn_ttft), 50) * 1000,
+            "turn_ttft_p99_ms": percentile(list(self.turn_ttft), 99) * 1000,
+            "stages": {
+                name: {
+                    "p50_ms": percentile(list(durations), 50) * 1000,
+                    "p99_ms": percentile(list(durations), 99) * 1000,
+                }
+                for name, durations in self.stages.items()
+            },
+        }
+
+
+class RoutedStream:
+    """
+    the stream of the endpoint that sent the first token, it holds a slot of
+    the endpoint until it's read to the end or closed. A response replayed
+    from the cache holds none.
+    """
+
+    def __init__(self, router: "Router", endpoint: Endpoint, first: dict, stream):
+        self.router = router
+        self.endpoint = endpoint
+        self.first = first
+        self.stream = stream
+        self.closed = False
+        # replayed from the response cache, it says nothing about the endpoint
+        self.cached = getattr(stream, "cached", False)
+
+    def __aiter__(self):
+        return self._relay()
+
+    async def _relay(self):
+        stall_timeout = self.router.get_timeouts(self.endpoint)[1]
+        try:
+            yield self.first
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        self.stream.__anext__(), stall_timeout
+                    )
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    # keep the partial answer, the endpoint won't finish it
+                    self.router.record_stall(self.endpoint)
+                    yield {
+                        "role": "assistant",
+                        "content": STALL_MARKER,
+                        "finished": "stall",
+                        "reasoning": False,
+                    }
+                    return
+
+                yield chunk
+        except Exception:
+            self.router.record_failure(self.endpoint)
+            raise
+        finally:
+            await self.aclose()
+
+        if not self.cached:
+            self.router.record_success(self.endpoint)
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            if not self.cached:
+                self.router.get_limiter(self.endpoint).release()
+            await self.stream.aclose()
+
+
+class Router:
+    """
+    Sends a chat request to the fastest healthy endpoint serving its model.
+    Endpoints are ranked by the median time to first token of their recent
+    requests. If an endpoint fails or doesn't send the first token within
+    `first_token_timeout`, the request goes to the next one, an endpoint
+    that timed out is tried again up to `retries` times after the others. A
+    stream that sends nothing for `stall_timeout` seconds is cut off. After
+    `max_failures` failures in a row an endpoint is skipped for `cooldown`
+    seconds. Every endpoint has a ConcurrencyLimiter, a request waits for a
+    slot of the best candidate only if none of them has a free one.
+    """
+
+    def __init__(
+        self,
+        config: Configuration,
+        enabled: bool = True,
+        first_token_timeout: float = 60,
+        stall_timeout: float = 120,
+        retries: int = 1,
+        max_failures: int = 3,
+        cooldown: float = 30,
+        window: int = 50,
+    ):
+        self.config = config
+        self.enabled = enabled
+        self.first_token_timeout = first_token_timeout
+        self.stall_timeout = stall_timeout
+        self.retries = retries
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.window = window
+        # endpoint name -> EndpointStats
+        self.stats: dict[str, EndpointStats] = {}
+        # endpoint name -> ConcurrencyLimiter
+        self.limiters: dict[str, ConcurrencyLimiter] = {}
+
+    def get_stats(self, endpoint: Endpoint) -> EndpointStats:
+        stats = self.stats.get(endpoint.name)
+        if stats is None:
+            stats = EndpointStats(self.window)
+            self.stats[endpoint.name] = stats
+
+        return stats
+
+    def get_limiter(self, endpoint: Endpoint) -> ConcurrencyLimiter:
+        limiter = self.limiters.get(endpoint.name)
+        if limiter is None:
+            limits = endpoint.limits
+            limiter = ConcurrencyLimiter(
+                max_concurrency=limits.get("max_concurrency", 16),
+                max_queue=limits.get("max_queue", 64),
+                max_wait=limits.get("max_wait", 60),
+            )
+            self.limiters[endpoint.name] = limiter
+
+        return limiter
+
+    def get_timeouts(self, endpoint: Endpoint) -> tuple[float, float, int]:
+        """first token timeout, stall timeout and retries of an endpoint"""
+        timeouts = endpoint.timeouts
+        return (
+            timeouts.get("first_token", self.first_token_timeout),
+            timeouts.get("stall", self.stall_timeout),
+            timeouts.get("retries", self.retries),
+        )
+
+    def get_candidates(self, endpoint: Endpoint, model: str) -> list[Endpoint]:
+        """the endpoints to try in order, healthy ones first and fastest first"""
+        if not self.enabled:
+            return [endpoint]
+
+        candidates = [endpoint] + [
+            e
+            for e in self.config.get_endpoints()
+            if e is not endpoint and model in e.models
+        ]
+        now = time.monotonic()
+
+        # sort is stable, the selected endpoint wins a tie
+        def rank(e: Endpoint):
+            stats = self.get_stats(e)
+            return not stats.is_healthy(now), stats.get_latency()
+
+        return sorted(candidates, key=rank)
+
+    def record_first_token(self, endpoint: Endpoint, ttft: float):
+        self.get_stats(endpoint).ttft.append(ttft)
+
+    def record_success(self, endpoint: Endpoint):
+        stats = self.get_stats(endpoint)
+        stats.outcomes.append(True)
+        stats.consecutive_failures = 0
+        stats.down_until = 0.0
+
+    def record_stall(self, endpoint: Endpoint):
+        self.get_stats(endpoint).stalls += 1
+        self.record_failure(endpoint)
+
+    def record_failure(self, endpoint: Endpoint):
+        stats = self.get_stats(endpoint)
+        stats.outcomes.append(False)
+        stats.consecutive_failures += 1
+        if stats.consecutive_failures >= self.max_failures:
+            stats.down_until = time.monotonic() + self.cooldown
+
+    async def _acquire(self, candidates: list[Endpoint], uid: int) -> Endpoint:
+        """
+        the first healthy candidate with a free slot, otherwise a slot of the
+        first one whose queue isn't full. Raises EndpointBusy if all are full.
+        """
+        now = time.monotonic()
+        healthy = [c for c in candidates if self.get_stats(c).is_healthy(now)]
+        for candidate in healthy or candidates:
+            if self.get_limiter(candidate).try_acquire():
+                return candidate
+
+        for candidate in candidates:
+            limiter = self.get_limiter(candidate)
+            if not limiter.is_full():
+                await limiter.acquire(uid)
+                return candidate
+
+        self.get_limiter(candidates[0]).rejected += 1
+        raise EndpointBusy("busy, please try again later")
+
+    def record_turn(self, endpoint: Endpoint, timer: TurnTimer):
+        """the stages and the time to first token of a chat turn"""
+        stats = self.get_stats(endpoint)
+        stats.turn_ttft.append(timer.elapsed())
+        for name, seconds in timer.stages.items():
+            stats.stages.setdefault(name, deque(maxlen=self.window)).append(seconds)
+
+    async def open_stream(
+        self, endpoint: Endpoint, model: str, body: dict, uid: int = 0
+    ):
+        """
+        the endpoint that sent the first token and its stream, the stream
+        holds a slot of the endpoint until it's closed. A response cached for
+        the best candidate is replayed first. Raises the error of the last
+        endpoint tried if none of them did.
+        """
+        body = dict(body, model=model)
+        candidates = self.get_candidates(endpoint, model)
+        # a cached response doesn't wait for or take a slot of the endpoint
+        cached = await provider.get_cached_stream(candidates[0], body)
+        if cached is not None:
+            first = await cached.__anext__()
+            return candidates[0], RoutedStream(self, candidates[0], first, cached)
+
+        # endpoint name -> times it was tried
+        attempts: dict[str, int] = {}
+        error = None
+        while candidates:
+            candidate = await self._acquire(candidates, uid)
+            candidates.remove(candidate)
+            attempts[candidate.name] = attempts.get(candidate.name, 0) + 1
+            first_token_timeout, _, retries = self.get_timeouts(candidate)
+            stats = self.get_stats(candidate)
+            stats.requests += 1
+            start = time.monotonic()
+            stream = None
+            try:
+                stream = await provider.ask_stream(candidate, body)
+                first = await asyncio.wait_for(stream.__anext__(), first_token_timeout)
+            except StopAsyncIteration:
+                first = {"role": "assistant", "content": "", "finished": True}
+            except asyncio.CancelledError:
+                self.get_limiter(candidate).release()
+                if stream is not None:
+                    await stream.aclose()
+                raise
+            except Exception as e:
+                print(f"endpoint {candidate.name} failed: {e!r}")
+                self.record_failure(candidate)
+                self.get_limiter(candidate).release()
+                timed_out = isinstance(e, asyncio.TimeoutError)
+                if timed_out:
+                    stats.first_token_timeouts += 1
+                if timed_out and attempts[candidate.name] <= retries:
+                    # tried again once the other candidates had their turn
+                    stats.retries += 1
+                    candidates.append(candidate)
+                elif candidates:
+                    stats.failovers += 1
+                if stream is not None:
+                    await stream.aclose()
+                error = e
+                continue
+
+            self.record_first_token(candidate, time.monotonic() - start)
+            return candidate, RoutedStream(self, candidate, first, stream)
+
+        raise error
+
+    def get_metrics(self) -> dict:
+        now = time.monotonic()
+        metrics = {}
+        for name, stats in sorted(self.stats.items()):
+            metrics[name] = stats.to_dict(now)
+            if name in self.limiters:
+                metrics[name].update(self.limiters[name].get_metrics())
+
+        return metrics
@@ -12,5 +12,15 @@ class Datasource(ABC):
     async def get_read_conn(self):
         pass
 
+    def get_executor(self, tx_type: str):
+        """executor used to run statements, None runs them on the event loop"""
+        return None
+
+    def get_metrics(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
 
 datasource: Datasource | None = None
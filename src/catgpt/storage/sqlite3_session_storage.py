@@ -1,12 +1,48 @@
 import asyncio
+import base64
+import binascii
+import hashlib
 import sqlite3
 import os
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from ..storage import Datasource, tx, Topic
 from ..storage import types
 
+
+def migrate_inline_media(cursor):
+    """move base64 photos stored inline in message.content to the media table"""
+    sql = "select rowid, content from message where message_type not in (0, 5)"
+    rows = cursor.execute(sql).fetchall()
+    for rowid, content in rows:
+        segments = (content or "").split(",", 1)
+        media_url = segments[0]
+        if not media_url or media_url.startswith(
+            ("http://", "https://", types.MEDIA_SCHEME)
+        ):
+            continue
+
+        try:
+            data = base64.b64decode(media_url, validate=True)
+        except (binascii.Error, ValueError):
+            print(f"skip message {rowid}, invalid inline media")
+            continue
+
+        digest = hashlib.sha256(data).hexdigest()
+        cursor.execute(
+            "insert or ignore into media (hash, mime_type, size, data) values (?,?,?,?)",
+            (digest, "image/jpeg", len(data), data),
+        )
+        caption = segments[1] if len(segments) > 1 else ""
+        cursor.execute(
+            "update message set content = ? where rowid = ?",
+            (f"{types.MEDIA_SCHEME}{digest},{caption}", rowid),
+        )
+
+
 VERSION = [
     {"version_name": "0.1.0", "version_code": 2406252010, "sql_list": []},
     {
@@ -22,8 +58,36 @@ VERSION = [
         "version_code": 2407080300,
         "sql_list": [],
     },
+    {
+        "version_name": "0.1.3",
+        "version_code": 2610181200,
+        "sql_list": [
+            "create table if not exists media (hash TEXT PRIMARY KEY, mime_type TEXT, size INTEGER, data BLOB);",
+        ],
+        "migrate": migrate_inline_media,
+    },
+    {
+        "version_name": "0.1.4",
+        "version_code": 2610181300,
+        "sql_list": [
+            "alter table message add tokens INTEGER default 0 not null;",
+        ],
+    },
+    {
+        "version_name": "0.1.5",
+        "version_code": 2610181400,
+        "sql_list": [
+            "create table if not exists response_cache (key TEXT PRIMARY KEY, content TEXT, reasoning TEXT, size INTEGER default 0 not null, created_at INTEGER default 0 not null);",
+            "create index if not exists idx_rc_created_at on response_cache (created_at);",
+        ],
+    },
 ]
 
+# columns in the order of types.Message's constructor
+MESSAGE_COLUMNS = (
+    "role, content, message_id, chat_id, topic_id, ts, message_type, tokens"
+)
+
 CURRENT_VERSION = VERSION[-1]["version_name"]
 VERSION_CODE = VERSION[-1]["version_code"]
 
@@ -45,6 +109,9 @@ def migrate(connection):
             for sql in sqlite_list:
                 cursor.execute(sql)
 
+            if "migrate" in version:
+                version["migrate"](cursor)
+
             latest_version = version
 
         if latest_version:
@@ -62,34 +129,96 @@ def migrate(connection):
 
 
 class ConnectionProxy:
-    def __init__(self, connection, datasource):
+    def __init__(self, connection, datasource, conn_type="read"):
         self._connection = connection
         self.datasource = datasource
+        self.conn_type = conn_type
+        self.released = False
+
+    def close(self):
+        # connections are owned by the pool, closing a proxy hands it back
+        if self.released:
+            return
+
+        self.released = True
+        self.datasource.release(self._connection, self.conn_type)
 
     def __getattr__(self, name):
-        attr = getattr(self._connection, name)
-        if callable(attr):
-
-            def wrapper(*args, **kwargs):
-                result = None
-                try:
-                    result = attr(*args, **kwargs)
-                finally:
-                    if name == "close":
-                        self.datasource.release()
-                return result
-
-            return wrapper
-        else:
-            return attr
+        return getattr(self._connection, name)
+
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+    "temp_store": "memory",
+}
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.reconnected = 0
+
+    def record(self, wait_time: float, waited: bool):
+        self.acquired += 1
+        self.wait_time += wait_time
+        if waited:
+            self.waited += 1
+        if wait_time > self.max_wait_time:
+            self.max_wait_time = wait_time
+
+    def to_dict(self) -> dict:
+        avg = self.wait_time / self.acquired if self.acquired else 0.0
+        return {
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "wait_time": self.wait_time,
+            "avg_wait_time": avg,
+            "max_wait_time": self.max_wait_time,
+            "reconnected": self.reconnected,
+        }
 
 
 class Sqlite3Datasource(Datasource):
-    def __init__(self, db_file: str, schema_file: Path):
+    def __init__(
+        self,
+        db_file: str,
+        schema_file: Path,
+        pool_size: int = 4,
+        pragmas: dict = None,
+        threaded: bool = False,
+    ):
+        assert pool_size > 0, "pool size must be > 0"
+
         self.db_file = db_file
-        self.pool = asyncio.Queue(1)
+        self.pool_size = pool_size
+        self.threaded = threaded
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+
+        self.read_executor = None
+        self.write_executor = None
+        if threaded:
+            # readers share a pool, all writes go through a single thread
+            self.read_executor = ThreadPoolExecutor(
+                max_workers=pool_size, thread_name_prefix="sqlite-read"
+            )
+            self.write_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="sqlite-write"
+            )
+
+        # connecting creates the file, check if it exists before that
+        initialized = os.path.exists(self.db_file)
+        # the writer is opened first and kept for the lifetime of the datasource,
+        # which also keeps shared in-memory databases alive during initialization
+        writer = self._connect()
 
-        if not os.path.exists(self.db_file):
+        if not initialized:
             conn = sqlite3.connect(self.db_file)
             schema_commands = schema_file.read_text(encoding="utf-8")
             conn.executescript(schema_commands)
@@ -102,18 +231,94 @@ class Sqlite3Datasource(Datasource):
 
         migrate(sqlite3.connect(self.db_file))
 
-        self.pool.put_nowait(sqlite3.connect(self.db_file))
+        self.write_pool = asyncio.Queue(1)
+        self.write_pool.put_nowait(writer)
+        self.read_pool = asyncio.Queue(pool_size)
+        self.read_created = 0
+        self.metrics = {"read": PoolMetrics(), "write": PoolMetrics()}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=not self.threaded)
+        for name, value in self.pragmas.items():
+            conn.execute(f"pragma {name}={value};")
+
+        return conn
+
+    def _ensure_alive(self, connection, conn_type: str):
+        try:
+            connection.execute("select 1").fetchone()
+            return connection
+        except sqlite3.Error as e:
+            print(f"discard broken {conn_type} connection: {e}")
+            try:
+                connection.close()
+            except sqlite3.Error:
+                pass
+
+            self.metrics[conn_type].reconnected += 1
+            return self._connect()
 
     async def get_write_conn(self):
-        connection = await self.pool.get()
-        return ConnectionProxy(connection, self)
+        start = time.perf_counter()
+        waited = self.write_pool.empty()
+        connection = await self.write_pool.get()
+        connection = self._ensure_alive(connection, "write")
+        self.metrics["write"].record(time.perf_counter() - start, waited)
+
+        return ConnectionProxy(connection, self, "write")
 
     async def get_read_conn(self):
-        return sqlite3.connect(self.db_file)
+        start = time.perf_counter()
+        waited = False
+        if not self.read_pool.empty():
+            connection = self.read_pool.get_nowait()
+        elif self.read_created < self.pool_size:
+            self.read_created += 1
+            connection = self._connect()
+        else:
+            waited = True
+            connection = await self.read_pool.get()
+
+        connection = self._ensure_alive(connection, "read")
+        self.metrics["read"].record(time.perf_counter() - start, waited)
+
+        return ConnectionProxy(connection, self, "read")
+
+    def release(self, connection, conn_type: str = "write"):
+        if connection.in_transaction:
+            connection.rollback()
+
+        if conn_type == "write":
+            self.write_pool.put_nowait(connection)
+        else:
+            self.read_pool.put_nowait(connection)
 
-    def release(self):
-        if self.pool.empty():
-            self.pool.put_nowait(sqlite3.connect(self.db_file))
+    def get_executor(self, tx_type: str):
+        if tx_type == "write":
+            return self.write_executor
+
+        return self.read_executor
+
+    def get_metrics(self) -> dict:
+        return {
+            "threaded": self.threaded,
+            "pool_size": self.pool_size,
+            "read_created": self.read_created,
+            "read_idle": self.read_pool.qsize(),
+            "read": self.metrics["read"].to_dict(),
+            "write": self.metrics["write"].to_dict(),
+        }
+
+    def close(self):
+        for executor in (self.read_executor, self.write_executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+        for pool in (self.read_pool, self.write_pool):
+            while not pool.empty():
+                pool.get_nowait().close()
+
+        self.read_created = 0
 
 
 class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
@@ -122,10 +327,8 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
     def _decode_message_content(message):
         if message.message_type == 1:
             content = message.content or ""
-            segments = content.split(",")
-            if len(segments) > 1:
-                message.content = segments[1]
-
+            segments = content.split(",", 1)
+            message.content = segments[1] if len(segments) > 1 else ""
             message.media_url = segments[0]
 
     @staticmethod
@@ -136,13 +339,12 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
     @tx.transactional(tx_type="write")
     async def append_message(self, topic_id: int, message: [types.Message]):
         transaction = await self.retrieve_transaction()
-        conn = transaction.connection
         tuples = []
         text_types = [0, 5]  # text, reasoning_content
         for m in message:
             content = m.content
             if m.message_type not in text_types:
-                content = f"{m.media_url},{content}"
+                content = f"{m.media_url},{content or ''}"
 
             t = (
                 m.role,
@@ -152,18 +354,18 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
                 m.ts,
                 topic_id,
                 m.message_type,
+                m.tokens or 0,
             )
             tuples.append(t)
 
         sql = """
-        insert into message (role, content, message_id, chat_id, ts, topic_id, message_type) values (?,?,?,?,?,?,?)
+        insert into message (role, content, message_id, chat_id, ts, topic_id, message_type, tokens) values (?,?,?,?,?,?,?,?)
         """
-        conn.executemany(sql, tuples)
+        await transaction.executemany(sql, tuples)
 
     @tx.transactional(tx_type="write")
     async def save_message_holder(self, message: types.MessageHolder):
         transaction = await self.retrieve_transaction()
-        conn = transaction.connection
 
         content = message.content
         if message.message_type == 1:
@@ -179,17 +381,16 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
             message.message_type,
         )
         sql = "insert into message_holder (content, message_id, user_id, chat_id, topic_id, reply_id, message_type) values (?,?,?,?,?,?,?)"
-        conn.execute(sql, tuples)
+        await transaction.execute(sql, tuples)
 
     @tx.transactional(tx_type="read")
     async def get_message_holder(
         self, uid: int, chat_id: int
     ) -> [types.MessageHolder | None]:
         transaction = await self.retrieve_transaction()
-        conn = transaction.connection
         t = (uid, chat_id)
         sql = "select * from message_holder where user_id = ? and chat_id = ?"
-        row = conn.execute(sql, t).fetchone()
+        row = await transaction.fetchone(sql, t)
         if not row:
             return None
 
@@ -202,7 +403,6 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
     @tx.transactional(tx_type="write")
     async def update_message_holder(self, message: types.MessageHolder):
         transaction = await self.retrieve_transaction()
-        conn = transaction.connection
         content = message.content
         if message.message_type == 1:
             content = f"{message.media_url},{content}"
@@ -218,17 +418,17 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
 
         sql = "update message_holder set content = ?, message_id = ?, topic_id = ?, message_type = ? where user_id = ? and chat_id = ?"
 
-        conn.execute(sql, tuples)
+        await transaction.execute(sql, tuples)
 
     @tx.transactional(tx_type="read")
     async def get_messages(self, topic_ids: list[int]) -> list[types.Message]:
         transaction = await self.retrieve_transaction()
-        conn = transaction.connection
         placeholders = ",".join(["?"] * len(topic_ids))
 
-        records = conn.execute(
-            f"select * from message where topic_id IN ({placeholders})", topic_ids
-        ).fetchall()
+        records = await transaction.fetchall(
+            f"select {MESSAGE_COLUMNS} from message where topic_id IN ({placeholders})",
+            topic_ids,
+        )
         if not records:
             return []
 
@@ -240,11 +440,66 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
 
         return messages
 
+    @tx.transactional(tx_type="read")
+    async def get_last_messages(
+        self, topic_id: int, limit: int, chat_id: int = None
+    ) -> list[types.Message]:
+        t = await self.retrieve_transaction()
+        sql = f"select {MESSAGE_COLUMNS} from message where topic_id = ?"
+        params = [topic_id]
+        if chat_id is not None:
+            sql += " and chat_id = ?"
+            params.append(chat_id)
+
+        sql += " order by rowid desc limit ?"
+        params.append(limit)
+
+        messages = []
+        for r in reversed(await t.fetchall(sql, params)):
+            msg = types.Message(*r)
+            self._decode_message_content(msg)
+            messages.append(msg)
+
+        return messages
+
+    @tx.transactional(tx_type="read")
+    async def get_message_ids(
+        self, topic_id: int, skip_system: bool = True
+    ) -> list[int]:
+        t = await self.retrieve_transaction()
+        sql = "select message_id from message where topic_id = ?"
+        if skip_system:
+            sql += " and role != 'system'"
+
+        records = await t.fetchall(sql, (topic_id,))
+        return [r[0] for r in records]
+
+    @tx.transactional(tx_type="read")
+    async def count_messages(self, topic_ids: list[int]) -> dict[int, int]:
+        t = await self.retrieve_transaction()
+        placeholders = ",".join(["?"] * len(topic_ids))
+        sql = f"select topic_id, count(*) from message where topic_id in ({placeholders}) group by topic_id"
+        records = await t.fetchall(sql, topic_ids)
+
+        counts = {tid: 0 for tid in topic_ids}
+        counts.update({r[0]: r[1] for r in records})
+        return counts
+
+    @tx.transactional(tx_type="write")
+    async def update_tokens(self, topic_id: int, messages: list[types.Message]):
+        t = await self.retrieve_transaction()
+        sql = "update message set tokens = ? where topic_id = ? and message_id = ? and role = ? and message_type = ?"
+        tuples = [
+            (m.tokens, topic_id, m.message_id, m.role, m.message_type) for m in messages
+        ]
+        await t.executemany(sql, tuples)
+
     @tx.transactional(tx_type="read")
     async def get_topic(self, topic_id: int) -> [types.Topic | None]:
         transaction = await self.retrieve_transaction()
-        conn = transaction.connection
-        row = conn.execute("select * from topic where tid = ?", (topic_id,)).fetchone()
+        row = await transaction.fetchone(
+            "select * from topic where tid = ?", (topic_id,)
+        )
         if not row:
             return None
 
@@ -261,7 +516,7 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
             sql += " and thread_id = ?"
             params.append(thread_id)
 
-        records = t.connection.execute(sql, params).fetchall()
+        records = await t.fetchall(sql, params)
         if not records:
             return []
 
@@ -270,7 +525,7 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
     @tx.transactional(tx_type="write")
     async def delete_topic(self, topic_id: int):
         t = await self.retrieve_transaction()
-        t.connection.execute("delete from topic where tid = ?", (topic_id,))
+        await t.execute("delete from topic where tid = ?", (topic_id,))
         # await self.remove_message_by_topic(topic_id)
 
     @tx.transactional(tx_type="write")
@@ -280,12 +535,12 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
         sql = (
             f"delete from message where topic_id = ? and message_id in ({placeholders})"
         )
-        t.connection.execute(sql, (topic_id, *message_ids))
+        await t.execute(sql, (topic_id, *message_ids))
 
     @tx.transactional(tx_type="write")
     async def remove_message_by_topic(self, topic_id: int):
         t = await self.retrieve_transaction()
-        t.connection.execute("delete from message where topic_id = ?", (topic_id,))
+        await t.execute("delete from message where topic_id = ?", (topic_id,))
 
     @tx.transactional(tx_type="write")
     async def create_topic(self, topic: Topic) -> int:
@@ -299,10 +554,7 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
             topic.generate_title,
             topic.thread_id or 0,
         )
-        cursor = t.connection.execute(sql, columns)
-        topic_id = cursor.lastrowid
-
-        return topic_id
+        return await t.execute(sql, columns)
 
     @tx.transactional(tx_type="write")
     async def update_topic(self, topic: Topic):
@@ -317,7 +569,73 @@ class Sqlite3TopicStorage(types.TopicStorage, tx.Transactional):
             topic.thread_id or 0,
             topic.tid,
         )
-        t.connection.execute(sql, columns)
+        await t.execute(sql, columns)
+
+
+PROFILE_COLUMNS = "uid, model, endpoint, prompt, chat_type, chat_id, thread_id, topic_id, preview_url, preview_token"
+TOPIC_COLUMNS = "tid, label, chat_id, user_id, title, generate_title, thread_id"
+
+
+def _prefix_columns(prefix: str, columns: str) -> str:
+    return ", ".join(f"{prefix}.{c.strip()}" for c in columns.split(","))
+
+
+def _load_chat_context(connection, uid, chat_id, thread_id, context_budget):
+    """runs every query of a chat context on one connection and thread hop"""
+    sql = f"""
+    select u.uid, u.blocked, {_prefix_columns("p", PROFILE_COLUMNS)}, {_prefix_columns("t", TOPIC_COLUMNS)}
+    from (select ? as uid) k
+    left join users u on u.uid = k.uid
+    left join profile p on p.uid = k.uid and p.chat_id = ? and p.thread_id = ?
+    left join topic t on t.tid = p.topic_id
+    """
+    row = connection.execute(sql, (uid, chat_id, thread_id)).fetchone()
+    user = types.User(*row[0:2]) if row[0] is not None else None
+    profile = types.Profile(*row[2:12]) if row[2] is not None else None
+    topic = types.Topic(*row[12:19]) if row[12] is not None else None
+
+    context = types.ChatContext(user, profile, topic)
+    budget = None
+    if topic is not None and context_budget is not None:
+        budget = context_budget(profile)
+
+    if budget is None:
+        return context
+
+    if budget > 0:
+        # reasoning content is never sent back to a provider, leave it out
+        sql = f"""
+        select {MESSAGE_COLUMNS} from (
+            select {MESSAGE_COLUMNS}, rowid as rid,
+                sum(tokens) over (order by rowid desc) as running
+            from message where topic_id = ? and message_type != 5
+        ) where role = 'system' or running - tokens < ?
+        order by rid
+        """
+        params = (topic.tid, budget)
+    else:
+        sql = f"select {MESSAGE_COLUMNS} from message where topic_id = ? order by rowid"
+        params = (topic.tid,)
+
+    for r in connection.execute(sql, params).fetchall():
+        msg = types.Message(*r)
+        Sqlite3TopicStorage._decode_message_content(msg)
+        topic.messages.append(msg)
+
+    context.has_messages = True
+    return context
+
+
+class Sqlite3ChatContextStorage(types.ChatContextStorage, tx.Transactional):
+
+    @tx.transactional(tx_type="read")
+    async def load_context(
+        self, uid: int, chat_id: int, thread_id: int, context_budget=None
+    ) -> types.ChatContext:
+        t = await self.retrieve_transaction()
+        return await t.run(
+            _load_chat_context, uid, chat_id, thread_id or 0, context_budget
+        )
 
 
 class Sqlite3UserStorage(types.UserStorage, tx.Transactional):
@@ -326,7 +644,7 @@ class Sqlite3UserStorage(types.UserStorage, tx.Transactional):
     async def get_user(self, uid: int) -> [types.User | None]:
         t = await self.retrieve_transaction()
         sql = "select * from users where uid = ?"
-        row = t.connection.execute(sql, (uid,)).fetchone()
+        row = await t.fetchone(sql, (uid,))
         if not row:
             return None
 
@@ -337,8 +655,7 @@ class Sqlite3UserStorage(types.UserStorage, tx.Transactional):
         t = await self.retrieve_transaction()
         sql = "insert into users (uid, blocked) values (?,?)"
         columns = (user.uid, user.blocked)
-        cursor = t.connection.execute(sql, columns)
-        return cursor.lastrowid
+        return await t.execute(sql, columns)
 
 
 class Sqlite3ProfileStorage(types.ProfileStorage, tx.Transactional):
@@ -362,8 +679,7 @@ class Sqlite3ProfileStorage(types.ProfileStorage, tx.Transactional):
         placeholders = "(" + ",".join("?" * len(columns)) + ")"
         sql = f"insert into profile {fields} values {placeholders}"
 
-        cursor = t.connection.execute(sql, columns)
-        return cursor.lastrowid
+        return await t.execute(sql, columns)
 
     @tx.transactional(tx_type="read")
     async def get_profile(
@@ -371,7 +687,7 @@ class Sqlite3ProfileStorage(types.ProfileStorage, tx.Transactional):
     ) -> [types.Profile | None]:
         t = await self.retrieve_transaction()
         sql = "select * from profile where uid = ? and chat_id = ? and thread_id = ?"
-        row = t.connection.execute(sql, (uid, chat_id, thread_id or 0)).fetchone()
+        row = await t.fetchone(sql, (uid, chat_id, thread_id or 0))
         if not row:
             return None
 
@@ -384,7 +700,7 @@ class Sqlite3ProfileStorage(types.ProfileStorage, tx.Transactional):
 
         t = await self.retrieve_transaction()
         sql = f"select {field} from profile where uid = ?"
-        row = t.connection.execute(sql, (uid,)).fetchone()
+        row = await t.fetchone(sql, (uid,))
         if not row:
             return 0
 
@@ -396,7 +712,7 @@ class Sqlite3ProfileStorage(types.ProfileStorage, tx.Transactional):
     ):
         t = await self.retrieve_transaction()
         sql = f"update profile set model = ?, endpoint = ?, prompt = ?, topic_id = ?, preview_url = ?, preview_token = ? where uid = ? and chat_id = ? and thread_id = ?"
-        t.connection.execute(
+        await t.execute(
             sql,
             (
                 profile.model,
@@ -418,7 +734,7 @@ class Sqlite3GroupInfoStorage(types.GroupInfoStorage, tx.Transactional):
     async def get_group_info(self, chat_id: int) -> [types.GroupInfo | None]:
         t = await self.retrieve_transaction()
         sql = "select * from group_info where chat_id = ?"
-        row = t.connection.execute(sql, (chat_id,)).fetchone()
+        row = await t.fetchone(sql, (chat_id,))
         if not row:
             return None
 
@@ -429,12 +745,75 @@ class Sqlite3GroupInfoStorage(types.GroupInfoStorage, tx.Transactional):
         t = await self.retrieve_transaction()
         sql = "insert into group_info (chat_id, respond_message) values (?,?)"
         columns = (group_info.chat_id, group_info.respond_message)
-        cursor = t.connection.execute(sql, columns)
-
-        return cursor.lastrowid
+        return await t.execute(sql, columns)
 
     @tx.transactional(tx_type="write")
     async def update_group_info(self, chat_id: int, respond_message: int):
         t = await self.retrieve_transaction()
         sql = f"update group_info set respond_message = ? where chat_id = ?"
-        t.connection.execute(sql, (respond_message, chat_id))
+        await t.execute(sql, (respond_message, chat_id))
+
+
+class Sqlite3MediaStorage(types.MediaStorage, tx.Transactional):
+
+    @tx.transactional(tx_type="write")
+    async def save_media(self, media: types.Media):
+        t = await self.retrieve_transaction()
+        sql = (
+            "insert or ignore into media (hash, mime_type, size, data) values (?,?,?,?)"
+        )
+        columns = (media.hash, media.mime_type, media.size, media.data)
+        await t.execute(sql, columns)
+
+    @tx.transactional(tx_type="read")
+    async def get_media(self, hashes: list[str]) -> list[types.Media]:
+        t = await self.retrieve_transaction()
+        placeholders = ",".join(["?"] * len(hashes))
+        sql = f"select hash, mime_type, size, data from media where hash in ({placeholders})"
+        records = await t.fetchall(sql, hashes)
+
+        return [types.Media(*r) for r in records]
+
+
+class Sqlite3ResponseCacheStorage(types.ResponseCacheStorage, tx.Transactional):
+
+    @tx.transactional(tx_type="read")
+    async def get_response(self, key: str) -> types.CachedResponse | None:
+        t = await self.retrieve_transaction()
+        sql = "select key, content, reasoning, size, created_at from response_cache where key = ?"
+        record = await t.fetchone(sql, (key,))
+
+        return types.CachedResponse(*record) if record else None
+
+    @tx.transactional(tx_type="write")
+    async def save_response(self, response: types.CachedResponse):
+        t = await self.retrieve_transaction()
+        sql = "insert or replace into response_cache (key, content, reasoning, size, created_at) values (?,?,?,?,?)"
+        columns = (
+            response.key,
+            response.content,
+            response.reasoning,
+            response.size,
+            response.created_at,
+        )
+        await t.execute(sql, columns)
+
+    @tx.transactional(tx_type="write")
+    async def evict_responses(
+        self, expire_before: int, max_entries: int, max_bytes: int
+    ) -> int:
+        t = await self.retrieve_transaction()
+        sql = "delete from response_cache where created_at < ?"
+        deleted = await t.executemany(sql, [(expire_before,)])
+
+        # the newest responses that fit within both limits are kept
+        sql = (
+            "delete from response_cache where key in ("
+            "select key from (select key, "
+            "row_number() over (order by created_at desc) as n, "
+            "sum(size) over (order by created_at desc) as total "
+            "from response_cache) where n > ? or total > ?)"
+        )
+        deleted += await t.executemany(sql, [(max_entries, max_bytes)])
+
+        return deleted
@@ -1,3 +1,4 @@
+import asyncio
 import enum
 import os
 
@@ -30,19 +31,54 @@ class Transactional:
 
 
 class Transaction:
-    def __init__(self, connection, tx_type="read"):
+    def __init__(self, connection, tx_type="read", executor=None):
         self.connection = connection
         if DEBUG:
             connection.set_trace_callback(print)
         self.tx_type = tx_type
         self.state = TxState.Init
-
-    def commit(self):
-        self.connection.commit()
+        # when set, every statement runs on this executor instead of the event loop
+        self.executor = executor
+
+    async def run(self, func, *args):
+        """run func(connection, *args) on the transaction's executor"""
+        if self.executor is None:
+            return func(self.connection, *args)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, func, self.connection, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the statement can't be stopped, the connection is rolled back
+            # and released only after the worker thread is done with it
+            while not future.done():
+                try:
+                    await asyncio.wait([future])
+                except asyncio.CancelledError:
+                    pass
+            raise
+
+    async def fetchone(self, sql: str, parameters=()):
+        return await self.run(_fetchone, sql, parameters)
+
+    async def fetchall(self, sql: str, parameters=()) -> list:
+        return await self.run(_fetchall, sql, parameters)
+
+    async def execute(self, sql: str, parameters=()) -> int:
+        """execute a statement and return the lastrowid"""
+        return await self.run(_execute, sql, parameters)
+
+    async def executemany(self, sql: str, seq_of_parameters) -> int:
+        """execute a statement against all parameters and return the rowcount"""
+        return await self.run(_executemany, sql, seq_of_parameters)
+
+    async def commit(self):
+        await self.run(_commit)
         self.state = TxState.Committed
 
-    def rollback(self):
-        self.connection.rollback()
+    async def rollback(self):
+        await self.run(_rollback)
         self.state = TxState.Rollback
 
     def close(self):
@@ -53,6 +89,30 @@ class Transaction:
         return self.state != TxState.Init
 
 
+def _fetchone(connection, sql, parameters):
+    return connection.execute(sql, parameters).fetchone()
+
+
+def _fetchall(connection, sql, parameters):
+    return connection.execute(sql, parameters).fetchall()
+
+
+def _execute(connection, sql, parameters):
+    return connection.execute(sql, parameters).lastrowid
+
+
+def _executemany(connection, sql, seq_of_parameters):
+    return connection.executemany(sql, seq_of_parameters).rowcount
+
+
+def _commit(connection):
+    connection.commit()
+
+
+def _rollback(connection):
+    connection.rollback()
+
+
 context: [Transaction | None] = ContextVar("transaction", default=None)
 
 
@@ -63,12 +123,7 @@ def transactional(tx_type: str = "read"):
             tx = context.get()
             # start = time.time()
             if tx is None:
-                if tx_type == "write":
-                    conn = await storage.datasource.get_write_conn()
-                else:
-                    conn = await storage.datasource.get_read_conn()
-
-                tx = Transaction(conn, tx_type)
+                tx = await new_transaction(tx_type)
                 token = context.set(tx)
 
             if tx_type == "write" and tx.tx_type != tx_type:
@@ -78,12 +133,12 @@ def transactional(tx_type: str = "read"):
                 result = await func(*args, **kwargs)
                 # reenter
                 if token is not None and (not tx.is_end()):
-                    tx.commit()
+                    await tx.commit()
 
                 return result
             except Exception as e:
                 if token is not None and (not tx.is_end()):
-                    tx.rollback()
+                    await tx.rollback()
 
                 print(e)
                 raise e
@@ -104,9 +159,14 @@ async def get_transaction(tx_type: str):
     if tx is not None:
         return tx
 
+    return await new_transaction(tx_type)
+
+
+async def new_transaction(tx_type: str) -> Transaction:
+    datasource = storage.datasource
     if tx_type == "write":
-        conn = await storage.datasource.get_write_conn()
+        conn = await datasource.get_write_conn()
     else:
-        conn = await storage.datasource.get_read_conn()
+        conn = await datasource.get_read_conn()
 
-    return Transaction(conn, tx_type)
+    return Transaction(conn, tx_type, datasource.get_executor(tx_type))
@@ -1,9 +1,20 @@
 from abc import ABC, abstractmethod
 
+# media_url of a message whose data lives in the media store, e.g. media:<sha256>
+MEDIA_SCHEME = "media:"
+
 
 class Message:
     def __init__(
-        self, role, content, message_id, chat_id, topic_id, ts, message_type=0
+        self,
+        role,
+        content,
+        message_id,
+        chat_id,
+        topic_id,
+        ts,
+        message_type=0,
+        tokens=0,
     ):
         self.role = role
         self.content = content
@@ -12,7 +23,11 @@ class Message:
         self.ts = ts
         self.topic_id = topic_id
         self.message_type = message_type
+        # estimated prompt tokens, 0 if not counted yet
+        self.tokens = tokens
         self.media_url = None
+        # binary data of media_url, loaded on demand
+        self.media_data: bytes | None = None
 
     def __repr__(self):
         return (
@@ -115,6 +130,50 @@ class GroupInfo:
         self.respond_message = respond_message
 
 
+class Media:
+    def __init__(self, hash: str, mime_type: str, size: int, data: bytes):
+        self.hash = hash
+        self.mime_type = mime_type
+        self.size = size
+        self.data = data
+
+    def __repr__(self):
+        return f"Media(hash={self.hash}, mime_type={self.mime_type}, size={self.size})"
+
+
+class CachedResponse:
+    def __init__(
+        self, key: str, content: str, reasoning: str, size: int, created_at: int
+    ):
+        self.key = key
+        self.content = content
+        self.reasoning = reasoning
+        self.size = size
+        self.created_at = created_at
+
+    def __repr__(self):
+        return f"CachedResponse(key={self.key}, size={self.size}, created_at={self.created_at})"
+
+
+class ChatContext:
+    """the user, profile and topic a chat handler starts from"""
+
+    def __init__(
+        self,
+        user: User | None,
+        profile: Profile | None,
+        topic: Topic | None,
+        has_messages: bool = False,
+    ):
+        self.user = user
+        self.profile = profile
+        self.topic = topic
+        # whether topic.messages holds the recent messages of the topic
+        self.has_messages = has_messages
+        # seconds it took to load
+        self.load_time = 0.0
+
+
 class TopicStorage(ABC):
     @abstractmethod
     async def append_message(self, topic_id: int, message: [Message]):
@@ -124,6 +183,26 @@ class TopicStorage(ABC):
     async def get_messages(self, topic_id: list[int]) -> list[Message]:
         pass
 
+    @abstractmethod
+    async def get_last_messages(
+        self, topic_id: int, limit: int, chat_id: int = None
+    ) -> list[Message]:
+        pass
+
+    @abstractmethod
+    async def get_message_ids(
+        self, topic_id: int, skip_system: bool = True
+    ) -> list[int]:
+        pass
+
+    @abstractmethod
+    async def count_messages(self, topic_ids: list[int]) -> dict[int, int]:
+        pass
+
+    @abstractmethod
+    async def update_tokens(self, topic_id: int, messages: list[Message]):
+        pass
+
     @abstractmethod
     async def remove_messages(self, topic_id: int, message_ids: list[int]):
         pass
@@ -200,3 +279,46 @@ class GroupInfoStorage:
 
     async def update_group_info(self, chat_id: int, respond_message: int):
         pass
+
+
+class ChatContextStorage:
+    @abstractmethod
+    async def load_context(
+        self, uid: int, chat_id: int, thread_id: int, context_budget=None
+    ) -> ChatContext:
+        """
+        context_budget(profile) returns the token budget of the recent messages
+        to load, leaving out reasoning content. 0 loads all messages of the
+        topic and None none of them.
+        """
+        pass
+
+
+class MediaStorage:
+    @abstractmethod
+    async def save_media(self, media: Media):
+        pass
+
+    @abstractmethod
+    async def get_media(self, hashes: list[str]) -> list[Media]:
+        pass
+
+
+class ResponseCacheStorage:
+    @abstractmethod
+    async def get_response(self, key: str) -> CachedResponse | None:
+        pass
+
+    @abstractmethod
+    async def save_response(self, response: CachedResponse):
+        pass
+
+    @abstractmethod
+    async def evict_responses(
+        self, expire_before: int, max_entries: int, max_bytes: int
+    ) -> int:
+        """
+        delete the responses created before expire_before, then the oldest
+        ones over max_entries or max_bytes. Returns the number deleted.
+        """
+        pass
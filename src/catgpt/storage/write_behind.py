@@ -0,0 +1,241 @@
+import asyncio
+import enum
+import time
+
+from . import tx
+
+
+class Durability(enum.Enum):
+    # the caller waits until the batch holding its write is committed
+    COMMIT = "commit"
+    # the caller returns once the write is queued, a crash loses at most one batch
+    BUFFERED = "buffered"
+
+
+def in_write_transaction() -> bool:
+    transaction = tx.context.get()
+    return transaction is not None and transaction.tx_type == "write"
+
+
+class PendingWrite:
+    def __init__(self, key: str, func, args: tuple, rows: int, future):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.rows = rows
+        self.future = future
+
+
+class WriteBehindQueue:
+    """
+    Collects writes from many chats and commits them together in a single
+    write transaction every `interval_ms` or as soon as `max_rows` rows are
+    pending. Writes are grouped by a key (e.g. `topic:1`), readers call
+    `sync(key)` before reading so they always observe their own writes.
+    Inside a write transaction a batch would wait for the writer the caller
+    holds, the writes run in that transaction instead.
+    """
+
+    def __init__(
+        self,
+        interval_ms: int = 50,
+        max_rows: int = 200,
+        durability: str = Durability.COMMIT.value,
+    ):
+        assert interval_ms > 0, "interval must be > 0"
+        assert max_rows > 0, "max rows must be > 0"
+
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self.durability = Durability(durability)
+
+        self.pending: list[PendingWrite] = []
+        self.pending_rows = 0
+        self.pending_keys: dict[str, int] = {}
+        self.task: asyncio.Task | None = None
+        self.wakeup: asyncio.Event | None = None
+        self.lock: asyncio.Lock | None = None
+        self.closed = False
+
+        self.batches = 0
+        self.writes = 0
+        self.failures = 0
+        self.commit_time = 0.0
+
+    def _ensure_started(self):
+        if self.task is not None and not self.task.done():
+            return
+
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = asyncio.create_task(self._run())
+
+    async def submit(self, key: str, func, *args, rows: int = 1):
+        """queue `await func(*args)` to run inside the next batch"""
+        if self.closed:
+            return await func(*args)
+
+        if in_write_transaction():
+            # the older writes of key go first
+            await self._write_inline(key)
+            return await func(*args)
+
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(PendingWrite(key, func, args, rows, future))
+        self.pending_rows += rows
+        self.pending_keys[key] = self.pending_keys.get(key, 0) + 1
+
+        if self.pending_rows >= self.max_rows:
+            self.wakeup.set()
+
+        if self.durability == Durability.COMMIT:
+            return await future
+
+        return None
+
+    def has_pending(self, key: str = None) -> bool:
+        if key is None:
+            return len(self.pending) > 0
+
+        return key in self.pending_keys
+
+    async def sync(self, key: str = None):
+        """
+        flush pending writes if any of them belongs to key, inside a write
+        transaction they run in it
+        """
+        if not self.has_pending(key):
+            return
+
+        if in_write_transaction():
+            await self._write_inline(key)
+        else:
+            await self.flush()
+
+    def _forget(self, batch: list[PendingWrite]):
+        for w in batch:
+            count = self.pending_keys.get(w.key, 0) - 1
+            if count > 0:
+                self.pending_keys[w.key] = count
+            else:
+                self.pending_keys.pop(w.key, None)
+
+    async def _write_inline(self, key: str = None):
+        """run the pending writes of key in the caller's write transaction"""
+        batch = [w for w in self.pending if key is None or w.key == key]
+        if not batch:
+            return
+
+        self.pending = [w for w in self.pending if w not in batch]
+        self.pending_rows -= sum(w.rows for w in batch)
+        self._forget(batch)
+        try:
+            results = [await w.func(*w.args) for w in batch]
+        except Exception as e:
+            # the caller's transaction rolls back, none of them is written
+            self.failures += len(batch)
+            for w in batch:
+                if w.future.done():
+                    continue
+                if self.durability == Durability.BUFFERED:
+                    w.future.set_result(None)
+                else:
+                    w.future.set_exception(e)
+            raise
+
+        for w, result in zip(batch, results):
+            if not w.future.done():
+                w.future.set_result(result)
+
+        self.writes += len(batch)
+
+    async def flush(self):
+        if self.lock is None:
+            return
+
+        async with self.lock:
+            if not self.pending:
+                return
+
+            batch = self.pending
+            self.pending = []
+            self.pending_rows = 0
+
+            # batches always run in a transaction of their own
+            token = tx.context.set(None)
+            try:
+                await self._write(batch)
+            finally:
+                tx.context.reset(token)
+                self._forget(batch)
+
+    async def _write(self, batch: list[PendingWrite]):
+        start = time.perf_counter()
+        try:
+            results = await self._commit(batch)
+            for w, result in zip(batch, results):
+                if not w.future.done():
+                    w.future.set_result(result)
+        except Exception as e:
+            print(f"write-behind batch failed, retrying one by one: {e}")
+            # isolate the failing writes so they don't take the others down
+            for w in batch:
+                try:
+                    result = await self._commit([w])
+                    if not w.future.done():
+                        w.future.set_result(result[0])
+                except Exception as ie:
+                    self.failures += 1
+                    if self.durability == Durability.BUFFERED:
+                        # nobody waits for buffered writes
+                        print(f"write-behind dropped write for {w.key}: {ie}")
+                        w.future.set_result(None)
+                    elif not w.future.done():
+                        w.future.set_exception(ie)
+
+        self.batches += 1
+        self.writes += len(batch)
+        self.commit_time += time.perf_counter() - start
+
+    @tx.transactional(tx_type="write")
+    async def _commit(self, batch: list[PendingWrite]) -> list:
+        results = []
+        for w in batch:
+            results.append(await w.func(*w.args))
+
+        return results
+
+    async def _run(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"write-behind flush error: {e}")
+
+    async def close(self):
+        """stop the background flusher and commit everything still pending"""
+        self.closed = True
+        if self.task is not None:
+            self.wakeup.set()
+            await self.task
+
+        await self.flush()
+
+    def get_metrics(self) -> dict:
+        return {
+            "durability": self.durability.value,
+            "pending": len(self.pending),
+            "pending_rows": self.pending_rows,
+            "batches": self.batches,
+            "writes": self.writes,
+            "failures": self.failures,
+            "avg_batch_size": self.writes / self.batches if self.batches else 0.0,
+            "commit_time": self.commit_time,
+        }
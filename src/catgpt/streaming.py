@@ -0,0 +1,233 @@
+import asyncio
+import time
+
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.types import Message
+
+from .gateway import TelegramGateway, Priority
+from .utils.md2tgmd import (
+    escape,
+    close_open_constructs,
+    open_fence,
+    find_split,
+    StreamingMarkdown,
+)
+from .utils.text import MAX_TEXT_LENGTH
+
+# seconds between two edits of a streaming reply
+EDIT_INTERVAL = 1.8
+# an edit is skipped until at least this many new characters arrived
+MIN_EDIT_CHARS = 18
+# separates the reasoning from the answer in the reply text
+REASONING_SEPARATOR = "\n\n---\n"
+
+
+class StreamBuffer:
+    """the reply received so far, filled by the provider stream"""
+
+    def __init__(self):
+        self.text = ""
+        self.reasoning = ""
+        self.finished = False
+        self.finished_at = 0.0
+        self.changed = asyncio.Event()
+        self.done = asyncio.Event()
+        self.in_reasoning = False
+
+    def append(self, chunk: dict):
+        content = chunk["content"]
+        if chunk.get("reasoning"):
+            self.reasoning += content
+            self.in_reasoning = True
+        elif self.in_reasoning:
+            content = REASONING_SEPARATOR + content
+            self.in_reasoning = False
+        elif not content:
+            print("empty chunk's content", chunk)
+            return
+
+        self.text += content
+        self.changed.set()
+
+    def finish(self):
+        if not self.finished:
+            self.finished_at = time.time()
+        self.finished = True
+        self.changed.set()
+        self.done.set()
+
+    def get_answer(self) -> str:
+        """the text without the reasoning"""
+        if len(self.reasoning) > 0:
+            return self.text[len(self.reasoning) + len(REASONING_SEPARATOR) :]
+
+        return self.text
+
+    async def wait_finished(self, timeout: float):
+        """sleep for timeout seconds, or until the stream finished"""
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def read_stream(stream, buffer: StreamBuffer):
+    """drain the provider stream into the buffer as fast as it arrives"""
+    try:
+        async for chunk in stream:
+            buffer.append(chunk)
+    finally:
+        buffer.finish()
+
+
+class Page:
+    """one message of a reply, it shows the reply text from start on"""
+
+    def __init__(self, message: Message, start: int, prefix: str = ""):
+        self.message = message
+        self.start = start
+        # reopens the code fence the previous page was cut in
+        self.prefix = prefix
+        # renders only the part of the text that changed since the last edit
+        self.markdown = StreamingMarkdown()
+
+
+class ReplyRenderer:
+    """
+    Shows a StreamBuffer in the reply message while it fills up. Edits are
+    queued on the gateway without waiting for them, so a newer text replaces
+    an edit that is still waiting for the chat's rate budget. A reply too long
+    for one message goes on in a chain of messages: the full one is frozen at
+    a markdown boundary and only the last one is edited.
+    """
+
+    def __init__(self, gateway: TelegramGateway, reply_msg: Message, header: str):
+        self.gateway = gateway
+        self.reply_msg = reply_msg
+        self.header = header
+        self.pages = [Page(reply_msg, 0)]
+        # the text the reply messages show
+        self.text = ""
+        # the text of the latest edit queued
+        self.submitted = ""
+        self.timeout = EDIT_INTERVAL
+        self.last_edit = time.time()
+        self.error: Exception | None = None
+
+    async def run(self, buffer: StreamBuffer):
+        while not buffer.finished:
+            await buffer.changed.wait()
+            buffer.changed.clear()
+            if self.error is not None:
+                raise self.error
+
+            delay = self.timeout - (time.time() - self.last_edit)
+            if delay > 0:
+                await buffer.wait_finished(delay)
+
+            if buffer.finished:
+                break
+
+            if len(buffer.text) - len(self.submitted) < MIN_EDIT_CHARS:
+                continue
+
+            await self.edit(buffer.text)
+
+    def _source(self, page: Page, text: str) -> str:
+        header = self.header if page is self.pages[0] else ""
+        return f"{header}{page.prefix}{text[page.start:]}"
+
+    async def edit(self, text: str):
+        self.last_edit = time.time()
+        while True:
+            page = self.pages[-1]
+            message_text = page.markdown.render(self._source(page, text))
+            if len(message_text) <= MAX_TEXT_LENGTH:
+                break
+            await self.split(text)
+
+        self.submitted = text
+        if not message_text:
+            return
+
+        future = self.gateway.submit_edit(
+            message_text,
+            page.message.chat.id,
+            page.message.message_id,
+            Priority.PROGRESS,
+            parse_mode="MarkdownV2",
+            disable_web_page_preview=True,
+        )
+        future.add_done_callback(lambda f: self._edited(f, text))
+
+    def _edited(self, future: asyncio.Future, text: str):
+        if future.cancelled():
+            return
+
+        ae = future.exception()
+        if ae is None:
+            # None: a newer text replaced this edit
+            if future.result() is not None and len(text) > len(self.text):
+                self.text = text
+                self.timeout = EDIT_INTERVAL
+        elif isinstance(ae, ApiTelegramException) and ae.error_code == 400:
+            print(ae)
+            self.timeout = 2.5
+            print(escape(text))
+        else:
+            self.error = ae
+
+    async def _final_edit(self, page: Page, message_text: str):
+        try:
+            await self.gateway.edit_message_text(
+                message_text,
+                page.message.chat.id,
+                page.message.message_id,
+                priority=Priority.FINAL,
+                parse_mode="MarkdownV2",
+                disable_web_page_preview=True,
+            )
+        except ApiTelegramException as ae:
+            # the last intermediate edit showed this text already
+            if ae.error_code != 400 or "not modified" not in ae.description:
+                raise
+
+    async def split(self, text: str):
+        """freeze the last page at a markdown boundary, go on in a new message"""
+        page = self.pages[-1]
+        source = page.prefix + text[page.start :]
+        cut = find_split(source, MAX_TEXT_LENGTH, len(page.prefix))
+        frozen = source[:cut]
+        await self._final_edit(page, escape(close_open_constructs(frozen)))
+
+        opening = open_fence(frozen)
+        prefix = "" if opening is None else f"{opening}\n"
+        start = page.start + cut - len(page.prefix)
+        self.text = max(self.text, text[:start], key=len)
+
+        rest = f"{prefix}{text[start:]}"
+        message_text = escape(close_open_constructs(rest)) if rest.strip() else ""
+        if not message_text or len(message_text) > MAX_TEXT_LENGTH:
+            message_text = escape("...")
+
+        message = await self.gateway.send_message(
+            page.message.chat.id,
+            message_text,
+            parse_mode="MarkdownV2",
+            disable_web_page_preview=True,
+            reply_to_message_id=page.message.message_id,
+        )
+        self.pages.append(Page(message, start, prefix))
+
+    async def finish(self, text: str):
+        """the final edit of the last page, without the header"""
+        while True:
+            page = self.pages[-1]
+            message_text = escape(page.prefix + text[page.start :])
+            if len(message_text) <= MAX_TEXT_LENGTH:
+                break
+            await self.split(text)
+
+        if message_text or len(self.pages) == 1:
+            await self._final_edit(page, message_text)
+        self.text = text
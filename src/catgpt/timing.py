@@ -0,0 +1,28 @@
+import time
+
+from contextlib import contextmanager
+
+
+class TurnTimer:
+    """the durations of the stages of a chat turn, from when it was picked up"""
+
+    def __init__(self, start: float = None):
+        self.start = time.monotonic() if start is None else start
+        # stage name -> seconds
+        self.stages: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.monotonic() - start
+
+    async def timed(self, name: str, awaitable):
+        """await a stage that runs as a task next to the others"""
+        with self.stage(name):
+            return await awaitable
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+from . import provider
+from .storage import types
+from .topic import Topic
+from .types import Endpoint
+
+TITLE_PROMPT = "Please generate a title for this conversation without any lead-in, punctuation, quotation marks, periods, symbols, bold text, or additional text. Remove enclosing quotation marks. Please only return the title without any additional info."
+
+
+def first_exchange(messages: list[types.Message], answer: str) -> tuple[str, str]:
+    """the first question of a topic and its answer"""
+    for i, m in enumerate(messages):
+        if m.role != "user":
+            continue
+
+        for reply in messages[i + 1 :]:
+            if reply.role == "assistant":
+                return m.content or "", reply.content or ""
+
+        return m.content or "", answer
+
+    return "", answer
+
+
+class TitleJob:
+    def __init__(self, convo: types.Topic, endpoint: Endpoint, question, answer):
+        self.convo = convo
+        self.endpoint = endpoint
+        self.question = question
+        self.answer = answer
+        self.attempts = 0
+
+
+class TitleQueue:
+    """
+    Generates the titles of new topics in the background, off the reply path.
+    Only the first exchange of a topic is sent, truncated to `max_chars`. At
+    most `concurrency` requests run at once so a spike of new topics doesn't
+    compete with live chats, and a failed one is retried after `backoff`,
+    2 * `backoff`, ... seconds. A title is dropped if the topic was cleared
+    or titled in the meantime.
+    """
+
+    def __init__(
+        self,
+        topic: Topic,
+        concurrency: int = 2,
+        max_retries: int = 3,
+        backoff: float = 2,
+        max_chars: int = 1000,
+        max_pending: int = 1000,
+    ):
+        assert concurrency > 0, "concurrency must be > 0"
+
+        self.topic = topic
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_chars = max_chars
+        self.queue: asyncio.Queue | None = None
+        self.max_pending = max_pending
+        self.workers: list[asyncio.Task] = []
+        # topics with a job queued, running or waiting for a retry
+        self.pending: set[int] = set()
+
+        self.generated = 0
+        self.retries = 0
+        self.failed = 0
+        self.dropped = 0
+        self.stale = 0
+
+    def _ensure_started(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.max_pending)
+        if not self.workers:
+            self.workers = [
+                asyncio.create_task(self._run()) for _ in range(self.concurrency)
+            ]
+
+    def submit(
+        self,
+        convo: types.Topic,
+        endpoint: Endpoint,
+        messages: list[types.Message],
+        answer: str,
+    ):
+        """queue the title of convo, unless one is on its way already"""
+        if convo.tid in self.pending:
+            return
+
+        self._ensure_started()
+        question, answer = first_exchange(messages, answer)
+        job = TitleJob(convo, endpoint, question, answer)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            # the topic keeps generate_title, its next reply tries again
+            self.dropped += 1
+            return
+
+        self.pending.add(convo.tid)
+
+    def _retry(self, job: TitleJob):
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self.pending.discard(job.convo.tid)
+
+    async def _run(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if await self._generate(job):
+                    self.generated += 1
+                else:
+                    self.stale += 1
+                self.pending.discard(job.convo.tid)
+            except Exception as e:
+                job.attempts += 1
+                if job.attempts > self.max_retries:
+                    print(f"failed to generate the title of {job.convo.tid}: {e!r}")
+                    self.failed += 1
+                    self.pending.discard(job.convo.tid)
+                else:
+                    self.retries += 1
+                    delay = self.backoff * 2 ** (job.attempts - 1)
+                    asyncio.get_running_loop().call_later(delay, self._retry, job)
+            finally:
+                self.queue.task_done()
+
+    async def _generate(self, job: TitleJob) -> bool:
+        """False if the topic no longer wants the title"""
+        now = int(time.time())
+        messages = [
+            types.Message("user", job.question[: self.max_chars], 0, 0, 0, now),
+            types.Message("assistant", job.answer[: self.max_chars], 0, 0, 0, now),
+            types.Message("user", TITLE_PROMPT, 0, 0, 0, now),
+        ]
+        title = (await provider.ask(job.endpoint, {"messages": messages}) or "").strip()
+        if not title:
+            raise Exception("empty title")
+
+        # the topic may have been cleared or titled since the job was queued
+        convo = await self.topic.get_topic(job.convo.tid)
+        if convo is None or convo.label != job.convo.label or not convo.generate_title:
+            return False
+
+        convo.generate_title = False
+        convo.title = title
+        await self.topic.update_topic(convo)
+        return True
+
+    def get_metrics(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "pending": len(self.pending),
+            "generated": self.generated,
+            "retries": self.retries,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "stale": self.stale,
+        }
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
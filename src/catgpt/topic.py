@@ -1,18 +1,177 @@
+import copy
+import sys
 import uuid
 
 from telebot import types as tg_types
 
 from .storage import types, tx
+from .storage.write_behind import WriteBehindQueue
 from .types import MessageType
+from .utils.cache import LRUCache
+from .utils.tokens import count_message_tokens
+
+# rough size of a topic or message object without its strings
+OBJECT_OVERHEAD = 256
+
+
+def _copy_topic(topic: types.Topic) -> types.Topic:
+    t = copy.copy(topic)
+    t.messages = []
+    return t
+
+
+def _copy_message(message: types.Message) -> types.Message:
+    m = copy.copy(message)
+    m.media_data = None
+    return m
+
+
+class CachedTopic:
+    """a topic row and, once they were loaded, all of its messages"""
+
+    def __init__(self, topic: types.Topic, messages: list[types.Message] = None):
+        self.topic = _copy_topic(topic)
+        self.messages = None
+        if messages is not None:
+            self.messages = [_copy_message(m) for m in messages]
+
+    def get_messages(self) -> list[types.Message]:
+        # callers get copies so media loaded for a request isn't cached
+        return [copy.copy(m) for m in self.messages]
+
+    def to_topic(self, fetch_messages: bool) -> types.Topic:
+        topic = _copy_topic(self.topic)
+        if fetch_messages:
+            topic.messages = self.get_messages()
+
+        return topic
+
+    def sizeof(self) -> int:
+        size = OBJECT_OVERHEAD + sys.getsizeof(self.topic.title or "")
+        for m in self.messages or []:
+            size += OBJECT_OVERHEAD + sys.getsizeof(m.content or "")
+            size += sys.getsizeof(m.media_url or "")
+
+        return size
 
 
 class Topic:
-    def __init__(self, storage: types.TopicStorage):
+    def __init__(
+        self,
+        storage: types.TopicStorage,
+        write_behind: WriteBehindQueue = None,
+        cache: LRUCache = None,
+    ):
         self.storage = storage
+        self.write_behind = write_behind
+        # topic id -> CachedTopic, kept up to date by every write of this class
+        self.cache = cache
+        # topic id -> token of the load in flight, dropped by writes to the topic
+        self.loading = {}
+        # number of writes to cached topics, lets loads of unknown topics detect them
+        self.writes = 0
+
+    def _peek(self, topic_id: int) -> CachedTopic | None:
+        if self.cache is None:
+            return None
+
+        return self.cache.peek(topic_id)
+
+    def _cache_put(self, topic: types.Topic, messages: list = None):
+        if self.cache is not None:
+            entry = CachedTopic(topic, messages)
+            self.cache.put(topic.tid, entry, entry.sizeof())
+
+    def _written(self, topic_id: int):
+        """drop loads of the topic in flight, their result may be stale"""
+        self.loading.pop(topic_id, None)
+        self.writes += 1
+
+    def _cache_messages(self, topic_id: int, func):
+        """apply func to the cached message list of the topic, if any"""
+        self._written(topic_id)
+        entry = self._peek(topic_id)
+        if entry is not None and entry.messages is not None:
+            entry.messages = func(entry.messages)
+            self.cache.resize(topic_id, entry.sizeof())
+
+    def get_cached(
+        self, topic_id: int, fetch_messages: bool = False
+    ) -> types.Topic | None:
+        """the cached topic, None if it isn't cached with what was asked for"""
+        if self.cache is None:
+            return None
+
+        entry = self.cache.get(topic_id)
+        if entry is None or (fetch_messages and entry.messages is None):
+            return None
+
+        return entry.to_topic(fetch_messages)
+
+    def cache_loaded(self, topic: types.Topic, writes: int):
+        """
+        cache a topic loaded with all of its messages outside of this class,
+        unless a topic was written since the load started at `writes`
+        """
+        if self.writes == writes:
+            self._cache_put(topic, topic.messages)
+
+    def get_cache_metrics(self) -> dict:
+        if self.cache is None:
+            return {}
+
+        return self.cache.get_metrics()
+
+    async def sync(self, topic_id: int = None):
+        """make pending write-behind writes of the topic visible to readers"""
+        if self.write_behind is not None:
+            key = None if topic_id is None else f"topic:{topic_id}"
+            await self.write_behind.sync(key)
 
     async def get_messages(self, topic_ids: list[int]) -> list[types.Message]:
+        if len(topic_ids) == 1:
+            await self.sync(topic_ids[0])
+            entry = self._peek(topic_ids[0])
+            if entry is not None and entry.messages is not None:
+                return entry.get_messages()
+        else:
+            await self.sync()
+
         return await self.storage.get_messages(topic_ids)
 
+    async def get_last_messages(
+        self, topic_id: int, limit: int, chat_id: int = None
+    ) -> list[types.Message]:
+        await self.sync(topic_id)
+        entry = self._peek(topic_id)
+        if entry is not None and entry.messages is not None:
+            messages = entry.get_messages()
+            if chat_id is not None:
+                messages = [m for m in messages if m.chat_id == chat_id]
+            return messages[-limit:]
+
+        return await self.storage.get_last_messages(topic_id, limit, chat_id)
+
+    async def get_message_ids(self, topic_id: int) -> list[int]:
+        """ids of all non-system messages in the topic"""
+        await self.sync(topic_id)
+        entry = self._peek(topic_id)
+        if entry is not None and entry.messages is not None:
+            return [m.message_id for m in entry.messages if m.role != "system"]
+
+        return await self.storage.get_message_ids(topic_id)
+
+    async def count_messages(self, topic_ids: list[int]) -> dict[int, int]:
+        if not topic_ids:
+            return {}
+
+        entries = [self._peek(tid) for tid in topic_ids]
+        if all(e is not None and e.messages is not None for e in entries):
+            return {e.topic.tid: len(e.messages) for e in entries}
+
+        await self.sync()
+        return await self.storage.count_messages(topic_ids)
+
     async def append_messages(
         self,
         topic_id: int,
@@ -60,31 +219,99 @@ class Topic:
             )
         )
 
-        await self.storage.append_message(topic_id, messages)
+        for m in messages:
+            count_message_tokens(m)
+
+        if self.write_behind is not None:
+            await self.write_behind.submit(
+                f"topic:{topic_id}",
+                self.storage.append_message,
+                topic_id,
+                messages,
+                rows=len(messages),
+            )
+        else:
+            await self.storage.append_message(topic_id, messages)
+
+        appended = [_copy_message(m) for m in messages]
+        self._cache_messages(topic_id, lambda cached: cached + appended)
+
+    async def update_tokens(self, topic_id: int, messages: list[types.Message]):
+        """persist token counts of messages stored before they were counted"""
+        if not messages:
+            return
+
+        await self.sync(topic_id)
+        await self.storage.update_tokens(topic_id, messages)
+
+        tokens = {(m.message_id, m.role, m.message_type): m.tokens for m in messages}
+
+        def apply(cached: list[types.Message]):
+            for m in cached:
+                m.tokens = tokens.get((m.message_id, m.role, m.message_type), m.tokens)
+            return cached
+
+        self._cache_messages(topic_id, apply)
 
     async def remove_messages(self, topic_id: int, message_ids: list[int]):
         assert topic_id > 0, "Invalid topic id"
         assert len(message_ids) > 0, "message ids cannot be empty"
 
+        await self.sync(topic_id)
         await self.storage.remove_messages(topic_id, message_ids)
 
+        removed = set(message_ids)
+        self._cache_messages(
+            topic_id, lambda cached: [m for m in cached if m.message_id not in removed]
+        )
+
     async def get_topic(
         self, topic_id: int, fetch_messages: bool = False
+    ) -> [types.Topic | None]:
+        await self.sync(topic_id)
+        if self.cache is None:
+            return await self._load_topic(topic_id, fetch_messages)
+
+        entry = self.cache.get(topic_id)
+        if entry is not None and (not fetch_messages or entry.messages is not None):
+            return entry.to_topic(fetch_messages)
+
+        token = object()
+        self.loading[topic_id] = token
+        try:
+            topic = await self._load_topic(topic_id, fetch_messages)
+            # skip caching if the topic was written while it was being loaded
+            if topic is not None and self.loading.get(topic_id) is token:
+                messages = topic.messages if fetch_messages else None
+                if messages is None and entry is not None:
+                    messages = entry.messages
+                self._cache_put(topic, messages)
+        finally:
+            if self.loading.get(topic_id) is token:
+                del self.loading[topic_id]
+
+        return topic
+
+    async def _load_topic(
+        self, topic_id: int, fetch_messages: bool
     ) -> [types.Topic | None]:
         topic = await self.storage.get_topic(topic_id)
         if topic is None:
             return None
 
         if fetch_messages:
-            messages = await self.get_messages([topic_id])
-            topic.messages = messages
+            topic.messages = await self.storage.get_messages([topic_id])
 
         return topic
 
     async def list_topics(
-        self, uid: int, chat_id: int, thread_id: int
+        self, uid: int, chat_id: int, thread_id: int, fetch_messages: bool = True
     ) -> list[types.Topic]:
+        await self.sync()
         topics = await self.storage.list_topics(uid, chat_id, thread_id)
+        if not fetch_messages or not topics:
+            return topics
+
         topic_ids = [topic.tid for topic in topics]
         messages = await self.get_messages(topic_ids)
 
@@ -111,7 +338,16 @@ class Topic:
 
     async def update_topic(self, topic: types.Topic):
         assert topic.tid > 0, "Topic id must be > 0"
-        await self.storage.update_topic(topic)
+        if self.write_behind is not None:
+            key = f"topic:{topic.tid}"
+            await self.write_behind.submit(key, self.storage.update_topic, topic)
+        else:
+            await self.storage.update_topic(topic)
+
+        self._written(topic.tid)
+        entry = self._peek(topic.tid)
+        if entry is not None:
+            entry.topic = _copy_topic(topic)
 
     async def new_topic(
         self,
@@ -136,12 +372,28 @@ class Topic:
         if messages:
             topic.messages = messages
 
-        return await self.create_topic(topic)
+        topic = await self.create_topic(topic)
+        self._cache_put(topic, topic.messages)
+        return topic
 
-    @tx.transactional(tx_type="write")
     async def clear_topic(self, topic: types.Topic, prompt: types.Message = None):
         assert topic.tid > 0, "Topic id must be > 0"
 
+        await self.sync(topic.tid)
+        self._written(topic.tid)
+        try:
+            await self._clear_topic(topic, prompt)
+        except Exception:
+            if self.cache is not None:
+                self.cache.invalidate(topic.tid)
+            raise
+
+        if prompt:
+            prompt.topic_id = topic.tid
+        self._cache_put(topic, [prompt] if prompt else [])
+
+    @tx.transactional(tx_type="write")
+    async def _clear_topic(self, topic: types.Topic, prompt: types.Message = None):
         await self.storage.remove_message_by_topic(topic.tid)
         if prompt:
             await self.storage.append_message(topic.tid, [prompt])
@@ -151,10 +403,17 @@ class Topic:
         topic.label = str(uuid.uuid4()).replace("-", "")
         await self.storage.update_topic(topic)
 
-    @tx.transactional(tx_type="write")
     async def remove_topic(self, topic_id: int):
         assert topic_id > 0, "Topic id must be > 0"
 
+        await self.sync(topic_id)
+        self._written(topic_id)
+        if self.cache is not None:
+            self.cache.invalidate(topic_id)
+        await self._remove_topic(topic_id)
+
+    @tx.transactional(tx_type="write")
+    async def _remove_topic(self, topic_id: int):
         await self.storage.delete_topic(topic_id)
         await self.storage.remove_message_by_topic(topic_id)
 
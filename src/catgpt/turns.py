@@ -0,0 +1,120 @@
+import asyncio
+
+from collections import OrderedDict, deque
+
+
+class TurnLane:
+    """the turns of a topic, one of them runs at a time"""
+
+    def __init__(self):
+        self.busy = False
+        # futures of the turns waiting, set to True when it's their turn
+        self.waiting: deque[asyncio.Future] = deque()
+
+
+class TurnQueue:
+    """
+    Runs the turns of a (chat, thread, topic) one after another, so a turn
+    sees the history of the turns before it and their messages don't
+    interleave. Telegram may deliver an update more than once, is_duplicate
+    tells a message seen before so it's dropped before anything is loaded
+    for it. With the "latest" policy a new message replaces the turns still
+    waiting, only the turn in progress and the newest one are answered.
+    """
+
+    POLICIES = ("queue", "latest")
+
+    def __init__(self, policy: str = "queue", max_seen: int = 4096):
+        assert policy in self.POLICIES, f"policy must be one of {self.POLICIES}"
+
+        self.policy = policy
+        self.max_seen = max_seen
+        # key -> TurnLane, only keys with a turn in progress
+        self.lanes: dict[tuple, TurnLane] = {}
+        # (chat id, message id) of the recent messages
+        self.seen: OrderedDict[tuple, None] = OrderedDict()
+
+        self.turns = 0
+        self.waited = 0
+        self.duplicates = 0
+        self.superseded = 0
+
+    def is_duplicate(self, message_key: tuple) -> bool:
+        if message_key in self.seen:
+            self.duplicates += 1
+            return True
+
+        self.seen[message_key] = None
+        if len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+
+        return False
+
+    def _next(self, key: tuple, lane: TurnLane):
+        """hand the lane over to the next turn waiting, or free it"""
+        while lane.waiting:
+            future = lane.waiting.popleft()
+            if not future.done():
+                future.set_result(True)
+                return
+
+        lane.busy = False
+        self.lanes.pop(key, None)
+
+    async def _wait(self, key: tuple, lane: TurnLane) -> bool:
+        """wait for the turn, False if a newer message replaced it"""
+        if self.policy == "latest":
+            while lane.waiting:
+                future = lane.waiting.popleft()
+                if not future.done():
+                    future.set_result(False)
+                    self.superseded += 1
+
+        future = asyncio.get_running_loop().create_future()
+        lane.waiting.append(future)
+        try:
+            return await future
+        except BaseException:
+            if future.done() and not future.cancelled() and future.result():
+                # the lane was handed over already
+                self._next(key, lane)
+            elif future in lane.waiting:
+                lane.waiting.remove(future)
+            raise
+
+    async def run(self, key: tuple, func) -> bool:
+        """
+        await func(waited) once the turns of key before it are done, waited
+        tells if any were. False if func didn't run, a newer message replaced
+        it.
+        """
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = TurnLane()
+            self.lanes[key] = lane
+
+        waited = lane.busy
+        if waited:
+            self.waited += 1
+            if not await self._wait(key, lane):
+                return False
+        else:
+            lane.busy = True
+
+        self.turns += 1
+        try:
+            await func(waited)
+        finally:
+            self._next(key, lane)
+
+        return True
+
+    def get_metrics(self) -> dict:
+        return {
+            "policy": self.policy,
+            "turns": self.turns,
+            "waited": self.waited,
+            "duplicates": self.duplicates,
+            "superseded": self.superseded,
+            "in_progress": len(self.lanes),
+        }
@@ -17,6 +17,25 @@ MODEL_MAPPING = {
     "gemini-1.5-pro": ["text", "photo"],
 }
 
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4o": 128000,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4-0125-preview": 128000,
+    "gpt-4-turbo-preview": 128000,
+    "gpt-4-turbo-2024-04-09": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-4-0613": 8192,
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-0301": 4096,
+    "gemini-1.5-flash": 1048576,
+    "gemini-1.5-pro": 2097152,
+}
+
+DEFAULT_CONTEXT_TOKENS = 32768
+# room left in the context window for the reply
+RESERVED_OUTPUT_TOKENS = 4096
+
 
 class Endpoint:
 
@@ -30,6 +49,10 @@ class Endpoint:
         default_model: str = None,
         default_endpoint: bool = False,
         generate_title: bool = True,
+        context_tokens: dict = None,
+        http: dict = None,
+        limits: dict = None,
+        timeouts: dict = None,
     ):
         assert len(name) > 0, "endpoint name can't be empty"
         assert len(api_url) > 0, "api url can't be empty"
@@ -47,6 +70,24 @@ class Endpoint:
         self.default_model = default_model
         if not default_model:
             self.default_model = models[0]
+        # model -> max prompt tokens sent to the model
+        self.context_tokens = context_tokens or {}
+        # connection pool and timeouts of the endpoint's http client
+        self.http = http or {}
+        # concurrent requests and their wait queue
+        self.limits = limits or {}
+        # connect, first token and stall timeouts of a streaming request
+        self.timeouts = timeouts or {}
+
+    def get_connect_timeout(self) -> float:
+        return self.timeouts.get("connect", self.http.get("connect_timeout", 5))
+
+    def get_context_budget(self, model: str) -> int:
+        if model in self.context_tokens:
+            return self.context_tokens[model]
+
+        window = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+        return max(window - RESERVED_OUTPUT_TOKENS, window // 2)
 
     @staticmethod
     def is_support(model, message_type):
@@ -79,6 +120,10 @@ class Configuration:
         self.endpoints: List[Endpoint] = []
         self.respond_group_message = False
         self.topic_preview = Preview.INTERNAL
+        self.storage = {}
+        self.title = {}
+        # telegram user ids allowed to see the bot's stats
+        self.admins: List[int] = []
 
     def get_endpoints(self) -> List[Endpoint]:
         return self.endpoints
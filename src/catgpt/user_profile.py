@@ -1,9 +1,12 @@
+import copy
 import json
 
 from pathlib import Path
 
 from .storage import types
+from .storage.write_behind import WriteBehindQueue
 from .types import ChatType
+from .utils.cache import LRUCache
 
 DEFAULT_PROFILE = {
     "prompt": "You are ChatGPT, a large language model trained by OpenAI.\nLatex inline: $x^2$\nLatex block: $$e=mc^2$$",
@@ -15,11 +18,23 @@ DEFAULT_PRESET = {"role": "System", "prompt": None}
 
 
 class UserProfile:
-    def __init__(self, storage: types.ProfileStorage, preset_file: Path):
+    def __init__(
+        self,
+        storage: types.ProfileStorage,
+        preset_file: Path,
+        write_behind: WriteBehindQueue = None,
+        cache: LRUCache = None,
+    ):
         self.presets = {}
         self.storage = storage
+        self.write_behind = write_behind
 
-        self.memory = {}
+        # uid-chat_id-thread_id -> Profile
+        self.cache = cache or LRUCache(max_size=4096, ttl=600)
+        # key -> token of the load in flight, dropped by writes to the profile
+        self.loading = {}
+        # number of profile writes, lets loads outside of this class detect them
+        self.writes = 0
 
         if preset_file.exists():
             presets: [] = json.loads(preset_file.read_text())
@@ -30,8 +45,76 @@ class UserProfile:
         if len(self.presets) == 0:
             self.presets["System"] = DEFAULT_PRESET
 
+    @staticmethod
+    def _key(uid: int, chat_id: int, thread_id: int) -> str:
+        return f"{uid}-{chat_id}-{thread_id or 0}"
+
+    def get_cached(
+        self, uid: int, chat_id: int, thread_id: int
+    ) -> types.Profile | None:
+        profile = self.cache.get(self._key(uid, chat_id, thread_id))
+        return copy.copy(profile) if profile is not None else None
+
+    def remember(self, profile: types.Profile, writes: int = None):
+        """
+        cache a profile loaded outside of this class, unless a profile was
+        written since the load started at `writes`
+        """
+        if writes is None or writes == self.writes:
+            self.cache.put(profile.get_key(), copy.copy(profile))
+
+    def invalidate(self, uid: int, chat_id: int, thread_id: int):
+        self.cache.invalidate(self._key(uid, chat_id, thread_id))
+
+    def invalidate_all(self):
+        self.cache.clear()
+
+    async def _sync(self, uid: int, chat_id: int, thread_id: int):
+        if self.write_behind is not None:
+            await self.write_behind.sync(f"profile:{uid}-{chat_id}-{thread_id or 0}")
+
+    def _written(self, uid: int, chat_id: int, thread_id: int, profile):
+        """
+        cache the written profile, loads in flight may have read the row
+        before the write and are not cached
+        """
+        key = self._key(uid, chat_id, thread_id)
+        self.loading.pop(key, None)
+        self.writes += 1
+        self.cache.put(key, copy.copy(profile))
+
+    async def _save(self, uid: int, chat_id: int, thread_id: int, profile):
+        self.invalidate(uid, chat_id, thread_id)
+        if self.write_behind is not None:
+            key = f"profile:{uid}-{chat_id}-{thread_id or 0}"
+            await self.write_behind.submit(
+                key, self.storage.update, uid, chat_id, thread_id, profile
+            )
+        else:
+            await self.storage.update(uid, chat_id, thread_id, profile)
+
+        self._written(uid, chat_id, thread_id, profile)
+
     async def load(self, uid: int, chat_id: int, thread_id: int) -> types.Profile:
-        profile = await self.storage.get_profile(uid, chat_id, thread_id)
+        key = self._key(uid, chat_id, thread_id)
+        profile = self.cache.get(key)
+        if profile is not None:
+            # callers modify the profile before saving it
+            return copy.copy(profile)
+
+        token = object()
+        self.loading[key] = token
+        try:
+            await self._sync(uid, chat_id, thread_id)
+            profile = await self.storage.get_profile(uid, chat_id, thread_id)
+        finally:
+            loaded = self.loading.get(key) is token
+            if loaded:
+                del self.loading[key]
+
+        if profile is not None and loaded:
+            self.cache.put(key, copy.copy(profile))
+
         return profile
 
     async def create(
@@ -59,6 +142,7 @@ class UserProfile:
         )
 
         await self.storage.create_profile(profile)
+        self.invalidate(uid, chat_id, thread_id)
         return profile
 
     def get_preset(self, preset_name: str):
@@ -68,45 +152,30 @@ class UserProfile:
         self, uid: int, chat_id: int, thread_id: int
     ) -> [types.Profile | None]:
         assert uid > 0, "invalid uid: " + str(uid)
-        profile = await self.storage.get_profile(uid, chat_id, thread_id)
-        if not profile:
-            return None
-
-        self.memory[profile.get_key()] = True
-
-        return profile
+        return await self.load(uid, chat_id, thread_id)
 
     async def has_profile(self, uid: int, chat_id: int, thread_id: int) -> bool:
         assert uid > 0, "invalid uid: " + str(uid)
-        key = f"{uid}-{chat_id}-{thread_id}"
-        if key in self.memory:
-            return True
-
         profile = await self.get_profile(uid, chat_id, thread_id)
-
-        if not profile:
-            return False
-
-        self.memory[key] = True
-        return True
+        return profile is not None
 
     async def update(
         self, uid: int, chat_id: int, thread_id: int, profile: types.Profile
     ):
         assert uid > 0, "invalid uid: " + str(uid)
-        await self.storage.update(uid, chat_id, thread_id, profile)
+        await self._save(uid, chat_id, thread_id, profile)
 
     async def update_model(self, uid: int, chat_id: int, thread_id: int, model: str):
         assert uid > 0, "invalid uid: " + str(uid)
         profile = await self.get_profile(uid, chat_id, thread_id)
         profile.model = model
-        await self.storage.update(uid, chat_id, thread_id, profile)
+        await self._save(uid, chat_id, thread_id, profile)
 
     async def update_prompt(self, uid: int, chat_id: int, thread_id: int, prompt: str):
         assert uid > 0, "invalid uid: " + str(uid)
         profile = await self.get_profile(uid, chat_id, thread_id)
         profile.prompt = prompt
-        await self.storage.update(uid, chat_id, thread_id, profile)
+        await self._save(uid, chat_id, thread_id, profile)
 
     async def get_conversation_id(self, uid: int, chat_type: str) -> int:
         return await self.storage.get_conversation_id(uid, chat_type)
@@ -117,7 +186,7 @@ class UserProfile:
         assert uid > 0, "invalid uid: " + str(uid)
         profile = await self.get_profile(uid, chat_id, thread_id)
         profile.topic_id = conversation_id
-        await self.storage.update(uid, chat_id, thread_id, profile)
+        await self._save(uid, chat_id, thread_id, profile)
 
     def get_prompt(self, prompt) -> str:
         prompt = self.presets.get(prompt, {})
@@ -125,24 +194,43 @@ class UserProfile:
 
 
 class Users:
-    def __init__(self, storage: types.UserStorage):
+    def __init__(self, storage: types.UserStorage, cache: LRUCache = None):
         self.storage = storage
-        self.memory = {}
+        # uid -> User
+        self.cache = cache or LRUCache(max_size=4096, ttl=600)
+
+    def get_cached(self, uid: int) -> types.User | None:
+        return self.cache.get(uid)
+
+    def remember(self, user: types.User):
+        """cache a user loaded outside of this class"""
+        self.cache.put(user.uid, user)
+
+    def invalidate(self, uid: int):
+        self.cache.invalidate(uid)
+
+    def invalidate_all(self):
+        self.cache.clear()
 
     async def get_user(self, uid: int) -> types.User | None:
-        return await self.storage.get_user(uid)
+        user = self.cache.get(uid)
+        if user is not None:
+            return user
+
+        user = await self.storage.get_user(uid)
+        if user is not None:
+            self.cache.put(uid, user)
+
+        return user
 
     async def create_user(self, uid: int, blocked: int = 0):
         user = types.User(uid=uid, blocked=blocked)
         await self.storage.create_user(user)
+        self.invalidate(uid)
 
     async def is_enrolled(self, uid: int) -> bool:
-        if uid in self.memory:
-            return True
-
-        u = await self.storage.get_user(uid)
+        u = await self.get_user(uid)
         if u:
-            self.memory[uid] = True
             return True
 
         return False
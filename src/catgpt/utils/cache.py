@@ -0,0 +1,101 @@
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A least recently used cache bounded by the number of entries and,
+    optionally, by the total size reported for the entries. Entries expire
+    `ttl` seconds after they were written when a ttl is given.
+    """
+
+    def __init__(self, max_size: int = 1024, max_bytes: int = 0, ttl: float = 0):
+        assert max_size > 0, "max size must be > 0"
+
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key) -> bool:
+        entry = self.entries.get(key)
+        return entry is not None and not self._is_expired(entry)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _is_expired(self, entry) -> bool:
+        return self.ttl > 0 and entry[2] < time.monotonic()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        if self._is_expired(entry):
+            self.invalidate(key)
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, key, default=None):
+        """like get, but doesn't count or refresh the entry"""
+        entry = self.entries.get(key)
+        if entry is None or self._is_expired(entry):
+            return default
+
+        return entry[0]
+
+    def put(self, key, value, size: int = 0):
+        self.invalidate(key)
+        if self.max_bytes > 0 and size > self.max_bytes:
+            return
+
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        self.entries[key] = (value, size, expires_at)
+        self.bytes += size
+
+        while len(self.entries) > self.max_size or (
+            self.max_bytes > 0 and self.bytes > self.max_bytes
+        ):
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def resize(self, key, size: int):
+        """update the size of an entry changed in place"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+
+        self.put(key, entry[0], size)
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def get_metrics(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+        }
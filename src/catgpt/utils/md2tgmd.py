@@ -5,3 +5,159 @@ NEW_LINE = "   "
 
 def escape(markdown_text: str):
     return telegramify_markdown.markdownify(content=markdown_text, max_line_length=256)
+
+
+FENCES = ("```", "~~~")
+
+
+def _scan_fences(text: str) -> tuple[str | None, list[str]]:
+    """the opening line of a code fence left open, and the lines outside fences"""
+    opening = None
+    inline = []
+    for line in text.split("\n"):
+        marker = line.lstrip()[:3]
+        if opening is None and marker in FENCES:
+            opening = line
+        elif opening is not None and marker == opening.lstrip()[:3]:
+            opening = None
+        elif opening is None:
+            inline.append(line)
+
+    return opening, inline
+
+
+def open_fence(text: str) -> str | None:
+    """the opening line of the code fence left open at the end of text"""
+    return _scan_fences(text)[0]
+
+
+def close_open_constructs(text: str) -> str:
+    """close a code fence, inline code or bold left open at the end of text"""
+    opening, inline = _scan_fences(text)
+    if opening is not None:
+        return f"{text}\n{opening.lstrip()[:3]}"
+
+    tail = "\n".join(inline)
+    text = text.rstrip()
+    if (tail.count("`") - 3 * tail.count("```")) % 2 == 1:
+        return text + "`"
+
+    if tail.count("**") % 2 == 1:
+        return text + "**"
+
+    return text
+
+
+class StreamingMarkdown:
+    """
+    Renders a growing markdown text to MarkdownV2. A block followed by a blank
+    line outside of a code fence is complete, its output is kept and only the
+    open tail is rendered again. Open constructs of the tail are closed, so
+    every snapshot is valid MarkdownV2.
+    """
+
+    def __init__(self):
+        # the source of the complete blocks
+        self.source = ""
+        # the output of every complete block
+        self.blocks: list[str] = []
+        # the end of the source of every complete block
+        self.ends: list[int] = []
+
+    def _complete(self, text: str, block_start: int, block_end: int, next_start: int):
+        block = text[block_start:block_end]
+        if block.strip():
+            self.blocks.append(escape(block))
+            self.ends.append(next_start)
+        self.source = text[:next_start]
+
+    def _complete_blocks(self, text: str):
+        block_start = len(self.source)
+        # end of the block before a blank line, until the next line shows
+        # whether the block goes on, e.g. an indented part of a list item
+        block_end = None
+        fence = None
+        pos = block_start
+        while pos < len(text):
+            end = text.find("\n", pos)
+            if end < 0:
+                end = len(text)
+
+            line = text[pos:end]
+            if fence is None and block_end is None and not line.strip():
+                if end < len(text):
+                    block_end = pos
+            elif fence is None and block_end is not None and line.strip():
+                if line[0] not in " \t":
+                    self._complete(text, block_start, block_end, pos)
+                    block_start = pos
+                block_end = None
+
+            marker = line.lstrip()[:3]
+            if fence is None and marker in FENCES:
+                fence = marker
+            elif fence is not None and marker == fence:
+                fence = None
+
+            pos = end + 1
+
+    def render(self, text: str) -> str:
+        if not text.startswith(self.source):
+            self.source = ""
+            self.blocks = []
+            self.ends = []
+
+        self._complete_blocks(text)
+        parts = list(self.blocks)
+        tail = text[len(self.source) :]
+        if tail.strip():
+            parts.append(escape(close_open_constructs(tail)))
+
+        return "\n".join(parts)
+
+
+def _last_fitting(positions, fits) -> int:
+    """the last of the ascending positions that fits, 0 if none does"""
+    found = 0
+    low, high = 0, len(positions) - 1
+    while low <= high:
+        middle = (low + high) // 2
+        if fits(positions[middle]):
+            found = positions[middle]
+            low = middle + 1
+        else:
+            high = middle - 1
+
+    return found
+
+
+def find_split(text: str, limit: int, start: int = 0) -> int:
+    """
+    the length of the longest prefix of text, longer than start, that renders
+    to at most limit characters. The prefix ends after a complete block if
+    there is one that fits, otherwise after a line, and only a single huge
+    line is cut anywhere.
+    """
+    markdown = StreamingMarkdown()
+    markdown.render(text)
+    length = -1
+    cut = 0
+    for block, end in zip(markdown.blocks, markdown.ends):
+        length += len(block) + 1
+        if length > limit:
+            break
+        if end > start:
+            cut = end
+
+    if cut > 0:
+        return cut
+
+    def fits(pos: int) -> bool:
+        return len(escape(close_open_constructs(text[:pos]))) <= limit
+
+    lines = [i + 1 for i, c in enumerate(text) if c == "\n" and i + 1 > start]
+    cut = _last_fitting(lines, fits)
+    if cut > 0:
+        return cut
+
+    return max(start + 1, _last_fitting(range(start + 1, len(text) + 1), fits))
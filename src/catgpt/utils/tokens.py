@@ -0,0 +1,60 @@
+import math
+
+from ..storage import types
+from ..types import MessageType
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# every message costs a few tokens for its role and separators
+MESSAGE_OVERHEAD = 4
+# a photo is counted as a high detail 512x512 image
+PHOTO_TOKENS = 765
+# without a tokenizer: ~4 latin characters per token, one token per CJK character
+CHARS_PER_TOKEN = 4
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding, tiktoken
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # the encoding file is fetched on first use, fall back to the estimator
+            print(f"tiktoken unavailable, estimating tokens: {e}")
+            tiktoken = None
+
+    return _encoding
+
+
+def estimate_tokens(text: str) -> int:
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return math.ceil(ascii_chars / CHARS_PER_TOKEN) + (len(text) - ascii_chars)
+
+
+def count_tokens(text: str | None) -> int:
+    if not text:
+        return 0
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    return estimate_tokens(text)
+
+
+def count_message_tokens(message: types.Message) -> int:
+    """count the tokens of a message once, the result is kept in message.tokens"""
+    if message.tokens:
+        return message.tokens
+
+    tokens = MESSAGE_OVERHEAD + count_tokens(message.content)
+    if message.message_type == MessageType.PHOTO.value:
+        tokens += PHOTO_TOKENS
+
+    message.tokens = tokens
+    return tokens
@@ -0,0 +1,179 @@
+import time
+import unittest
+
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase
+from pathlib import Path
+
+from catgpt.storage.sqlite3_session_storage import (
+    Sqlite3Datasource,
+    Sqlite3TopicStorage,
+)
+import catgpt.storage as storage
+from catgpt.storage import types
+from catgpt.commands import chat
+from catgpt.gateway import TelegramGateway
+from catgpt.topic import Topic
+from catgpt.types import Endpoint, Preview
+from catgpt.timing import TurnTimer
+from catgpt.turns import TurnQueue
+
+
+def new_message(message_id: int, text: str, content_type: str = "text"):
+    return SimpleNamespace(
+        content_type=content_type,
+        text=text,
+        caption=None,
+        message_id=message_id,
+        message_thread_id=None,
+        date=int(time.time()),
+        chat=SimpleNamespace(id=1, type="private"),
+        from_user=SimpleNamespace(id=3),
+    )
+
+
+class FakeBot:
+    def __init__(self):
+        self.edits = []
+
+    async def reply_to(self, message, text, **kwargs):
+        return SimpleNamespace(
+            chat=message.chat, message_id=message.message_id + 1, date=message.date
+        )
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+class FakeStream:
+    def __init__(self, chunks: list[dict], cached: bool = False):
+        self.chunks = iter(chunks)
+        self.cached = cached
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def aclose(self):
+        pass
+
+
+class FakeRouter:
+    def __init__(self, endpoint: Endpoint, chunks: list[dict], cached: bool):
+        self.endpoint = endpoint
+        self.chunks = chunks
+        self.cached = cached
+        self.bodies = []
+        self.turns = 0
+
+    async def open_stream(self, endpoint, model, body, uid=0):
+        self.bodies.append(body)
+        return self.endpoint, FakeStream(self.chunks, self.cached)
+
+    def record_turn(self, endpoint, timer):
+        self.turns += 1
+
+
+class TestChat(IsolatedAsyncioTestCase):
+    def setUp(self):
+        schema_file = (
+            Path(__file__)
+            .parent.parent.joinpath("src/catgpt/data")
+            .joinpath("session_schema.sql")
+        )
+        storage.datasource = Sqlite3Datasource(
+            "file::memory:?cache=shared", schema_file
+        )
+        self.endpoint = Endpoint("a", "http://127.0.0.1:9/v1", "secret", ["gpt-4o"])
+        self.saved = {
+            name: getattr(chat, name)
+            for name in (
+                "config",
+                "topic",
+                "gateway",
+                "router",
+                "titles",
+                "turns",
+                "segmentation",
+            )
+        }
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(chat, name, value)
+        storage.datasource.close()
+
+    async def turn(self, message, message_text: str, chunks: list[dict], cached=False):
+        """answer message with a provider replying chunks, the stored topic"""
+        chat.topic = Topic(Sqlite3TopicStorage())
+        chat.config = SimpleNamespace(
+            get_endpoint=lambda name: self.endpoint, topic_preview=Preview.INTERNAL
+        )
+        chat.gateway = TelegramGateway(FakeBot())
+        chat.router = FakeRouter(self.endpoint, chunks, cached)
+
+        convo = await chat.topic.new_topic(
+            "title", message.chat.id, message.from_user.id, [], False, 0
+        )
+        profile = types.Profile(3, "gpt-4o", "a", "", 0, 1, 0, convo.tid, None, None)
+        context = types.ChatContext(None, profile, convo)
+        await chat.answer_message(
+            message, FakeBot(), context, message_text, TurnTimer()
+        )
+        return await chat.topic.get_topic(convo.tid, fetch_messages=True)
+
+    async def test_document_turn(self):
+        message = new_message(10, "a, b\n1, 2\n\nsum the columns", "document")
+        message.caption = "sum the columns"
+        chunks = [{"content": "3", "finished": "stop"}]
+        convo = await self.turn(message, message.text, chunks)
+
+        # the document is sent and stored as text, not as media
+        prompt = chat.router.bodies[0]["messages"][-1]
+        self.assertTrue(prompt.content == message.text)
+        question, answer = convo.messages
+        self.assertTrue(question.content == message.text and question.message_type == 0)
+        self.assertTrue(question.media_url is None)
+        self.assertTrue(answer.content == "3")
+        self.assertTrue(chat.router.turns == 1)
+
+    async def test_cached_turn(self):
+        message = new_message(11, "hi")
+        chunks = [{"content": "hello", "finished": "stop"}]
+        convo = await self.turn(message, message.text, chunks, cached=True)
+
+        # a replayed response isn't counted in the time to first token
+        self.assertTrue(convo.messages[-1].content == "hello")
+        self.assertTrue(chat.router.turns == 0)
+
+    async def test_duplicate_delivery(self):
+        chat.turns = TurnQueue()
+        chat.segmentation = chat.SegmentationHandler()
+        handled = []
+
+        async def handle(message, bot):
+            handled.append(message.text)
+
+        handler = chat.message_check(handle)
+        for message_id, text in [
+            (1, "hi"),
+            (1, "hi"),
+            (2, "===segstart a"),
+            (3, "b"),
+            (3, "b"),
+            (4, "===segend"),
+        ]:
+            await handler(new_message(message_id, text), None)
+
+        # a redelivered update is neither answered nor added to a segment
+        self.assertTrue(handled == ["hi", "a\nb"])
+        self.assertTrue(chat.turns.get_metrics()["duplicates"] == 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
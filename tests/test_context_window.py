@@ -0,0 +1,50 @@
+import unittest
+
+from catgpt import context_window
+from catgpt.storage import types
+from catgpt.utils.tokens import count_message_tokens, estimate_tokens
+
+
+def new_message(role: str, content: str, message_id: int = 0) -> types.Message:
+    return types.Message(
+        role=role, content=content, message_id=message_id, chat_id=1, topic_id=1, ts=0
+    )
+
+
+class TestContextWindow(unittest.TestCase):
+
+    def test_estimate_tokens(self):
+        self.assertTrue(estimate_tokens("abcdefgh") == 2)
+        self.assertTrue(estimate_tokens("你好") == 2)
+
+    def test_count_is_cached(self):
+        message = new_message("user", "hello world")
+        tokens = count_message_tokens(message)
+        self.assertTrue(tokens > 0 and message.tokens == tokens)
+
+        message.content = "changed" * 100
+        self.assertTrue(count_message_tokens(message) == tokens)
+
+    def test_keep_system_and_recent_turns(self):
+        messages = [new_message("system", "be nice")]
+        for i in range(10):
+            messages.append(new_message("user", "question " * 50, i))
+            messages.append(new_message("assistant", "answer " * 50, i))
+        messages.append(new_message("user", "last", 10))
+
+        budget = sum(count_message_tokens(m) for m in messages[-5:]) + 10
+        window = context_window.build(messages, budget)
+
+        self.assertTrue(window[0].role == "system")
+        self.assertTrue(window[1].role == "user")
+        self.assertTrue(window[-1].content == "last")
+        self.assertTrue(len(window) < len(messages))
+
+    def test_latest_message_always_kept(self):
+        messages = [new_message("user", "x" * 1000)]
+        window = context_window.build(messages, 1)
+        self.assertTrue(len(window) == 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
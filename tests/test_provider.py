@@ -0,0 +1,368 @@
+import asyncio
+import copy
+import time
+
+from unittest import IsolatedAsyncioTestCase, skipIf
+
+from catgpt import provider, router, titles, turns
+from catgpt.limiter import ConcurrencyLimiter, EndpointBusy
+from catgpt.timing import TurnTimer
+from catgpt.provider import oai
+from catgpt.provider.payload import PayloadCache
+from catgpt.response_cache import CachedStream
+from catgpt.storage import types
+from catgpt.types import Configuration, Endpoint
+
+try:
+    from catgpt.provider import gemini
+except ImportError:
+    gemini = None
+
+
+def new_endpoint(name: str, api_url: str = "http://127.0.0.1:9/v1", **kwargs):
+    return Endpoint(name, api_url, "secret", ["gpt-4o"], **kwargs)
+
+
+class TestProvider(IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await provider.close()
+
+    async def test_client_is_shared_per_endpoint(self):
+        endpoint = new_endpoint("a", http={"max_connections": 4, "timeout": 30})
+        client = oai.get_client(endpoint)
+        self.assertTrue(oai.get_client(endpoint) is client)
+        self.assertTrue(oai.get_client(new_endpoint("b")) is not client)
+        self.assertTrue(client.timeout.read == 30)
+
+        # an endpoint that can't be reached doesn't stop the bot from starting
+        await provider.warm_up([endpoint])
+        await provider.close()
+        self.assertTrue(client.is_closed())
+        self.assertTrue(oai.get_client(endpoint) is not client)
+
+    @skipIf(gemini is None, "google-generativeai isn't installed")
+    async def test_gemini_payload_is_converted_once(self):
+        photo = types.Message("user", "look", 1, 1, 1, 0, message_type=1)
+        photo.media_url = "media://abc"
+        photo.media_data = b"jpeg"
+        answer = types.Message("assistant", "a cat", 2, 1, 1, 0)
+
+        payloads = PayloadCache()
+        contents = payloads.build(gemini, "gemini", 1, [photo, answer])
+        self.assertTrue(contents[0]["parts"][0]["data"] == b"jpeg")
+        self.assertTrue(contents[1] == {"role": "model", "parts": [{"text": "a cat"}]})
+
+        # a later turn reuses the entries, even without the photo loaded
+        photo.media_data = None
+        again = payloads.build(gemini, "gemini", 1, [photo, answer])
+        self.assertTrue(again[0] is contents[0] and again[1] is contents[1])
+
+        endpoint = new_endpoint("g", provider="gemini")
+        model = gemini.get_model(endpoint, {"model": "gemini-1.5-flash"})
+        self.assertTrue(
+            gemini.get_model(endpoint, {"model": "gemini-1.5-flash"}) is model
+        )
+
+    async def test_dangling_media_ref(self):
+        # the media row of both photos is gone
+        photo = types.Message("user", "look", 1, 1, 1, 0, message_type=1)
+        photo.media_url = "media:abc"
+        bare = types.Message("user", "", 2, 1, 1, 0, message_type=1)
+        bare.media_url = "media:def"
+
+        payload = oai.message2payload([photo, bare])
+        self.assertTrue(payload == [{"role": "user", "content": "look"}])
+        if gemini is not None:
+            contents = gemini.message2payload([photo, bare])
+            self.assertTrue(contents == [{"role": "user", "parts": [{"text": "look"}]}])
+
+    async def test_payload_cache_converts_new_messages(self):
+        payloads = PayloadCache()
+        messages = [types.Message("user", f"q{i}", i, 1, 1, 0) for i in range(1, 4)]
+
+        first = payloads.build(oai, "openai", 1, messages)
+        self.assertTrue(first == oai.message2payload(messages))
+
+        reply = types.Message("assistant", "a", 4, 1, 1, 0)
+        second = payloads.build(oai, "openai", 1, messages + [reply])
+        self.assertTrue(second[:3] == first and second[0] is first[0])
+        self.assertTrue(payloads.converted == 4 and payloads.reused == 3)
+
+        # a revoked message is dropped, an edited one converted again
+        edited = types.Message("user", "changed", 2, 1, 1, 0)
+        third = payloads.build(oai, "openai", 1, [messages[0], edited])
+        self.assertTrue(third[1]["content"] == "changed")
+        self.assertTrue(len(payloads.topics.peek(1).entries) == 2)
+
+        payloads.invalidate(1)
+        self.assertTrue(payloads.get_missing("openai", 1, messages) == messages)
+
+
+class TestRouter(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.ask_stream = provider.ask_stream
+        self.get_cached_stream = provider.get_cached_stream
+        self.delays = {}
+
+        async def fake_stream(endpoint, delay):
+            if delay is None:
+                raise ConnectionError(endpoint.name)
+            await asyncio.sleep(delay)
+            yield {"content": endpoint.name}
+
+        async def ask_stream(endpoint, body):
+            return fake_stream(endpoint, self.delays[endpoint.name])
+
+        provider.ask_stream = ask_stream
+
+    def tearDown(self):
+        provider.ask_stream = self.ask_stream
+        provider.get_cached_stream = self.get_cached_stream
+
+    async def test_fastest_healthy_endpoint(self):
+        config = Configuration()
+        config.endpoints = [new_endpoint(name) for name in ("a", "b", "c")]
+        config.endpoints.append(
+            Endpoint("d", "http://127.0.0.1:9/v1", "secret", ["other"])
+        )
+        a, b, c, d = config.endpoints
+        r = router.Router(config, first_token_timeout=0.1, max_failures=1)
+
+        # a is down, b too slow, the request fails over to c
+        self.delays = {"a": None, "b": 1, "c": 0.01}
+        endpoint, stream = await r.open_stream(a, "gpt-4o", {"messages": []})
+        self.assertTrue(endpoint is c)
+        self.assertTrue([chunk async for chunk in stream] == [{"content": "c"}])
+        self.assertTrue(r.get_candidates(a, "gpt-4o")[0] is c)
+        self.assertTrue(d not in r.get_candidates(a, "gpt-4o"))
+
+        metrics = r.get_metrics()
+        self.assertTrue(not metrics["a"]["healthy"] and metrics["a"]["failovers"] == 1)
+        self.assertTrue(metrics["c"]["error_rate"] == 0 and metrics["c"]["requests"])
+
+        self.delays = {"a": None, "b": None, "c": None}
+        with self.assertRaises(ConnectionError):
+            await r.open_stream(a, "gpt-4o", {"messages": []})
+
+    async def test_first_token_retry_and_stall(self):
+        config = Configuration()
+        config.endpoints = [new_endpoint("a", timeouts={"stall": 0.05})]
+        a = config.endpoints[0]
+        r = router.Router(config, first_token_timeout=0.05, max_failures=5)
+        delays = [1, 0.01]
+
+        async def stalling_stream(delay):
+            await asyncio.sleep(delay)
+            yield {"content": "partial"}
+            await asyncio.sleep(1)
+            yield {"content": "never"}
+
+        async def ask_stream(endpoint, body):
+            return stalling_stream(delays.pop(0))
+
+        provider.ask_stream = ask_stream
+        # the first attempt misses the first token deadline and is retried
+        endpoint, stream = await r.open_stream(a, "gpt-4o", {"messages": []})
+        chunks = [chunk["content"] async for chunk in stream]
+        self.assertTrue(chunks == ["partial", router.STALL_MARKER])
+
+        metrics = r.get_metrics()["a"]
+        self.assertTrue(metrics["first_token_timeouts"] == 1)
+        self.assertTrue(metrics["retries"] == 1 and metrics["stalls"] == 1)
+        self.assertTrue(metrics["active"] == 0)
+
+    async def test_cancelled_open_closes_stream(self):
+        config = Configuration()
+        config.endpoints = [new_endpoint("a")]
+        a = config.endpoints[0]
+        r = router.Router(config)
+        closed = []
+
+        class SlowStream:
+            """a provider stream whose connection is closed by aclose only"""
+
+            async def __anext__(self):
+                await asyncio.sleep(1)
+                return {"content": "late"}
+
+            async def aclose(self):
+                closed.append(True)
+
+        async def ask_stream(endpoint, body):
+            return SlowStream()
+
+        provider.ask_stream = ask_stream
+        opening = asyncio.create_task(r.open_stream(a, "gpt-4o", {"messages": []}))
+        await asyncio.sleep(0.01)
+        opening.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await opening
+
+        self.assertTrue(closed == [True] and r.get_limiter(a).active == 0)
+
+    async def test_cache_hit_takes_no_slot(self):
+        config = Configuration()
+        config.endpoints = [new_endpoint("a", limits={"max_concurrency": 1})]
+        a = config.endpoints[0]
+        r = router.Router(config)
+        response = types.CachedResponse("key", "hello", "", 5, int(time.time()))
+
+        async def get_cached_stream(endpoint, body):
+            return CachedStream(response)
+
+        provider.get_cached_stream = get_cached_stream
+        limiter = r.get_limiter(a)
+        await limiter.acquire(1)
+        # the endpoint is busy, the cached response is replayed anyway
+        endpoint, stream = await asyncio.wait_for(
+            r.open_stream(a, "gpt-4o", {"messages": []}), 0.1
+        )
+        self.assertTrue(stream.cached)
+        self.assertTrue([chunk["content"] async for chunk in stream] == ["hello"])
+        self.assertTrue(limiter.active == 1 and r.get_metrics()["a"]["requests"] == 0)
+
+    async def test_limiter_takes_turns_and_sheds(self):
+        limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=3, max_wait=0.2)
+        await limiter.acquire(1)
+        order = []
+
+        async def request(uid: int):
+            await limiter.acquire(uid)
+            order.append(uid)
+            limiter.release()
+
+        # user 1 queued two requests before user 2, they still alternate
+        tasks = [asyncio.create_task(request(uid)) for uid in (1, 1, 2)]
+        await asyncio.sleep(0)
+        with self.assertRaises(EndpointBusy):
+            await limiter.acquire(3)
+
+        limiter.release()
+        await asyncio.gather(*tasks)
+        self.assertTrue(order == [1, 2, 1])
+        self.assertTrue(limiter.active == 0 and limiter.queued == 0)
+
+        await limiter.acquire(1)
+        with self.assertRaises(EndpointBusy):
+            await limiter.acquire(2)
+        metrics = limiter.get_metrics()
+        self.assertTrue(metrics["rejected"] == 1 and metrics["timeouts"] == 1)
+        self.assertTrue(limiter.queued == 0)
+
+    async def test_turn_timings(self):
+        config = Configuration()
+        config.endpoints = [new_endpoint("a")]
+        r = router.Router(config)
+        timer = TurnTimer(time.monotonic() - 0.01)
+        timer.stages["context"] = 0.01
+        with timer.stage("prompt"):
+            await asyncio.sleep(0.01)
+        placeholder = asyncio.create_task(timer.timed("placeholder", asyncio.sleep(0)))
+        await placeholder
+
+        r.record_turn(config.endpoints[0], timer)
+        metrics = r.get_metrics()["a"]
+        self.assertTrue(set(metrics["stages"]) == {"context", "prompt", "placeholder"})
+        self.assertTrue(metrics["turn_ttft_p99_ms"] >= 20)
+
+
+class FakeTopic:
+    def __init__(self, convo: types.Topic):
+        self.topics = {convo.tid: convo}
+        self.updated = []
+
+    async def get_topic(self, topic_id: int):
+        return copy.copy(self.topics.get(topic_id))
+
+    async def update_topic(self, convo):
+        self.topics[convo.tid] = convo
+        self.updated.append(convo.title)
+
+
+class TestTitleQueue(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.ask = provider.ask
+        self.asked = []
+        self.failures = 1
+
+        async def ask(endpoint, body):
+            self.asked.append(body["messages"])
+            if self.failures > 0:
+                self.failures -= 1
+                raise ConnectionError(endpoint.name)
+            return " title "
+
+        provider.ask = ask
+
+    def tearDown(self):
+        provider.ask = self.ask
+
+    async def generate(self, queue: titles.TitleQueue, convo: types.Topic):
+        messages = [
+            types.Message("system", "prompt", 0, 1, 1, 0),
+            types.Message("user", "first question", 1, 1, 1, 0),
+            types.Message("assistant", "first answer", 2, 1, 1, 0),
+            types.Message("user", "second question", 3, 1, 1, 0),
+        ]
+        queue.submit(convo, new_endpoint("a"), messages, "second answer")
+        queue.submit(convo, new_endpoint("a"), messages, "second answer")
+
+        for _ in range(50):
+            if not queue.pending:
+                break
+            await asyncio.sleep(0.01)
+        await queue.close()
+
+    async def test_first_exchange_with_retry(self):
+        topic = FakeTopic(types.Topic(1, "1", 1, 1, "", True, 0))
+        queue = titles.TitleQueue(topic, concurrency=1, backoff=0.01, max_chars=5)
+        await self.generate(queue, types.Topic(1, "1", 1, 1, "", True, 0))
+
+        self.assertTrue(topic.updated == ["title"])
+        self.assertTrue(not topic.topics[1].generate_title)
+        self.assertTrue(len(self.asked) == 2)
+        question, answer, _ = [m.content for m in self.asked[0]]
+        self.assertTrue(question == "first" and answer == "first")
+        metrics = queue.get_metrics()
+        self.assertTrue(metrics["retries"] == 1 and metrics["pending"] == 0)
+
+    async def test_cleared_topic_keeps_generate_title(self):
+        # the topic was cleared while the job waited for its retry
+        topic = FakeTopic(types.Topic(1, "2", 1, 1, "", True, 0))
+        queue = titles.TitleQueue(topic, concurrency=1, backoff=0.01)
+        await self.generate(queue, types.Topic(1, "1", 1, 1, "old", True, 0))
+
+        self.assertTrue(not topic.updated and topic.topics[1].generate_title)
+        self.assertTrue(queue.get_metrics()["stale"] == 1)
+
+
+class TestTurnQueue(IsolatedAsyncioTestCase):
+    async def run_turns(self, queue: turns.TurnQueue, message_ids: list[int]):
+        answered = []
+
+        async def turn(message_id: int):
+            async def answer(waited: bool):
+                await asyncio.sleep(0.01)
+                answered.append((message_id, waited))
+
+            if not queue.is_duplicate((1, message_id)):
+                await queue.run((1, 0, 1), answer)
+
+        tasks = []
+        for message_id in message_ids:
+            tasks.append(asyncio.create_task(turn(message_id)))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return answered
+
+    async def test_queue_in_order_without_duplicates(self):
+        queue = turns.TurnQueue()
+        answered = await self.run_turns(queue, [1, 2, 2, 3])
+        self.assertTrue(answered == [(1, False), (2, True), (3, True)])
+        self.assertTrue(queue.get_metrics()["duplicates"] == 1 and not queue.lanes)
+
+    async def test_latest_wins(self):
+        queue = turns.TurnQueue("latest")
+        answered = await self.run_turns(queue, [1, 2, 3, 4])
+        self.assertTrue(answered == [(1, False), (4, True)])
+        self.assertTrue(queue.get_metrics()["superseded"] == 2)
@@ -3,6 +3,7 @@ import asyncio
 import time
 import os
 
+from types import SimpleNamespace
 from unittest import IsolatedAsyncioTestCase
 from pathlib import Path
 
@@ -10,14 +11,29 @@ from catgpt.storage.sqlite3_session_storage import (
     Sqlite3Datasource,
     Sqlite3TopicStorage,
     Sqlite3ProfileStorage,
+    Sqlite3MediaStorage,
+    Sqlite3UserStorage,
+    Sqlite3ChatContextStorage,
+    Sqlite3ResponseCacheStorage,
+    migrate_inline_media,
 )
 import catgpt.storage as storage
+from catgpt.storage import tx
+from catgpt.storage.tx import context
 from catgpt.storage import types
+from catgpt.storage.write_behind import WriteBehindQueue
 from catgpt.topic import Topic
-from catgpt.user_profile import UserProfile
+from catgpt.media import MediaStore
+from catgpt.response_cache import ResponseCache, CachedStream, make_key
+from catgpt.types import Endpoint
+from catgpt.utils.cache import LRUCache
+from catgpt.user_profile import UserProfile, Users
+from catgpt.chat_context import ChatContexts
+from catgpt.commands import new_convo
 
 
 class TestService(IsolatedAsyncioTestCase):
+    threaded = False
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
@@ -33,7 +49,7 @@ class TestService(IsolatedAsyncioTestCase):
             .parent.parent.joinpath("src/catgpt/data")
             .joinpath("session_schema.sql")
         )
-        datasource = Sqlite3Datasource(db_file, schema_file)
+        datasource = Sqlite3Datasource(db_file, schema_file, threaded=self.threaded)
         storage.datasource = datasource
 
         topic_storage = Sqlite3TopicStorage()
@@ -84,6 +100,9 @@ class TestService(IsolatedAsyncioTestCase):
 
         asyncio.run(init_data())
 
+    def tearDown(self):
+        storage.datasource.close()
+
     async def test_new_topic(self):
         record = await self.topic.new_topic(
             title="test", chat_id=1, user_id=3, messages=[], generate_title=True
@@ -99,6 +118,163 @@ class TestService(IsolatedAsyncioTestCase):
         topics = await self.topic.list_topics(3, 1, 0)
         self.assertTrue(len(topics) >= 1)
 
+    async def test_projections(self):
+        tid = self.internal_tid
+        messages = await self.topic.get_last_messages(tid, 1)
+        self.assertTrue(len(messages) == 1 and messages[0].role == "assistant")
+
+        messages = await self.topic.get_last_messages(tid, 10, chat_id=2)
+        self.assertTrue(len(messages) == 0)
+
+        self.assertTrue(await self.topic.get_message_ids(tid) == [1, 1])
+        counts = await self.topic.count_messages([tid, tid + 1000])
+        self.assertTrue(counts == {tid: 2, tid + 1000: 0})
+
+        topics = await self.topic.list_topics(3, 1, 0, fetch_messages=False)
+        self.assertTrue(len(topics) >= 1 and topics[0].messages == [])
+
+    async def test_update_tokens(self):
+        tid = self.internal_tid
+        messages = await self.topic.get_messages([tid])
+        self.assertTrue(all(m.tokens == 0 and m.topic_id == tid for m in messages))
+
+        for m in messages:
+            m.tokens = 42
+        await self.topic.update_tokens(tid, messages)
+
+        messages = await self.topic.get_messages([tid])
+        self.assertTrue(all(m.tokens == 42 for m in messages))
+
+    async def test_topic_cache(self):
+        cache = LRUCache(max_size=10, max_bytes=1024 * 1024)
+        topic = Topic(self.topic.storage, cache=cache)
+        tid = self.internal_tid
+
+        convo = await topic.get_topic(tid, fetch_messages=True)
+        convo = await topic.get_topic(tid, fetch_messages=True)
+        self.assertTrue(cache.hits == 1 and cache.misses == 1)
+        self.assertTrue(len(convo.messages) == 2)
+
+        chat = SimpleNamespace(id=1)
+        user_message = SimpleNamespace(
+            content_type="text", text="Again", message_id=5, chat=chat, date=10
+        )
+        reply = SimpleNamespace(text="Sure", message_id=6, chat=chat, date=10)
+        await topic.append_messages(tid, user_message, reply, "")
+        messages = await topic.get_messages([tid])
+        self.assertTrue([m.content for m in messages][-2:] == ["Again", "Sure"])
+
+        await topic.remove_messages(tid, [6])
+        self.assertTrue(await topic.get_message_ids(tid) == [1, 1, 5])
+
+        convo.title = "cached"
+        await topic.update_topic(convo)
+        self.assertTrue((await topic.get_topic(tid)).title == "cached")
+
+        # the cache always matches the database
+        stored = await self.topic.get_topic(tid, fetch_messages=True)
+        cached = await topic.get_topic(tid, fetch_messages=True)
+        self.assertTrue(stored.title == cached.title)
+        self.assertTrue(
+            [m.message_id for m in stored.messages]
+            == [m.message_id for m in cached.messages]
+        )
+
+        await topic.remove_topic(tid)
+        self.assertTrue(await topic.get_topic(tid) is None)
+
+    async def test_profile_cache(self):
+        profile = await self.profile.create(
+            uid=3,
+            model="gpt-4o",
+            endpoint="openai",
+            prompt="",
+            chat_type=0,
+            chat_id=1,
+            thread_id=None,
+            topic_id=self.internal_tid,
+        )
+        self.assertTrue(await self.profile.has_profile(3, 1, None))
+        cached = await self.profile.load(3, 1, 0)
+        self.assertTrue(self.profile.cache.hits == 1 and cached.model == profile.model)
+
+        # changes to a loaded profile don't leak into the cache
+        cached.model = "changed"
+        self.assertTrue((await self.profile.load(3, 1, 0)).model == "gpt-4o")
+
+        await self.profile.update_model(3, 1, 0, "gpt-4o-mini")
+        self.assertTrue(self.profile.cache.peek("3-1-0").model == "gpt-4o-mini")
+        data = await self.profile.load(3, 1, 0)
+        self.assertTrue(data.model == "gpt-4o-mini")
+
+    async def test_load_during_write(self):
+        await self.profile.create(3, "gpt-4o", "openai", "", 0, 1, None, 1)
+        storage = self.profile.storage
+        update, get_profile = storage.update, storage.get_profile
+
+        async def slow_update(*args):
+            await asyncio.sleep(0.02)
+            await update(*args)
+
+        async def slow_get_profile(*args):
+            profile = await get_profile(*args)
+            await asyncio.sleep(0.04)
+            return profile
+
+        # a load that reads the old row while the write is pending
+        storage.update = slow_update
+        saving = asyncio.create_task(self.profile.update_model(3, 1, 0, "a"))
+        await asyncio.sleep(0.01)
+        self.assertTrue((await self.profile.load(3, 1, 0)).model == "gpt-4o")
+        await saving
+        self.assertTrue((await self.profile.load(3, 1, 0)).model == "a")
+
+        # a load that started before the write and finished after it
+        storage.update = update
+        storage.get_profile = slow_get_profile
+        self.profile.invalidate(3, 1, 0)
+        loading = asyncio.create_task(self.profile.load(3, 1, 0))
+        await asyncio.sleep(0.01)
+        await self.profile.update_model(3, 1, 0, "b")
+        self.assertTrue((await loading).model == "a")
+        self.assertTrue((await self.profile.load(3, 1, 0)).model == "b")
+
+    async def test_chat_context(self):
+        tid = self.internal_tid
+        users = Users(Sqlite3UserStorage())
+        contexts = ChatContexts(
+            Sqlite3ChatContextStorage(), users, self.profile, self.topic
+        )
+
+        context = await contexts.load(3, 1, None)
+        self.assertTrue(context.user is None and context.profile is None)
+
+        await users.create_user(3)
+        await self.profile.create(3, "gpt-4o", "openai", "", 0, 1, None, tid)
+        messages = await self.topic.get_messages([tid])
+        for m in messages:
+            m.tokens = 10
+        await self.topic.update_tokens(tid, messages)
+
+        # a tiny budget loads the latest message only
+        context = await contexts.load(3, 1, None, lambda profile: 1)
+        self.assertTrue(context.user.uid == 3 and context.profile.topic_id == tid)
+        self.assertTrue(context.has_messages and len(context.topic.messages) == 1)
+        self.assertTrue(context.topic.messages[0].role == "assistant")
+
+        context = await contexts.load(3, 1, 0, lambda profile: None)
+        self.assertFalse(context.has_messages)
+
+        # with a topic cache the whole topic is loaded and cached once
+        topic = Topic(self.topic.storage, cache=LRUCache())
+        contexts = ChatContexts(Sqlite3ChatContextStorage(), users, self.profile, topic)
+        context = await contexts.load(3, 1, 0, lambda profile: 1)
+        self.assertTrue(len(context.topic.messages) == 2)
+        hits = topic.cache.hits
+        context = await contexts.load(3, 1, 0, lambda profile: 1)
+        self.assertTrue(topic.cache.hits == hits + 1)
+        self.assertTrue(len(context.topic.messages) == 2)
+
     async def test_clear_topic(self):
         data = await self.topic.get_topic(self.internal_tid)
         self.assertTrue(data)
@@ -108,6 +284,191 @@ class TestService(IsolatedAsyncioTestCase):
 
         self.assertTrue(data and data.title == "new topic" and data.generate_title > 0)
 
+    async def test_connection_reuse(self):
+        datasource = storage.datasource
+        for _ in range(10):
+            await self.topic.get_messages([self.internal_tid])
+
+        metrics = datasource.get_metrics()
+        self.assertTrue(metrics["read_created"] == 1)
+        self.assertTrue(metrics["read"]["acquired"] >= 10)
+
+        await self.topic.new_topic(title="a", chat_id=1, user_id=3, messages=[])
+        await self.topic.new_topic(title="b", chat_id=1, user_id=3, messages=[])
+        self.assertTrue(datasource.write_pool.qsize() == 1)
+
+    async def test_cancelled_statement(self):
+        if not self.threaded:
+            return
+
+        finished = []
+
+        def slow_select(connection):
+            time.sleep(0.05)
+            connection.execute("select 1").fetchone()
+            finished.append(True)
+
+        @tx.transactional(tx_type="write")
+        async def run():
+            t = context.get()
+            await t.run(slow_select)
+
+        task = asyncio.create_task(run())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        # the connection went back to the pool once the statement was done
+        self.assertTrue(finished == [True])
+        self.assertTrue(storage.datasource.write_pool.qsize() == 1)
+
+    async def test_write_behind(self):
+        queue = WriteBehindQueue(interval_ms=60000, durability="buffered")
+        topic = Topic(self.topic.storage, queue)
+        tid = self.internal_tid
+
+        convo = await topic.get_topic(tid)
+        convo.title = "renamed"
+        await topic.update_topic(convo)
+        message = types.Message(
+            role="user", content="Hello", message_id=2, chat_id=1, topic_id=tid, ts=0
+        )
+        await queue.submit(f"topic:{tid}", topic.storage.append_message, tid, [message])
+        self.assertTrue(queue.has_pending(f"topic:{tid}"))
+
+        # reads of the same topic flush the pending batch first
+        messages = await topic.get_messages([tid])
+        self.assertTrue(len(messages) == 3)
+        data = await topic.get_topic(tid)
+        self.assertTrue(data.title == "renamed")
+        self.assertTrue(queue.batches == 1 and queue.writes == 2)
+
+        await topic.update_topic(data)
+        await queue.close()
+        self.assertFalse(queue.has_pending())
+
+    async def test_chat_context_write_behind(self):
+        tid = self.internal_tid
+        queue = WriteBehindQueue(interval_ms=60000, durability="buffered")
+        users = Users(Sqlite3UserStorage())
+        topic = Topic(self.topic.storage, queue)
+        contexts = ChatContexts(
+            Sqlite3ChatContextStorage(), users, self.profile, topic, queue
+        )
+        await users.create_user(3)
+        await self.profile.create(3, "gpt-4o", "openai", "", 0, 1, None, tid)
+
+        # writes of other topics stay in their batch
+        other = types.Message("user", "other", 2, 1, 999, 0)
+        await queue.submit("topic:999", topic.storage.append_message, 999, [other])
+        await contexts.load(3, 1, None, lambda profile: 0)
+        self.assertTrue(queue.batches == 0 and queue.has_pending())
+
+        message = types.Message("user", "Hello", 2, 1, tid, 0)
+        await queue.submit(f"topic:{tid}", topic.storage.append_message, tid, [message])
+        context = await contexts.load(3, 1, None, lambda profile: 0)
+        self.assertTrue(queue.batches == 1 and not queue.has_pending())
+        self.assertTrue(context.topic.messages[-1].content == "Hello")
+        await queue.close()
+
+    async def test_new_topic_write_behind(self):
+        tid = self.internal_tid
+        queue = WriteBehindQueue(interval_ms=60000)
+        topic = Topic(self.topic.storage, queue)
+        profiles = UserProfile(self.profile.storage, Path("presets.json"), queue)
+        await profiles.create(3, "gpt-4o", "openai", "", 0, 1, None, tid)
+        saved = new_convo.topic, new_convo.profiles
+        new_convo.topic, new_convo.profiles = topic, profiles
+        try:
+            # a pending write of the profile goes before the one of /new
+            profile = await profiles.load(3, 1, None)
+            profile.model = "gpt-4o-mini"
+            writing = asyncio.create_task(profiles.update(3, 1, None, profile))
+            await asyncio.sleep(0)
+            self.assertTrue(queue.has_pending("profile:3-1-0"))
+
+            # the writes of the profile join the transaction of /new
+            convo = await asyncio.wait_for(
+                new_convo.create_topic_and_update_profile(1, 3, "private", None, "t"),
+                1,
+            )
+            await writing
+        finally:
+            new_convo.topic, new_convo.profiles = saved
+
+        profile = await self.profile.get_profile(3, 1, None)
+        self.assertTrue(profile.topic_id == convo.tid and convo.tid != tid)
+        self.assertTrue(profile.model == "gpt-4o-mini")
+        self.assertTrue(queue.batches == 0 and not queue.has_pending())
+        await queue.close()
+
+    async def test_media(self):
+        media = MediaStore(Sqlite3MediaStorage())
+        tid = self.internal_tid
+        ref = await media.save(b"\x89PNG fake image")
+        self.assertTrue(ref == await media.save(b"\x89PNG fake image"))
+
+        message = types.Message("user", "a, b", 3, 1, tid, 0, message_type=1)
+        message.media_url = ref
+        await self.topic.storage.append_message(tid, [message])
+
+        stored = (await self.topic.get_messages([tid]))[-1]
+        self.assertTrue(stored.media_url == ref and stored.content == "a, b")
+        await media.resolve([stored])
+        self.assertTrue(stored.media_data == b"\x89PNG fake image")
+
+    async def test_response_cache(self):
+        responses = ResponseCache(
+            Sqlite3ResponseCacheStorage(), max_entries=2, evict_every=1
+        )
+        endpoint = Endpoint("a", "http://127.0.0.1:9/v1", "secret", ["gpt-4o"])
+        payload = [{"role": "user", "parts": [{"data": b"\x89PNG"}, {"text": "hi"}]}]
+        key = make_key(endpoint, "gpt-4o", {"temperature": 0.6}, payload, "stream")
+        self.assertTrue(key != make_key(endpoint, "gpt-4o", {}, payload, "stream"))
+        # a request without a model goes to the default one
+        options = {"temperature": 0.6}
+        self.assertTrue(key == make_key(endpoint, None, options, payload, "stream"))
+
+        async def stream():
+            yield {"content": "think", "reasoning": "think"}
+            yield {"content": "hello", "reasoning": False}
+
+        chunks = [chunk async for chunk in responses.record(key, stream())]
+        self.assertTrue(len(chunks) == 2)
+        response = await responses.get(key)
+        self.assertTrue(response.content == "hello" and response.reasoning == "think")
+        replayed = [c["content"] async for c in CachedStream(response)]
+        self.assertTrue(replayed == ["think", "hello"])
+
+        await responses.put("b", "b")
+        await responses.put("c", "c")
+        responses.ttl = -1
+        self.assertTrue(await responses.get("c") is None)
+        metrics = responses.get_metrics()
+        self.assertTrue(metrics["hits"] == 1 and metrics["evicted"] == 1)
+
+    async def test_migrate_inline_media(self):
+        tid = self.internal_tid
+        message = types.Message("user", "caption", 4, 1, tid, 0, message_type=1)
+        message.media_url = "aW1hZ2UgZGF0YQ=="
+        await self.topic.storage.append_message(tid, [message])
+
+        conn = await storage.datasource.get_write_conn()
+        migrate_inline_media(conn.cursor())
+        conn.commit()
+        conn.close()
+
+        stored = (await self.topic.get_messages([tid]))[-1]
+        self.assertTrue(stored.media_url.startswith(types.MEDIA_SCHEME))
+        self.assertTrue(stored.content == "caption")
+        data = await MediaStore(Sqlite3MediaStorage()).load(stored.media_url)
+        self.assertTrue(data == b"image data")
+
+
+class TestThreadedService(TestService):
+    threaded = True
+
 
 if __name__ == "__main__":
     unittest.main()
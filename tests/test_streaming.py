@@ -0,0 +1,160 @@
+import asyncio
+import time
+
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase
+
+from catgpt import streaming
+from catgpt.streaming import StreamBuffer, ReplyRenderer, read_stream
+from catgpt.gateway import TelegramGateway, Priority
+from catgpt.utils.md2tgmd import escape, StreamingMarkdown
+from catgpt.utils.text import MAX_TEXT_LENGTH
+
+
+class SlowBot:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.edits = []
+        # message id -> the latest text
+        self.messages = {}
+
+    async def edit_message_text(self, text, **kwargs):
+        await asyncio.sleep(self.delay)
+        self.edits.append(text)
+        self.messages[kwargs.get("message_id")] = text
+        return text
+
+    async def send_message(self, chat_id, text, **kwargs):
+        message_id = 100 + len(self.messages)
+        self.messages[message_id] = text
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=message_id)
+
+
+async def provider_stream(chunks: list[dict], interval: float):
+    for chunk in chunks:
+        await asyncio.sleep(interval)
+        yield chunk
+
+
+class TestStreaming(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.interval = streaming.EDIT_INTERVAL
+        streaming.EDIT_INTERVAL = 0.05
+
+    def tearDown(self):
+        streaming.EDIT_INTERVAL = self.interval
+
+    async def test_buffer(self):
+        buffer = StreamBuffer()
+        buffer.append({"content": "think", "reasoning": True})
+        buffer.append({"content": ""})
+        buffer.append({"content": "answer"})
+        self.assertTrue(buffer.text == "think\n\n---\nanswer")
+        self.assertTrue(buffer.get_answer() == "answer")
+        self.assertTrue(buffer.reasoning == "think")
+
+    async def test_slow_edits_dont_block_the_stream(self):
+        chunks = [{"content": f"chunk {i:03d} "} for i in range(40)]
+        bot = SlowBot(delay=0.5)
+        reply_msg = SimpleNamespace(chat=SimpleNamespace(id=1), message_id=2)
+        buffer = StreamBuffer()
+        gateway = TelegramGateway(bot, private_rate=100)
+        renderer = ReplyRenderer(gateway, reply_msg, "")
+        renderer.last_edit = 0
+
+        rendering = asyncio.create_task(renderer.run(buffer))
+        start = time.perf_counter()
+        await read_stream(provider_stream(chunks, 0.005), buffer)
+        elapsed = time.perf_counter() - start
+        await rendering
+        await asyncio.gather(*gateway.inflight)
+
+        # the stream was read while the first edit was still in flight
+        self.assertTrue(elapsed < bot.delay)
+        self.assertTrue(buffer.text == "".join(c["content"] for c in chunks))
+        self.assertTrue(0 < len(bot.edits) < len(chunks))
+        self.assertTrue(buffer.text.startswith(renderer.text))
+
+    async def test_gateway_coalesces_edits(self):
+        bot = SlowBot(delay=0)
+        gateway = TelegramGateway(bot, private_rate=10, burst=1)
+        # spend the chat's budget, the following edits have to wait
+        await gateway.edit_message_text("first", 1, 2)
+
+        stale = gateway.submit_edit("stale", 1, 2, Priority.PROGRESS)
+        newer = gateway.submit_edit("newer", 1, 2, Priority.PROGRESS)
+        other = gateway.submit_edit("other", 1, 3, Priority.PROGRESS)
+        final = gateway.submit_edit("final", 1, 3, Priority.FINAL)
+        self.assertTrue(gateway.get_metrics()["queued"] == 2)
+
+        self.assertTrue(await stale is None and await other is None)
+        self.assertTrue(await final == "final")
+        await newer
+        # the final edit jumped the queue, the stale states were never sent
+        self.assertTrue(bot.edits == ["first", "final", "newer"])
+        self.assertTrue(gateway.get_metrics()["coalesced"] == 2)
+        await gateway.close()
+
+    async def test_final_edit_waits_for_edit_in_flight(self):
+        bot = SlowBot(delay=0.05)
+        gateway = TelegramGateway(bot, private_rate=1000, burst=1000)
+        progress = gateway.submit_edit("partial", 1, 2, Priority.PROGRESS)
+        await asyncio.sleep(0.01)
+        # the progress edit is in flight, a faster final edit must not overtake it
+        bot.delay = 0
+        other = gateway.submit_edit("other", 1, 3, Priority.NORMAL)
+        final = gateway.submit_edit("final", 1, 2, Priority.FINAL)
+
+        self.assertTrue(await other == "other")
+        self.assertTrue(await final == "final" and await progress == "partial")
+        self.assertTrue(bot.edits == ["other", "partial", "final"])
+        self.assertTrue(bot.messages[2] == "final" and not gateway.editing)
+        await gateway.close()
+
+    async def test_streaming_markdown(self):
+        text = (
+            "Hello **world**.\n\n1. one\n2. two\n\n"
+            "```python\nprint(1)\n\nprint(2)\n```\n\n- a\n\n  more of a\n\ndone."
+        )
+        markdown = StreamingMarkdown()
+        for i in range(1, len(text)):
+            markdown.render(text[:i])
+        self.assertTrue(markdown.render(text) == escape(text))
+        self.assertTrue(len(markdown.blocks) == 4)
+
+        # open constructs of the tail are closed
+        snapshot = StreamingMarkdown().render("a\n\n```python\nprint(1)")
+        self.assertTrue(snapshot.endswith("```\n") and snapshot.count("```") == 2)
+        self.assertTrue(StreamingMarkdown().render("use `pip") == escape("use `pip`"))
+
+    async def test_long_reply_continues_in_new_messages(self):
+        paragraph = "Some *markdown* text with `code` in it. " * 8 + "\n\n"
+        code = "```python\n" + "print('a line of code')\n" * 300 + "```\n\n"
+        text = paragraph * 20 + code + paragraph * 10
+        chunks = [{"content": text[i : i + 200]} for i in range(0, len(text), 200)]
+        bot = SlowBot(delay=0)
+        reply_msg = SimpleNamespace(chat=SimpleNamespace(id=1), message_id=2)
+        buffer = StreamBuffer()
+        gateway = TelegramGateway(bot, private_rate=1000, burst=1000)
+        renderer = ReplyRenderer(gateway, reply_msg, "header\n\n")
+
+        rendering = asyncio.create_task(renderer.run(buffer))
+        await read_stream(provider_stream(chunks, 0.01), buffer)
+        await rendering
+        await renderer.finish(buffer.text)
+        await asyncio.gather(*gateway.inflight)
+
+        self.assertTrue(len(renderer.pages) > 3)
+        self.assertTrue(renderer.pages[0].message is reply_msg)
+        shown = [bot.messages[p.message.message_id] for p in renderer.pages]
+        self.assertTrue(all(0 < len(t) <= MAX_TEXT_LENGTH for t in shown))
+        # the pages follow each other, the last one shows the end of the reply
+        starts = [p.start for p in renderer.pages]
+        self.assertTrue(starts == sorted(set(starts)))
+        last = renderer.pages[-1]
+        self.assertTrue(shown[-1] == escape(last.prefix + text[last.start :]))
+        self.assertTrue(not shown[0].startswith("header"))
+        # a code block cut in two is reopened on the next page
+        self.assertTrue(any(p.prefix.startswith("```python") for p in renderer.pages))
+        self.assertTrue(all(t.count("```") % 2 == 0 for t in shown))
+        await gateway.close()